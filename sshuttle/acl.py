@@ -0,0 +1,154 @@
+import socket
+import struct
+from bisect import bisect_right
+
+import ipaddress
+
+from sshuttle.helpers import log
+
+
+def _ip_to_int(ip):
+    if ':' in ip:
+        hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+        return (6, (hi << 64) | lo)
+    return (4, struct.unpack('!I', socket.inet_aton(ip))[0])
+
+
+def _parse_ports(entries):
+    # "80" or "1000-2000" -> sorted, merged list of (first, last)
+    ranges = []
+    for entry in entries:
+        entry = str(entry)
+        if '-' in entry:
+            first, last = entry.split('-', 1)
+            ranges.append((int(first), int(last)))
+        else:
+            ranges.append((int(entry), int(entry)))
+    ranges.sort()
+    merged = []
+    for (first, last) in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return ([first for (first, last) in merged],
+            [last for (first, last) in merged])
+
+
+def _port_in(intervals, port):
+    (firsts, lasts) = intervals
+    i = bisect_right(firsts, port) - 1
+    return i >= 0 and port <= lasts[i]
+
+
+class AclIndex(object):
+    """Precompiled form of an ACL dict like {"10.0.0.0/8": ["80", "1-1024"]}.
+
+    Networks are kept in one hash table per (address family, prefix
+    length), keyed by the network's integer address; the ports of each
+    network are merged into sorted intervals.  A lookup therefore costs one
+    dict probe per prefix length in use plus a bisect, no matter how many
+    entries the ACL has.  "0.0.0.0/0" matches every address, including
+    IPv6 ones.
+
+    update() may be called from another thread than match(): the slots it
+    changes are replaced, each with a single assignment, rather than
+    modified in place.
+    """
+
+    def __init__(self, acl=None):
+        # cidr -> intervals, for "0.0.0.0/0"
+        self.any = {}
+        # family -> {prefixlen: {network: {cidr: intervals}}}
+        self.nets = {4: {}, 6: {}}
+        # family -> [(hostbits, {network: {cidr: intervals}})], longest
+        # prefix first
+        self.tables = {4: [], 6: []}
+        # cidr -> (family, prefixlen, network), or None for "0.0.0.0/0"
+        self.entries = {}
+        self.update(acl or {})
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, changes):
+        # changes is {cidr: ports}; ports of None removes the entry
+        for (cidr, ports) in changes.items():
+            parsed = None
+            if ports is not None:
+                parsed = self._parse(cidr, ports)
+            if parsed is None:
+                self._remove(cidr)
+            else:
+                # a changed entry's slot is rebuilt aside and put in place
+                # with one assignment, so match() never finds it missing
+                self._put(cidr, *parsed)
+        for (family, bits) in ((4, 32), (6, 128)):
+            nets = self.nets[family]
+            self.tables[family] = [(bits - prefixlen, nets[prefixlen])
+                                   for prefixlen in sorted(nets, reverse=True)]
+
+    def _parse(self, cidr, ports):
+        # -> (where, intervals), where being what self.entries keeps
+        try:
+            net = ipaddress.ip_network(u'%s' % cidr, strict=False)
+            intervals = _parse_ports(ports)
+        except ValueError as e:
+            log("Failed to parse ACL entry '%s': %s. Ignoring entry.\n"
+                % (cidr, e))
+            return None
+        if net.version == 4 and net.prefixlen == 0:
+            return (None, intervals)
+        return ((net.version, net.prefixlen, int(net.network_address)),
+                intervals)
+
+    def _put(self, cidr, where, intervals):
+        if where is None:
+            slot = dict(self.any)
+            slot[cidr] = intervals
+            self.any = slot
+        else:
+            (family, prefixlen, network) = where
+            table = self.nets[family].setdefault(prefixlen, {})
+            slot = dict(table.get(network, {}))
+            slot[cidr] = intervals
+            table[network] = slot
+        self.entries[cidr] = where
+
+    def _remove(self, cidr):
+        if cidr not in self.entries:
+            return
+        where = self.entries.pop(cidr)
+        if where is None:
+            slot = dict(self.any)
+            del slot[cidr]
+            self.any = slot
+            return
+        (family, prefixlen, network) = where
+        table = self.nets[family][prefixlen]
+        slot = dict(table[network])
+        del slot[cidr]
+        if slot:
+            table[network] = slot
+        else:
+            del table[network]
+            if not table:
+                del self.nets[family][prefixlen]
+
+    def match(self, ip, port):
+        port = int(port)
+        for intervals in self.any.values():
+            if _port_in(intervals, port):
+                return True
+        try:
+            (family, addr) = _ip_to_int(ip)
+        except (socket.error, ValueError):
+            return False
+        for (hostbits, table) in self.tables[family]:
+            slot = table.get(addr >> hostbits << hostbits)
+            if slot:
+                for intervals in slot.values():
+                    if _port_in(intervals, port):
+                        return True
+        return False
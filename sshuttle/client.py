@@ -8,18 +8,25 @@ import os
 import sshuttle.ssnet as ssnet
 import sshuttle.ssh as ssh
 import sshuttle.ssyslog as ssyslog
+import sshuttle.metrics as metrics
 import sys
 import platform
 import json
 from dnslib import *
-from sshuttle.ssnet import SockWrapper, Handler, Proxy, Mux, MuxWrapper
+from sshuttle.ssnet import SockWrapper, Handler, Proxy, Mux, MuxWrapper, _add
 from sshuttle.helpers import log, debug1, debug2, debug3, Fatal, islocal, \
     resolvconf_nameservers
 from sshuttle.methods import get_method, Features
-import ipaddress
+from sshuttle.acl import AclIndex
+from sshuttle.dnscache import DnsCache, payload_size
 import threading
 import redis
 import time
+import heapq
+import random
+import struct
+import itertools
+from collections import deque
 
 _extra_fd = os.open('/dev/null', os.O_RDONLY)
 
@@ -32,6 +39,8 @@ def got_signal(signum, frame):
 _pidname = None
 _allowed_targets = {}
 _disallowed_targets = {}
+_allowed_index = AclIndex()
+_disallowed_index = AclIndex()
 _allowed_sources = {}
 _excluded_sources = {}
 
@@ -45,6 +54,17 @@ sshuttleAclSources = "sshuttleAclSources"
 sshuttleAclExcluded = "sshuttleAclExcluded"
 sshuttleAclEventsChannel = "aclEvents"
 
+# Each ACL key is either a JSON string holding the whole ACL, or a hash
+# with one field per source or target whose value is that entry's JSON.
+# A message on the events channel is either the name of the key, to
+# reload it completely, or "<key>:<field>[,<field>...]" to reread just
+# those fields of a hash; a field that is gone is removed from the ACL.
+ACL_KEYS = {
+    ALLOWED_ACL_TYPE: sshuttleAcl,
+    ACL_SOURCES_TYPE: sshuttleAclSources,
+    ACL_EXCLUDED_SOURCES_TYPE: sshuttleAclExcluded,
+}
+
 preferreddns = ''
 notpreferreddns = ''
 
@@ -72,6 +92,12 @@ try:
 except KeyError:
     log('Error: Could not read environment variables for REDIS_HOST and/or REDIS_PORT\n')
 
+def _text(s):
+    # redis hands us bytes on python 3
+    if isinstance(s, bytes):
+        return s.decode("utf-8")
+    return s
+
 def check_daemon(pidfile):
     global _pidname
     _pidname = os.path.abspath(pidfile)
@@ -153,6 +179,13 @@ class MultiListener:
         if self.v4:
             self.v4.setsockopt(level, optname, value)
 
+    def setblocking(self, flag):
+        assert(self.bind_called)
+        if self.v6:
+            self.v6.setblocking(flag)
+        if self.v4:
+            self.v4.setblocking(flag)
+
     def add_handler(self, handlers, callback, method, mux):
         assert(self.bind_called)
         socks = []
@@ -161,12 +194,12 @@ class MultiListener:
         if self.v4:
             socks.append(self.v4)
 
-        handlers.append(
-            Handler(
-                socks,
-                lambda sock: callback(sock, method, mux, handlers)
-            )
+        handler = Handler(
+            socks,
+            lambda sock: callback(sock, method, mux, handlers)
         )
+        handlers.append(handler)
+        return handler
 
     def listen(self, backlog):
         assert(self.bind_called)
@@ -203,12 +236,12 @@ class MultiListener:
         assert(self.bind_called)
         if self.v6:
             listenip = self.v6.getsockname()
-            debug1('%s listening on %r.\n' % (what, listenip))
-            debug2('%s listening with %r.\n' % (what, self.v6))
+            debug1('%s listening on %r.\n', what, listenip)
+            debug2('%s listening with %r.\n', what, self.v6)
         if self.v4:
             listenip = self.v4.getsockname()
-            debug1('%s listening on %r.\n' % (what, listenip))
-            debug2('%s listening with %r.\n' % (what, self.v4))
+            debug1('%s listening on %r.\n', what, listenip)
+            debug2('%s listening with %r.\n', what, self.v4)
 
 
 class FirewallClient:
@@ -330,63 +363,200 @@ class FirewallClient:
 
 dnsreqs = {}
 dnsreqs2 = {}
+dns_inflight = {}
+dns_waiters = {}
+dns_started = {}
 udp_by_src = {}
-tcp_conns = []
+tcp_conns = {}
 active_tcp_conns = {}
 
-def expire_connections(now, mux):
-    remove = []
-    for chan, timeout in dnsreqs.items():
-        if timeout < now:
-            debug3('expiring dnsreqs channel=%d\n' % chan)
-            remove.append(chan)
-            del mux.channels[chan]
-    for chan in remove:
-        del dnsreqs[chan]
-    debug3('Remaining DNS requests: %d\n' % len(dnsreqs))
-
-    remove = []
-    for peer, (chan, timeout) in udp_by_src.items():
-        if timeout < now:
-            debug3('expiring UDP channel channel=%d peer=%r\n' % (chan, peer))
-            mux.send(chan, ssnet.CMD_UDP_CLOSE, b'')
-            remove.append(peer)
-            del mux.channels[chan]
-    for peer in remove:
-        del udp_by_src[peer]
-    debug3('Remaining UDP channels: %d\n' % len(udp_by_src))
-
-    # we also want to close all TCP connections from sources that have expired their lease
-    global tcp_conns
-    new_tcp_conns = []
-    for (srcip, dstip, s, sock) in tcp_conns:
-        if connection_is_allowed(dstip[0], str(dstip[1]), srcip[0]) and s.ok:
-            new_tcp_conns.append((srcip, dstip, s, sock))
-        else:
-            try:
-                # remove from list of active tcp connections
-                del active_tcp_conns[sock]
-
-                # really make sure we kill everything while we can
-                s.ok = False
-                s.wrap1.noread()
-                s.wrap1.nowrite()
-                s.wrap2.noread()
-                s.wrap2.nowrite()
-                del mux.channels[s.wrap2.channel]
-                sock.close()
-                sock.shutdown(2)
-            except:
-                # we may hit an exception if the socket has already been closed...that is ok
-                pass
+# Everything that can expire is also put on a heap of
+# (deadline, seq, kind, key) entries, so that expire_connections() only
+# looks at what is actually due.  Entries aren't removed when their
+# request or connection goes away or gets a new deadline; they are checked
+# against the real state when they come up instead.
+EXPIRE_DNS = 1
+EXPIRE_UDP = 2
+EXPIRE_TCP = 3
+EXPIRE_DNS_FORWARD = 4
+_expiry = []
+_expiry_seq = itertools.count()
+tcp_conns_by_src = {}
+tcp_conns_by_mux = {}
+# srcip -> when the connections from it are checked next
+tcp_rechecks = {}
+
+
+def schedule_expiry(when, kind, key):
+    heapq.heappush(_expiry, (when, next(_expiry_seq), kind, key))
+
+
+def next_expiry(now):
+    # how long the main loop may sleep before expire_connections() has
+    # something to do
+    if not _expiry:
+        return None
+    return max(0, _expiry[0][0] - now)
+
+
+def source_lease(srcip, now):
+    # the first of the source's exclusion and its allowance to run out
+    # from now on; either can take its connections away when it does
+    lease = None
+    for sources in (_excluded_sources, _allowed_sources):
+        if sources:
+            end = sources.get(srcip, 0) / 1000.0
+            if end > now and (lease is None or end < lease):
+                lease = end
+    return max(lease or now, now + 1)
+
+
+def watch_tcp_source(srcip, now):
+    # look again when the source's lease runs out; it may have been renewed
+    # by then.  One check covers all of the source's connections.
+    lease = source_lease(srcip, now)
+    if srcip not in tcp_rechecks or lease < tcp_rechecks[srcip]:
+        tcp_rechecks[srcip] = lease
+        schedule_expiry(lease, EXPIRE_TCP, srcip)
+
+
+def check_tcp_conn(sock, now):
+    (srcip, dstip, s) = tcp_conns[sock]
+    if connection_is_allowed(dstip[0], str(dstip[1]), srcip[0]):
+        watch_tcp_source(srcip[0], now)
+    else:
+        close_tcp_conn(sock)
+
 
-    tcp_conns = new_tcp_conns
+def check_tcp_source(srcip, now):
+    del tcp_rechecks[srcip]
+    for sock in list(tcp_conns_by_src.get(srcip, ())):
+        check_tcp_conn(sock, now)
 
-def onaccept_tcp(listener, method, mux, handlers):
+
+def add_tcp_conn(sock, srcip, dstip, s, now):
+    active_tcp_conns[sock] = True
+    tcp_conns[sock] = (srcip, dstip, s)
+    tcp_conns_by_src.setdefault(srcip[0], set()).add(sock)
+    tcp_conns_by_mux.setdefault(s.wrap2.mux, set()).add(sock)
+    s.onclose = lambda s: forget_tcp_conn(sock)
+    watch_tcp_source(srcip[0], now)
+
+
+def forget_tcp_conn(sock):
+    active_tcp_conns.pop(sock, None)
+    conn = tcp_conns.pop(sock, None)
+    if conn:
+        srcip = conn[0][0]
+        tcp_conns_by_src[srcip].discard(sock)
+        if not tcp_conns_by_src[srcip]:
+            del tcp_conns_by_src[srcip]
+        mux = conn[2].wrap2.mux
+        tcp_conns_by_mux[mux].discard(sock)
+        if not tcp_conns_by_mux[mux]:
+            del tcp_conns_by_mux[mux]
+
+
+def close_tcp_conn(sock):
+    (srcip, dstip, s) = tcp_conns[sock]
+    debug1('Closing TCP: %s:%r -> %s:%r.\n',
+           srcip[0], srcip[1], dstip[0], dstip[1])
+    try:
+        # this forgets about the connection, too
+        s.ok = False
+
+        # really make sure we kill everything while we can
+        s.wrap1.noread()
+        s.wrap1.nowrite()
+        s.wrap2.noread()
+        s.wrap2.nowrite()
+        del s.wrap2.mux.channels[s.wrap2.channel]
+        sock.close()
+        sock.shutdown(2)
+    except:
+        # we may hit an exception if the socket has already been closed...that is ok
+        pass
+    forget_tcp_conn(sock)
+
+
+def expire_connections(now, mux, method=None):
+    while _expiry and _expiry[0][0] <= now:
+        (when, seq, kind, key) = heapq.heappop(_expiry)
+        if kind == EXPIRE_DNS:
+            if dnsreqs.get(key) == when:
+                debug3('expiring dnsreqs channel=%d\n', key)
+                del mux.channels[key]
+                forget_dns_request(key)
+        elif kind == EXPIRE_UDP:
+            if key not in udp_by_src:
+                continue
+            (chan, timeout) = udp_by_src[key]
+            if timeout > now:
+                schedule_expiry(timeout, EXPIRE_UDP, key)
+            else:
+                debug3('expiring UDP channel channel=%d peer=%r\n', chan, key)
+                mux.send(chan, ssnet.CMD_UDP_CLOSE, b'')
+                del mux.channels[chan]
+                del udp_by_src[key]
+                if method:
+                    method.forget_udp(key)
+        elif kind == EXPIRE_TCP:
+            # we also want to close all TCP connections from sources that
+            # have expired their lease
+            if tcp_rechecks.get(key) == when:
+                check_tcp_source(key, now)
+        elif kind == EXPIRE_DNS_FORWARD:
+            if _dns_forwarder:
+                _dns_forwarder.expire(key, when, now)
+
+
+class UdpSenders(Handler):
+
+    # Some methods (tproxy) keep the sockets they send UDP replies from
+    # open.  Each one is bound to the remote address it replies as, so
+    # whatever the client sends to that address next ends up on it rather
+    # than on the listener; it's handled just as if the listener got it.
+    def __init__(self, method):
+        Handler.__init__(self, [])
+        self.method = method
+        self.callbacks = {}  # listener -> callback
+        self.listeners = {}  # sender -> listener
+        method.udp_senders_changed = self.senders_changed
+
+    def add_listener(self, handler):
+        for sock in handler.socks:
+            self.callbacks[sock] = handler.callback
+
+    def senders_changed(self):
+        self.changed()
+
+    def pre_select(self, r, w, x):
+        self.listeners = dict(self.method.udp_senders())
+        for sock in self.listeners:
+            _add(r, sock)
+
+    def callback(self, sock):
+        callback = self.callbacks.get(self.listeners.get(sock))
+        if callback:
+            callback(sock)
+
+
+def pick_mux(muxes):
+    # stripe new TCP channels over the ssh sessions: least TCP connections
+    # first, then least data waiting to be sent.  The DNS and UDP channels,
+    # which are all on the first one, don't count.
+    return min(muxes, key=lambda m: (len(tcp_conns_by_mux.get(m, ())),
+                                     m.amount_queued()))
+
+
+def onaccept_tcp(listener, method, muxes, handlers):
     global _extra_fd
     try:
         sock, srcip = listener.accept()
     except socket.error as e:
+        if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+            # another worker got there first
+            return
         if e.args[0] in [errno.EMFILE, errno.ENFILE]:
             debug1('Rejected incoming connection: too many open files!\n')
             # free up an fd so we can eat the connection
@@ -403,195 +573,388 @@ def onaccept_tcp(listener, method, mux, handlers):
     dstip = method.get_tcp_dstip(sock)
 
     if not connection_is_allowed(dstip[0], str(dstip[1]), srcip[0]):
-        debug1('Deny TCP: %s:%r -> %s:%r.\n' % (srcip[0], srcip[1],
-                                                dstip[0], dstip[1]))
+        debug1('Deny TCP: %s:%r -> %s:%r.\n',
+               srcip[0], srcip[1], dstip[0], dstip[1])
+        metrics.counters['tcp_denied'] += 1
         sock.close()
         return
 
-    debug1('Accept TCP: %s:%r -> %s:%r.\n' % (srcip[0], srcip[1],
-                                              dstip[0], dstip[1]))
+    debug1('Accept TCP: %s:%r -> %s:%r.\n',
+           srcip[0], srcip[1], dstip[0], dstip[1])
     if dstip[1] == sock.getsockname()[1] and islocal(dstip[0], sock.family):
         debug1("-- ignored: that's my address!\n")
         sock.close()
         return
+    mux = pick_mux(muxes)
     chan = mux.next_channel()
     if not chan:
         log('warning: too many open channels.  Discarded connection.\n')
         sock.close()
         return
-    mux.send(chan, ssnet.CMD_TCP_CONNECT, b'%d,%s,%d' %
-             (sock.family, dstip[0].encode("ASCII"), dstip[1]))
+    metrics.counters['tcp_accepted'] += 1
+    mux.send(chan, ssnet.CMD_TCP_CONNECT,
+             ssnet.tcp_connect_data(mux.protocol, sock.family, dstip))
     outwrap = MuxWrapper(mux, chan)
     s = Proxy(SockWrapper(sock, sock, None, None, lambda: connection_is_active(sock)), outwrap)
     handlers.append(s)
-    active_tcp_conns[sock] = True
-    tcp_conns.append((srcip, dstip, s, sock))
-    expire_connections(time.time(), mux)
-
-def port_in_range(port_range, port):
-
-    parsed_range = port_range.split("-")
-    port_start = int(parsed_range[0])
-    port_end = int(parsed_range[1])
-    dest_port = int(port)
-
-    if (dest_port >= port_start and dest_port <= port_end):
-        return True
-
-    return False
-
-def acl_entry_match(cidr, port, storeToCheck):
-    if (cidr in storeToCheck):
-        if (port in storeToCheck[cidr]):
-            return True
-        for port_entry in storeToCheck[cidr]:
-            if ("-" in port_entry):
-                if (port_in_range(port_entry, port)):
-                    return True
-
-    return False
-
-def matches_acl(dstip, dstport, store_to_check):
-    # check for IP address rule
-    cidr = dstip + "/32"
-
-    if (acl_entry_match(cidr, dstport, store_to_check)):
-        return True
-
-    # check for global rule
-    cidr = "0.0.0.0/0"
-    if (acl_entry_match(cidr, dstport, store_to_check)):
-        return True
-
-    # check for subnet rule
-    for cidr_entry in store_to_check:
-        if (cidr_entry != "0.0.0.0/0" and int(cidr_entry.split("/")[1]) != 32):
-            try:
-                network = ipaddress.ip_network(unicode(cidr_entry))
-                addr = ipaddress.ip_network(unicode(dstip + "/32"))
-                if (addr.subnet_of(network)):
-                    if (acl_entry_match(cidr_entry, dstport, store_to_check)):
-                        return True
-            except Exception as e:
-                log("Failed to parse CIDR block '%s': %s. Ignoring entry.\n" % (cidr_entry, e))
-
-    return False
+    now = time.time()
+    add_tcp_conn(sock, srcip, dstip, s, now)
+    # DNS and UDP channels always live on the first mux
+    expire_connections(now, muxes[0], method)
 
 def connection_is_allowed(dstip, dstport, srcip):
 
+    # the source lists can be updated in place by the ACL thread; look
+    # each one up only once.
     ctime = time.time()
-    if _excluded_sources and srcip in _excluded_sources and (_excluded_sources[srcip] / 1000.0) >= ctime:
+    excluded = _excluded_sources and _excluded_sources.get(srcip)
+    if excluded and (excluded / 1000.0) >= ctime:
         debug1("Connection from a source excluded from the ACL\n")
         return True
-    if not _allowed_sources or (srcip not in _allowed_sources) or (
-                    srcip in _allowed_sources and (_allowed_sources[srcip] / 1000.0) < ctime):
+    lease = _allowed_sources and _allowed_sources.get(srcip)
+    if not lease or (lease / 1000.0) < ctime:
         debug3("Connection not allowed - allowed sources exception\n")
         return False
-    if matches_acl(dstip, dstport, _disallowed_targets):
+    if _disallowed_index.match(dstip, dstport):
         debug3("Connection not allowed - firewall ACL exception\n")
         return False
-    elif matches_acl(dstip, dstport, _allowed_targets):
+    elif _allowed_index.match(dstip, dstport):
         return True
 
 def connection_is_active(sock):
     return sock in active_tcp_conns
 
-def udp_done(chan, data, method, sock, dstip):
-    (src, srcport, data) = data.split(b",", 2)
-    srcip = (src, int(srcport))
-    debug3('doing send from %r to %r\n' % (srcip, dstip,))
+# datagrams taken from the UDP listener per wakeup, at most
+UDP_BATCH = 64
+
+
+def udp_done(chan, data, method, sock, dstip, mux):
+    (srcip, data) = ssnet.split_udp_data(mux.protocol, data)
+    debug3('doing send from %r to %r\n', srcip, dstip)
     method.send_udp(sock, srcip, dstip, data)
 
 
 def onaccept_udp(listener, method, mux, handlers):
+    # everything that's queued goes out in one go; the mux writes all of
+    # it with a single writev() once it's writable
     now = time.time()
-    t = method.recv_udp(listener, 4096)
-    if t is None:
-        return
-    srcip, dstip, data = t
-    debug1('Accept UDP: %r -> %r.\n' % (srcip, dstip,))
-    if srcip in udp_by_src:
-        chan, timeout = udp_by_src[srcip]
-    else:
-        chan = mux.next_channel()
-        mux.channels[chan] = lambda cmd, data: udp_done(
-            chan, data, method, listener, dstip=srcip)
-        mux.send(chan, ssnet.CMD_UDP_OPEN, b"%d" % listener.family)
-    udp_by_src[srcip] = chan, now + 30
+    for (srcip, dstip, data) in method.recv_udp_batch(listener, 65536,
+                                                      UDP_BATCH):
+        debug1('Accept UDP: %r -> %r.\n', srcip, dstip)
+        metrics.counters['udp_datagrams'] += 1
+        if srcip in udp_by_src:
+            chan, timeout = udp_by_src[srcip]
+        else:
+            chan = mux.next_channel()
+            mux.channels[chan] = udp_channel(chan, method, mux, listener,
+                                           srcip)
+            mux.send(chan, ssnet.CMD_UDP_OPEN,
+                     ssnet.udp_open_data(mux.protocol, listener.family))
+            schedule_expiry(now + 30, EXPIRE_UDP, srcip)
+        udp_by_src[srcip] = chan, now + 30
+
+        mux.send(chan, ssnet.CMD_UDP_DATA,
+                 ssnet.udp_header(mux.protocol, dstip) + data)
 
-    hdr = b"%s,%d," % (dstip[0].encode("ASCII"), dstip[1])
-    mux.send(chan, ssnet.CMD_UDP_DATA, hdr + data)
+    expire_connections(now, mux, method)
 
-    expire_connections(now, mux)
+
+def udp_channel(chan, method, mux, listener, srcip):
+    # a closure of its own, as the one in the loop above would see the
+    # last chan and srcip of the batch
+    return lambda cmd, data: udp_done(chan, data, method, listener,
+                                      dstip=srcip, mux=mux)
 
 
 def dns_done(chan, data, method, sock, srcip, dstip, mux):
-    debug3('dns_done: channel=%d src=%r dst=%r\n' % (chan, srcip, dstip))
+    debug3('dns_done: channel=%d src=%r dst=%r\n', chan, srcip, dstip)
 
     response = DNSRecord.parse(data)
-    debug3('For the DNS request: %r   >>>>> DNS response: %r <<<<<<' % (dnsreqs2[chan], response))
+    debug3('For the DNS request: %r   >>>>> DNS response: %r <<<<<<',
+           dnsreqs2[chan], response)
+    now = time.time()
+    if _dns_cache is not None:
+        _dns_cache.put(response, data, now)
+    if chan in dns_started:
+        metrics.dns_latency.observe(now - dns_started[chan])
 
     del mux.channels[chan]
-    del dnsreqs[chan]
-    del dnsreqs2[chan]
+    waiters = forget_dns_request(chan)
     method.send_udp(sock, srcip, dstip, data)
+    method.forget_udp(dstip)
+    for (wsock, wsrcip, wdstip, qid) in waiters:
+        method.send_udp(wsock, wsrcip, wdstip,
+                        struct.pack('!H', qid) + data[2:])
+        method.forget_udp(wdstip)
+
+
+def inflight_key(request):
+    # only askers that would take the very same answer wait for each
+    # other: resolvers using 0x20 check the case of the qname they get
+    # back, and the answer mustn't be larger than any of them can take
+    q = request.q
+    return (str(q.qname), q.qtype, q.qclass, payload_size(request))
+
+
+def forget_dns_request(chan):
+    # returns whoever asked the same question while this one was
+    # outstanding
+    dnsreqs.pop(chan, None)
+    dns_started.pop(chan, None)
+    request = dnsreqs2.pop(chan, None)
+    if request and len(request.questions) == 1:
+        key = inflight_key(request)
+        if dns_inflight.get(key) == chan:
+            del dns_inflight[key]
+    return dns_waiters.pop(chan, [])
 
 
 def ondns(listener, method, mux, handlers):
     now = time.time()
-    t = method.recv_udp(listener, 4096)
+    t = method.recv_udp(listener, 65536)
     if t is None:
         return
     srcip, dstip, data = t
 
     request = DNSRecord.parse(data)
+    metrics.counters['dns_requests'] += 1
 
     qname = request.q.qname
     qn = str(qname)
     qtype = request.q.qtype
     qt = QTYPE[qtype]
 
+    if _dns_cache is not None:
+        response = _dns_cache.get(request, now)
+        if response:
+            debug3('DNS cache hit: %s %s\n', qn, qt)
+            method.send_udp(listener, dstip, srcip, response)
+            method.forget_udp(srcip)
+            return
+
+    key = None
+    if len(request.questions) == 1:
+        key = inflight_key(request)
+        if key in dns_inflight:
+            # the same question is already on its way; just wait for its
+            # answer
+            chan = dns_inflight[key]
+            debug3('DNS request %s %s joins channel=%d\n', qn, qt, chan)
+            dns_waiters[chan].append(
+                (listener, dstip, srcip, request.header.id))
+            return
+
     chan = mux.next_channel()
+    if key:
+        dns_inflight[key] = chan
+        dns_waiters[chan] = []
     dnsreqs2[chan] = request
     dnsreqs[chan] = now + 30
+    dns_started[chan] = now
+    schedule_expiry(now + 30, EXPIRE_DNS, chan)
     mux.channels[chan] = lambda cmd, data: dns_done(
         chan, data, method, listener, srcip=dstip, dstip=srcip, mux=mux)
 
-    global preferreddns
-    global notpreferreddns
+    global _dns_forwarder
 
     if preferreddns and notpreferreddns and DNS_PROXY_SUFFIX1 and \
             (qn.endswith(DNS_PROXY_SUFFIX1) or qn.endswith(DNS_PROXY_SUFFIX2)):
+        if not _dns_forwarder:
+            _dns_forwarder = DnsForwarder()
+            handlers.append(_dns_forwarder)
+        _dns_forwarder.forward(
+            data, now,
+            lambda response: dns_done(chan, response, method, listener,
+                                      srcip=dstip, dstip=srcip, mux=mux),
+            # fallback to agent if both AD servers are down.
+            lambda: mux.send(chan, ssnet.CMD_DNS_REQ, data))
+    else:
+        mux.send(chan, ssnet.CMD_DNS_REQ, data)
+
+    expire_connections(now, mux, method)
+
+
+_dns_cache = None
+
+DNS_PORT = 53
+DNS_HEDGE_DELAY = 0.5
+DNS_TIMEOUT = 5
+
+_dns_forwarder = None
+
+
+class DnsForwarder(Handler):
+
+    # Sends queries straight to the AD servers (DNS_1 and DNS_2) from a
+    # single non-blocking socket.  Each query goes to the preferred server
+    # first, and also to the other one if there's no answer within
+    # DNS_HEDGE_DELAY; whichever answers first becomes the preferred one.
+    # Queries are told apart by the transaction ID we give them, and the
+    # timeouts are run by expire_connections().
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        Handler.__init__(self, [self.sock])
+        # our id -> [original data, done, fallback, started, next timer]
+        self.pending = {}
+
+    def forward(self, data, now, done, fallback):
+        if len(data) < 12:
+            fallback()
+            return
+        qid = random.randrange(65536)
+        while qid in self.pending:
+            qid = random.randrange(65536)
+        self.pending[qid] = [data, done, fallback, now, now + DNS_HEDGE_DELAY]
+        self.send(qid, preferreddns)
+        schedule_expiry(now + DNS_HEDGE_DELAY, EXPIRE_DNS_FORWARD, qid)
+
+    def send(self, qid, server):
+        data = self.pending[qid][0]
         try:
-            response = send_udp(data, preferreddns, 53)
-            dns_done(chan, response, method, listener, srcip=dstip, dstip=srcip, mux=mux)
-        except socket.error:
-            debug3('Error: Could not contact DNS server %r, now trying %r' % (preferreddns, notpreferreddns))
+            self.sock.sendto(struct.pack('!H', qid) + data[2:],
+                             (server, DNS_PORT))
+        except socket.error as e:
+            debug3('Error: Could not contact DNS server %r: %s\n', server, e)
+
+    def expire(self, qid, when, now):
+        q = self.pending.get(qid)
+        if not q or q[4] != when:
+            return  # answered already, or the id was reused
+        (data, done, fallback, started, timer) = q
+        if timer < started + DNS_TIMEOUT:
+            debug3('No answer from DNS server %r yet, now trying %r\n',
+                   preferreddns, notpreferreddns)
+            self.send(qid, notpreferreddns)
+            q[4] = started + DNS_TIMEOUT
+            schedule_expiry(q[4], EXPIRE_DNS_FORWARD, qid)
+        else:
+            debug3('Error: No answer from DNS servers %r and %r\n',
+                   preferreddns, notpreferreddns)
+            del self.pending[qid]
+            fallback()
 
-            _notpreferreddns = notpreferreddns
-            notpreferreddns = preferreddns
-            preferreddns = _notpreferreddns
+    def callback(self, sock):
+        global preferreddns
+        global notpreferreddns
 
-            # try the other AD server if there was an error...
+        while 1:
             try:
-                response = send_udp(data, preferreddns, 53)
-                dns_done(chan, response, method, listener, srcip=dstip, dstip=srcip, mux=mux)
-            except socket.error:
-                # fallback to agent if both AD servers are down.
-                mux.send(chan, ssnet.CMD_DNS_REQ, data)
-    else:
-        mux.send(chan, ssnet.CMD_DNS_REQ, data)
+                (response, peer) = self.sock.recvfrom(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                debug3('DNS forwarder: %s\n', e)
+                continue
+            if len(response) < 12 or peer[0] not in (DNS_1, DNS_2):
+                continue
+            qid = struct.unpack('!H', response[:2])[0]
+            q = self.pending.pop(qid, None)
+            if not q:
+                continue  # late or duplicate answer
+            if peer[0] != preferreddns:
+                notpreferreddns = preferreddns
+                preferreddns = peer[0]
+            q[1](q[0][:2] + response[2:])
+
+
+ACL_SOURCES_CHANGED = 1
+ACL_TARGETS_CHANGED = 2
+
+_acl_watcher = None
+
+
+def changed_sources(old, new):
+    old = old or {}
+    new = new or {}
+    return [src for src in set(old) | set(new) if old.get(src) != new.get(src)]
+
+
+def revoked_targets(old, new):
+    # only entries that went away or changed can take access away
+    old = old or {}
+    new = new or {}
+    return dict((cidr, ports) for (cidr, ports) in old.items()
+                if new.get(cidr) != ports)
+
+
+def update_sources(sources, changes):
+    # apply changes in place, so that we don't copy a big source list on
+    # every lease renewal
+    if sources is None:
+        sources = {}
+    for (src, lease) in changes.items():
+        if lease is None:
+            sources.pop(src, None)
+        else:
+            sources[src] = lease
+    post_acl_change(ACL_SOURCES_CHANGED, list(changes))
+    return sources
+
+
+def update_targets(changes):
+    global _allowed_targets
+    targets = _allowed_targets
+    if targets is None:
+        targets = {}
+    revoked = revoked_targets(
+        dict((cidr, targets[cidr]) for cidr in changes if cidr in targets),
+        changes)
+    for (cidr, ports) in changes.items():
+        if ports is None:
+            targets.pop(cidr, None)
+        else:
+            targets[cidr] = ports
+    _allowed_targets = targets
+    _allowed_index.update(changes)
+    if revoked:
+        post_acl_change(ACL_TARGETS_CHANGED, AclIndex(revoked))
+
+
+def post_acl_change(kind, what):
+    if _acl_watcher and what:
+        _acl_watcher.post(kind, what)
+
 
-    expire_connections(now, mux)
+class AclWatcher(Handler):
 
+    # The ACLs are reloaded by the ChannelListener thread; it tells the main
+    # loop what changed through a socketpair, and the main loop then checks
+    # just the connections that could be affected.
+    def __init__(self):
+        (self.rsock, self.wsock) = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        Handler.__init__(self, [self.rsock])
+        self.changes = deque()
 
-def send_udp(data, host, port):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(5)
-    sock.sendto(data, (host, port))
-    response, server = sock.recvfrom(8192)
-    sock.close()
-    return response
+    def post(self, kind, what):
+        self.changes.append((kind, what))
+        try:
+            self.wsock.send(b'!')
+        except socket.error:
+            pass  # the main loop has a wakeup pending anyway
+
+    def callback(self, sock):
+        try:
+            self.rsock.recv(4096)
+        except socket.error:
+            pass
+        now = time.time()
+        while self.changes:
+            (kind, what) = self.changes.popleft()
+            if kind == ACL_SOURCES_CHANGED:
+                socks = set()
+                for src in what:
+                    socks.update(tcp_conns_by_src.get(src, ()))
+            else:
+                socks = [sock for (sock, (srcip, dstip, s))
+                         in tcp_conns.items()
+                         if what.match(dstip[0], dstip[1])]
+            debug2('ACL change: checking %d connections\n', len(socks))
+            for sock in socks:
+                if sock in tcp_conns:
+                    check_tcp_conn(sock, now)
 
 
 class AclHandler:
@@ -604,37 +967,85 @@ class AclHandler:
     def reload_acl_file(self):
         self.pullAcl()
         if (self.acl_type is ALLOWED_ACL_TYPE):
+            old = _allowed_targets
             self.reload_acl_targets_file()
+            revoked = revoked_targets(old, _allowed_targets)
+            if revoked:
+                post_acl_change(ACL_TARGETS_CHANGED, AclIndex(revoked))
         elif (self.acl_type is ACL_SOURCES_TYPE):
+            old = _allowed_sources
             self.reload_acl_sources_file()
+            post_acl_change(ACL_SOURCES_CHANGED,
+                            changed_sources(old, _allowed_sources))
         elif (self.acl_type is ACL_EXCLUDED_SOURCES_TYPE):
+            old = _excluded_sources
             self.reload_acl_excluded_sources_file()
+            post_acl_change(ACL_SOURCES_CHANGED,
+                            changed_sources(old, _excluded_sources))
 
 
     def pullAcl(self):
+        key = ACL_KEYS.get(self.acl_type)
+        if key is None:
+            debug1("pullAcl() -> Unsupported ACL type %d\n", self.acl_type)
+            self.acl = None
+        elif _text(self.redisClient.type(key)) == "hash":
+            self.acl = self.parseFields(self.redisClient.hgetall(key).items())
+        else:
+            self.acl = self.redisClient.get(key)
+
+    def parseAcl(self):
+        if isinstance(self.acl, dict):
+            return self.acl
+        return json.loads(_text(self.acl))
+
+    def parseFields(self, items):
+        acl = {}
+        for (field, value) in items:
+            field = _text(field)
+            if value is None:
+                acl[field] = None
+                continue
+            try:
+                acl[field] = json.loads(_text(value))
+            except ValueError as e:
+                debug3("Ignoring bad ACL entry %s: %s\n", field, e)
+        return acl
+
+    def apply_acl_delta(self, fields):
+        global _allowed_sources
+        global _excluded_sources
+
+        try:
+            values = self.redisClient.hmget(ACL_KEYS[self.acl_type], fields)
+        except redis.ResponseError as e:
+            # not a hash (yet); read the whole thing instead
+            debug3("Can't read ACL fields %r: %s\n", fields, e)
+            self.reload_acl_file()
+            return
+        changes = self.parseFields(zip(fields, values))
+        debug3("ACL update: %r\n", changes)
+
         if (self.acl_type is ALLOWED_ACL_TYPE):
-            self.acl = self.redisClient.get(sshuttleAcl)
+            update_targets(changes)
         elif (self.acl_type is ACL_SOURCES_TYPE):
-            self.acl = self.redisClient.get(sshuttleAclSources)
+            _allowed_sources = update_sources(_allowed_sources, changes)
         elif (self.acl_type is ACL_EXCLUDED_SOURCES_TYPE):
-            self.acl = self.redisClient.get(sshuttleAclExcluded)
-        else:
-            debug1("pullAcl() -> Unsupported ACL type %d\n" % self.acl_type)
-            self.acl = None
+            _excluded_sources = update_sources(_excluded_sources, changes)
 
     def reload_acl_sources_file(self):
         global _allowed_sources
 
         if self.acl is not None:
             try:
-                _new_allowed_sources = json.loads(self.acl, "utf-8")
+                _new_allowed_sources = self.parseAcl()
                 _allowed_sources = _new_allowed_sources
             except BaseException as e:
                 debug3("An exception has occurred while loading the sources data: {}\n\n".format(e))
         else:
             _allowed_sources = None
 
-        debug3("Network Connection Sources ACL \n\n%s" % _allowed_sources)
+        debug3("Network Connection Sources ACL \n\n%s", _allowed_sources)
 
     def reload_acl_excluded_sources_file(self):
 
@@ -642,27 +1053,31 @@ class AclHandler:
 
         if self.acl is not None:
             try:
-                _new_excluded_sources = json.loads(self.acl, "utf-8")
+                _new_excluded_sources = self.parseAcl()
                 _excluded_sources = _new_excluded_sources
             except BaseException as e:
                 debug3("An exception has occurred while loading the excluded sources data: {}\n\n".format(e))
         else:
             _excluded_sources = None
 
-        debug3("Network Connection Excluded Sources ACL \n\n%s" % _excluded_sources)
+        debug3("Network Connection Excluded Sources ACL \n\n%s",
+               _excluded_sources)
 
     def reload_acl_targets_file(self):
 
         global _allowed_targets
+        global _allowed_index
 
         if self.acl is not None:
             try:
-                _new_targets = json.loads(self.acl, "utf-8")
+                _new_targets = self.parseAcl()
+                _allowed_index = AclIndex(_new_targets)
                 _allowed_targets = _new_targets
             except BaseException as e:
                 debug3("An exception has occurred while loading the allowed targets (sshuttleAcl) data: {}\n\n".format(e))
         else:
             _allowed_targets = None
+            _allowed_index = AclIndex()
 
         if (not _allowed_targets):
             log("Allowed ACL list is empty. Restricting all access\n")
@@ -705,17 +1120,22 @@ class ChannelListener(threading.Thread):
 
     def handlePubSubEvent(self, item):
         acl_type = None
-        if (item['channel'] == sshuttleAclEventsChannel and item['type'] == "message"):
-            if (item['data'] == sshuttleAcl):
+        fields = None
+        if (_text(item['channel']) == sshuttleAclEventsChannel and item['type'] == "message"):
+            (key, sep, fields) = _text(item['data']).partition(":")
+            if (key == sshuttleAcl):
                 acl_type = ALLOWED_ACL_TYPE
-            elif (item['data'] == sshuttleAclSources):
+            elif (key == sshuttleAclSources):
                 acl_type = ACL_SOURCES_TYPE
-            elif (item['data'] == sshuttleAclExcluded):
+            elif (key == sshuttleAclExcluded):
                 acl_type = ACL_EXCLUDED_SOURCES_TYPE
             else:
-                debug3("Unsupported ACL type. Channel: %s, Data: %s\n" % (item['channel'], item['data']))
+                debug3("Unsupported ACL type. Channel: %s, Data: %s\n",
+                       item['channel'], item['data'])
 
-        if acl_type is not None:
+        if acl_type is not None and fields:
+            AclHandler(self.redisClient, acl_type).apply_acl_delta(fields.split(","))
+        elif acl_type is not None:
             AclHandler(self.redisClient, acl_type).reload_acl_file()
 
     def reloadAllAcls(self):
@@ -734,36 +1154,28 @@ class ChannelListener(threading.Thread):
     def run(self):
         self.initializeChannelHandlers()
 
-def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
-          python, ttl_hack, latency_control,
-          dns_listener, seed_hosts, auto_nets, daemon):
-
-    debug1('Starting client with Python version %s\n'
-           % platform.python_version())
-
-    method = fw.method
-
-    handlers = []
-    if helpers.verbose >= 1:
-        helpers.logprefix = 'c : '
-    else:
-        helpers.logprefix = 'client: '
-    debug1('connecting to server...\n')
+def start_channel_listener():
+    channelSubscriptions = [sshuttleAclEventsChannel]
+    channelListener = ChannelListener(REDIS_HOST, REDIS_PORT, channelSubscriptions)
+    channelListener.setDaemon(True)
+    channelListener.initialize()
+    channelListener.start()
+    return channelListener
 
+def connect_server(ssh_cmd, remotename, python, options):
     try:
         (serverproc, serversock) = ssh.connect(
             ssh_cmd, remotename, python,
             stderr=ssyslog._p and ssyslog._p.stdin,
-            options=dict(ttl_hack=ttl_hack, latency_control=latency_control))
+            options=options)
     except socket.error as e:
         if e.args[0] == errno.EPIPE:
             raise Fatal("failed to establish ssh session (1)")
         else:
             raise
     mux = Mux(serversock, serversock)
-    handlers.append(mux)
 
-    expected = b'SSHUTTLE0001'
+    expected = b'SSHUTTLE'
 
     try:
         v = 'x'
@@ -772,7 +1184,7 @@ def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
         v = 'x'
         while v and v != b'\0':
             v = serversock.recv(1)
-        initstring = serversock.recv(len(expected))
+        initstring = serversock.recv(len(expected) + 4)
     except socket.error as e:
         if e.args[0] == errno.ECONNRESET:
             raise Fatal("failed to establish ssh session (2)")
@@ -783,15 +1195,68 @@ def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
     if rv:
         raise Fatal('server died with error code %d' % rv)
 
-    if initstring != expected:
-        raise Fatal('expected server init string %r; got %r'
+    version = initstring[len(expected):]
+    if not initstring.startswith(expected) or not version.isdigit():
+        raise Fatal('expected server init string %r<version>; got %r'
                     % (expected, initstring))
+    mux.protocol = int(version)
+    if not ssnet.PROTOCOL_MIN <= mux.protocol <= ssnet.PROTOCOL_VERSION:
+        raise Fatal('server wants unsupported protocol version %d'
+                    % mux.protocol)
+    debug1('using protocol version %d\n', mux.protocol)
+    return (serverproc, mux)
+
+
+def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
+          python, ttl_hack, latency_control,
+          dns_listener, seed_hosts, auto_nets, daemon, compress,
+          transports, workers, metrics_listen):
+    global _acl_watcher
+
+    debug1('Starting client with Python version %s\n',
+           platform.python_version())
+
+    method = fw.method
+
+    handlers = []
+    if helpers.verbose >= 1:
+        helpers.logprefix = 'c : '
+    else:
+        helpers.logprefix = 'client: '
+    debug1('connecting to server...\n')
+
+    options = dict(ttl_hack=ttl_hack, latency_control=latency_control,
+                   protocol=ssnet.PROTOCOL_VERSION, compress=compress)
+    servers = [connect_server(ssh_cmd, remotename, python, options)
+               for i in range(transports)]
+    (serverproc, mux) = servers[0]
+    muxes = [m for (p, m) in servers]
+    handlers.extend(muxes)
+    metrics_server = None
+    if metrics_listen:
+        metrics_server = start_metrics(metrics_listen, muxes, handlers)
     log('Connected.\n')
     sys.stdout.flush()
     if daemon:
         daemonize()
         log('daemonizing (%s).\n' % _pidname)
 
+    # Fork the extra workers only now, so that they end up in the daemon's
+    # session.  They share the TCP redirector socket with us, but each one
+    # opens its own ssh sessions and follows the ACLs on its own.
+    workerpids = start_workers(
+        workers, tcp_listener, servers, metrics_server,
+        lambda i, sock: _worker(i, sock, tcp_listener, method, ssh_cmd,
+                                remotename, python, options,
+                                latency_control, transports, metrics_listen))
+    helpers.start_log_writer()
+    dispatcher = ssnet.Dispatcher()
+    _acl_watcher = AclWatcher()
+    handlers.append(_acl_watcher)
+    # not before the forks: the workers would inherit its thread's locks
+    # and redis connection in whatever state they happened to be in
+    start_channel_listener()
+
     def onroutes(routestr):
         if auto_nets:
             for line in routestr.strip().split(b'\n'):
@@ -800,11 +1265,11 @@ def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
                 width = int(width)
                 ip = ip.decode("ASCII")
                 if family == socket.AF_INET6 and tcp_listener.v6 is None:
-                    debug2("Ignored auto net %d/%s/%d\n" % (family, ip, width))
+                    debug2("Ignored auto net %d/%s/%d\n", family, ip, width)
                 if family == socket.AF_INET and tcp_listener.v4 is None:
-                    debug2("Ignored auto net %d/%s/%d\n" % (family, ip, width))
+                    debug2("Ignored auto net %d/%s/%d\n", family, ip, width)
                 else:
-                    debug2("Adding auto net %d/%s/%d\n" % (family, ip, width))
+                    debug2("Adding auto net %d/%s/%d\n", family, ip, width)
                     fw.auto_nets.append((family, ip, width))
 
         # we definitely want to do this *after* starting ssh, or we might end
@@ -817,43 +1282,195 @@ def _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
         mux.got_routes = None
         fw.start()
     mux.got_routes = onroutes
+    for m in muxes[1:]:
+        # every server sends its routes, but the first one is enough
+        m.got_routes = lambda routestr: None
 
     def onhostlist(hostlist):
-        debug2('got host list: %r\n' % hostlist)
+        debug2('got host list: %r\n', hostlist)
         for line in hostlist.strip().split():
             if line:
                 name, ip = line.split(b',', 1)
                 fw.sethostip(name, ip)
     mux.got_host_list = onhostlist
 
-    tcp_listener.add_handler(handlers, onaccept_tcp, method, mux)
+    tcp_listener.add_handler(handlers, onaccept_tcp, method, muxes)
+
+    if udp_listener or dns_listener:
+        senders = UdpSenders(method)
+        handlers.append(senders)
 
     if udp_listener:
-        udp_listener.add_handler(handlers, onaccept_udp, method, mux)
+        senders.add_listener(
+            udp_listener.add_handler(handlers, onaccept_udp, method, mux))
 
     if dns_listener:
-        dns_listener.add_handler(handlers, ondns, method, mux)
+        senders.add_listener(
+            dns_listener.add_handler(handlers, ondns, method, mux))
 
     if seed_hosts is not None:
-        debug1('seed_hosts: %r\n' % seed_hosts)
+        debug1('seed_hosts: %r\n', seed_hosts)
         mux.send(0, ssnet.CMD_HOST_REQ, str.encode('\n'.join(seed_hosts)))
 
+    try:
+        while 1:
+            for (p, m) in servers:
+                rv = p.poll()
+                if rv:
+                    raise Fatal('server died with error code %d' % rv)
+            for (wpid, wsock) in workerpids:
+                if os.waitpid(wpid, os.WNOHANG)[0]:
+                    raise Fatal('worker %d died' % wpid)
+
+            now = time.time()
+            expire_connections(now, mux, method)
+            ssnet.runonce(handlers, mux, dispatcher, next_expiry(now))
+            if latency_control:
+                for m in muxes:
+                    m.check_fullness()
+    finally:
+        for m in muxes:
+            if m.compression:
+                debug1('%s compression ratio: %.3f\n',
+                       m.compression, m.compression_ratio())
+        if _dns_cache is not None:
+            debug1('DNS cache: %d hits, %d misses\n',
+                   _dns_cache.hits, _dns_cache.misses)
+        if metrics_server:
+            metrics_server.close()
+        stop_workers(workerpids)
+
+
+def start_workers(workers, tcp_listener, servers, metrics_server, run):
+    # forks the workers, which each call run(worker, parentsock); returns
+    # [(pid, sock)], sock being the socket they watch to notice we're gone
+    workerpids = []
+    if workers > 1:
+        tcp_listener.setblocking(False)
+    for i in range(1, workers):
+        (s1, s2) = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            s1.close()
+            for (wpid, wsock) in workerpids:
+                wsock.close()
+            for (p, m) in servers:
+                m.rsock.close()
+            if metrics_server:
+                metrics_server.sock.close()
+            rv = 99
+            try:
+                try:
+                    rv = run(i, s2)
+                except Fatal as e:
+                    log('fatal: %s\n' % e)
+                except KeyboardInterrupt:
+                    rv = 1
+            finally:
+                # never fall back into the main process's cleanup code;
+                # os._exit() skips the atexit one that writes out the log
+                helpers.flush_log()
+                os._exit(rv)
+        s2.close()
+        workerpids.append((pid, s1))
+    return workerpids
+
+
+def _worker(worker, parentsock, tcp_listener, method, ssh_cmd, remotename,
+            python, options, latency_control, transports, metrics_listen):
+    global _acl_watcher
+    helpers.logprefix = 'c%d: ' % worker
+    helpers.start_log_writer()
+    _acl_watcher = AclWatcher()
+    start_channel_listener()
+    servers = [connect_server(ssh_cmd, remotename, python, options)
+               for i in range(transports)]
+    muxes = [m for (p, m) in servers]
+    for m in muxes:
+        m.got_routes = lambda routestr: None
+    debug1('worker %d connected.\n', worker)
+
+    def onparent(sock):
+        if not sock.recv(1):
+            raise Fatal('main process went away')
+
+    handlers = list(muxes)
+    handlers.append(Handler([parentsock], onparent))
+    handlers.append(_acl_watcher)
+    if metrics_listen:
+        start_metrics(metrics.worker_address(metrics_listen, worker),
+                      muxes, handlers)
+    tcp_listener.add_handler(handlers, onaccept_tcp, method, muxes)
+    dispatcher = ssnet.Dispatcher()
     while 1:
-        rv = serverproc.poll()
-        if rv:
-            raise Fatal('server died with error code %d' % rv)
-
-        expire_connections(time.time(), mux)
-        ssnet.runonce(handlers, mux)
+        for (p, m) in servers:
+            rv = p.poll()
+            if rv:
+                raise Fatal('server died with error code %d' % rv)
+
+        now = time.time()
+        expire_connections(now, muxes[0], method)
+        ssnet.runonce(handlers, muxes[0], dispatcher, next_expiry(now))
         if latency_control:
-            mux.check_fullness()
+            for m in muxes:
+                m.check_fullness()
+
+
+def start_metrics(address, muxes, handlers):
+    for m in muxes:
+        m.got_rtt = metrics.ping_rtt.observe
+    server = metrics.MetricsServer(address, muxes, metrics_gauges)
+    handlers.append(server)
+    return server
+
+
+def metrics_gauges():
+    # what only the client knows about, for the metrics endpoint
+    gauges = [
+        ('sshuttle_tcp_connections', 'gauge', 'open TCP connections',
+         len(tcp_conns)),
+        ('sshuttle_udp_sources', 'gauge',
+         'local sources with an open UDP channel', len(udp_by_src)),
+        ('sshuttle_dns_pending', 'gauge',
+         'DNS requests waiting for an answer', len(dnsreqs)),
+    ]
+    if _dns_cache is not None:
+        gauges += [
+            ('sshuttle_dns_cache_hits_total', 'counter',
+             'DNS requests answered from the cache', _dns_cache.hits),
+            ('sshuttle_dns_cache_misses_total', 'counter',
+             'DNS requests the cache had no answer for', _dns_cache.misses),
+            ('sshuttle_dns_cache_entries', 'gauge',
+             'answers in the DNS cache', len(_dns_cache)),
+        ]
+    return gauges
+
+
+def stop_workers(workerpids):
+    for (pid, sock) in workerpids:
+        # closing our end of the socketpair is enough for a worker that is
+        # running its loop; one that is still connecting needs the signal.
+        sock.close()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+    for (pid, sock) in workerpids:
+        try:
+            os.waitpid(pid, 0)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
 
 
 def main(listenip_v6, listenip_v4,
          ssh_cmd, remotename, python, ttl_hack, latency_control, dns, nslist,
          method_name, seed_hosts, auto_nets,
          subnets_include, subnets_exclude,
-         daemon, pidfile):
+         daemon, pidfile, compress=None, transports=1, workers=1,
+         dns_cache=0, metrics_listen=None):
+    global _dns_cache
 
     if daemon:
         try:
@@ -868,6 +1485,8 @@ def main(listenip_v6, listenip_v4,
     # Get family specific subnet lists
     if dns:
         nslist += resolvconf_nameservers()
+    if dns_cache:
+        _dns_cache = DnsCache(dns_cache)
 
     subnets = subnets_include + subnets_exclude  # we don't care here
     subnets_v6 = [i for i in subnets if i[0] == socket.AF_INET6]
@@ -889,6 +1508,7 @@ def main(listenip_v6, listenip_v4,
         or listenip_v6 is not None
     required.udp = avail.udp
     required.dns = len(nslist) > 0
+    required.workers = workers > 1
 
     fw.method.assert_features(required)
 
@@ -896,9 +1516,9 @@ def main(listenip_v6, listenip_v4,
         raise Fatal("IPv6 required but not listening.")
 
     # display features enabled
-    debug1("IPv6 enabled: %r\n" % required.ipv6)
-    debug1("UDP enabled: %r\n" % required.udp)
-    debug1("DNS enabled: %r\n" % required.dns)
+    debug1("IPv6 enabled: %r\n", required.ipv6)
+    debug1("UDP enabled: %r\n", required.udp)
+    debug1("DNS enabled: %r\n", required.dns)
 
     # bind to required ports
     if listenip_v4 == "auto":
@@ -918,7 +1538,7 @@ def main(listenip_v6, listenip_v4,
     bound = False
     debug2('Binding redirector:')
     for port in ports:
-        debug2(' %d' % port)
+        debug2(' %d', port)
         tcp_listener = MultiListener()
 
         if required.udp:
@@ -973,7 +1593,7 @@ def main(listenip_v6, listenip_v4,
         debug2('Binding DNS:')
         ports = range(12300, 9000, -1)
         for port in ports:
-            debug2(' %d' % port)
+            debug2(' %d', port)
             dns_listener = MultiListener(socket.SOCK_DGRAM)
 
             if listenip_v6:
@@ -1046,17 +1666,12 @@ def main(listenip_v6, listenip_v4,
     if (REDIS_HOST is None or REDIS_PORT is None):
         raise Fatal("REDIS_HOST and REDIS_PORT environment variables must both be set!")
 
-    channelSubscriptions = [sshuttleAclEventsChannel]
-    channelListener = ChannelListener(REDIS_HOST, REDIS_PORT, channelSubscriptions)
-    channelListener.setDaemon(True)
-    channelListener.initialize()
-    channelListener.start()
-
     # start the client process
     try:
         return _main(tcp_listener, udp_listener, fw, ssh_cmd, remotename,
                      python, ttl_hack, latency_control, dns_listener,
-                     seed_hosts, auto_nets, daemon)
+                     seed_hosts, auto_nets, daemon, compress,
+                     transports, workers, metrics_listen)
     finally:
         try:
             if daemon:
@@ -7,6 +7,8 @@ import sshuttle.client as client
 import sshuttle.firewall as firewall
 import sshuttle.hostwatch as hostwatch
 import sshuttle.ssyslog as ssyslog
+import sshuttle.ssnet as ssnet
+import sshuttle.metrics as metrics
 from sshuttle.helpers import family_ip_tuple, log, Fatal
 
 
@@ -120,6 +122,7 @@ H,auto-hosts scan for remote hostnames and update local /etc/hosts
 N,auto-nets  automatically determine subnets to route
 dns        capture local DNS requests and forward to the remote DNS server
 ns-hosts=  capture and forward remote DNS requests to the following servers
+dns-cache= number of DNS answers to cache, 0 to disable [10000]
 method=    auto, nat, tproxy or pf
 python=    path to python interpreter on the remote server
 r,remote=  ssh hostname (and optional username) of remote sshuttle server
@@ -131,6 +134,10 @@ e,ssh-cmd= the command to use to connect to the remote [ssh]
 seed-hosts= with -H, use these hostnames for initial scan (comma-separated)
 ttl-hack  add ttl hack that prevents infinite loops when client is also the server
 no-latency-control  sacrifice latency to improve bandwidth benchmarks
+compress=  compress TCP data sent through the tunnel: zlib or lz4
+transports= number of ssh sessions to spread TCP connections over [1]
+workers=   number of client processes accepting TCP connections [1]
+metrics=   serve runtime metrics on this [ip:]port or unix socket path
 wrap=      restart counting channel numbers after this number (for testing)
 disable-ipv6 disables ipv6 support
 D,daemon   run in the background as a daemon
@@ -158,7 +165,6 @@ def main():
     if opt.daemon:
         opt.syslog = 1
     if opt.wrap:
-        import sshuttle.ssnet as ssnet
         ssnet.MAX_CHANNEL = int(opt.wrap)
     helpers.verbose = opt.verbose or 0
 
@@ -199,6 +205,15 @@ def main():
                 method_name = opt.method
             else:
                 o.fatal("method_name %s not supported" % opt.method)
+            if opt.compress and opt.compress not in ssnet.COMPRESSORS:
+                o.fatal("compression %s not available" % opt.compress)
+            if opt.transports < 1:
+                o.fatal("--transports must be at least 1")
+            if opt.workers < 1:
+                o.fatal("--workers must be at least 1")
+            metrics_listen = None
+            if opt.metrics:
+                metrics_listen = metrics.parse_address(opt.metrics)
             if opt.listen:
                 ipport_v6 = None
                 ipport_v4 = None
@@ -216,6 +231,7 @@ def main():
             if opt.syslog:
                 ssyslog.start_syslog()
                 ssyslog.stderr_to_syslog()
+                helpers.log_sink = ssyslog.devlog_sink()
 
             return_code = client.main(ipport_v6, ipport_v4,
                                       opt.ssh_cmd,
@@ -230,7 +246,12 @@ def main():
                                       opt.auto_nets,
                                       parse_subnets(includes),
                                       parse_subnets(excludes),
-                                      opt.daemon, opt.pidfile)
+                                      opt.daemon, opt.pidfile,
+                                      opt.compress,
+                                      opt.transports,
+                                      opt.workers,
+                                      opt.dns_cache,
+                                      metrics_listen)
 
             if return_code == 0:
                 log('Normal exit code, exiting...')
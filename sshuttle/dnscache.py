@@ -0,0 +1,114 @@
+import struct
+from collections import OrderedDict
+
+from dnslib import DNSRecord, QTYPE, RCODE
+
+# never keep anything for longer than this, whatever the TTL says
+DNS_CACHE_MAX_TTL = 86400
+# the DO bit, in the TTL field of the OPT pseudo-record (RFC 3225)
+EDNS_DO = 0x8000
+
+
+def cache_key(record):
+    # DNSSEC OK askers get answers with signatures, the others without;
+    # RFC 3225 has servers copy the bit from the query into the answer
+    q = record.q
+    return (str(q.qname).lower(), q.qtype, q.qclass, _dnssec_ok(record))
+
+
+def _dnssec_ok(record):
+    for rr in record.ar:
+        if rr.rtype == QTYPE.OPT:
+            return bool(rr.ttl & EDNS_DO)
+    return False
+
+
+def _with_question(data, request):
+    # the asker's ID, and its qname spelt the way it was asked: resolvers
+    # randomizing the case of the letters (0x20) drop answers that don't
+    # match.  Only the case can differ, so the name keeps its length.
+    qname = b''.join(struct.pack('!B', len(label)) + label
+                     for label in request.q.qname.label) + b'\0'
+    return (struct.pack('!H', request.header.id) + data[2:12] + qname +
+            data[12 + len(qname):])
+
+
+def _records(record):
+    # every resource record except EDNS's OPT pseudo-record
+    return [rr for rr in record.rr + record.auth + record.ar
+            if rr.rtype != QTYPE.OPT]
+
+
+def payload_size(request):
+    # the largest answer the asker can take over UDP (RFC 6891)
+    for rr in request.ar:
+        if rr.rtype == QTYPE.OPT:
+            return max(rr.rclass, 512)
+    return 512
+
+
+class DnsCache(object):
+    """Cache of DNS answers, keyed on (qname, qtype, qclass, DO bit).
+
+    Positive answers are kept for as long as their shortest TTL, negative
+    ones (NXDOMAIN, or no data) for the SOA's negative caching TTL as in
+    RFC 2308; anything else isn't cached.  Answers are handed out with
+    the TTLs counted down and the asker's transaction ID and qname, to
+    askers that can take them over UDP.  The least recently used entries
+    are dropped once there are more than size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, request, now):
+        if len(request.questions) != 1:
+            return None
+        key = cache_key(request)
+        entry = self.entries.pop(key, None)
+        if entry is not None and len(entry[2]) > payload_size(request):
+            # let the asker get its own, truncated, answer
+            self.entries[key] = entry
+            entry = None
+        if entry is None or entry[0] <= now:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        (expires, stored, data) = entry
+        age = int(now - stored)
+        if age > 0:
+            response = DNSRecord.parse(data)
+            for rr in _records(response):
+                rr.ttl = max(rr.ttl - age, 0)
+            data = response.pack()
+        return _with_question(data, request)
+
+    def put(self, response, data, now):
+        # response is data, already parsed
+        if len(response.questions) != 1 or response.header.tc:
+            return
+        ttl = self.ttl(response)
+        if ttl <= 0:
+            return
+        key = cache_key(response)
+        self.entries.pop(key, None)
+        self.entries[key] = (now + min(ttl, DNS_CACHE_MAX_TTL), now, data)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def ttl(self, response):
+        rcode = response.header.rcode
+        if rcode == RCODE.NOERROR and response.rr:
+            return min(rr.ttl for rr in _records(response))
+        if rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            for rr in response.auth:
+                if rr.rtype == QTYPE.SOA:
+                    return min(rr.ttl, rr.rdata.times[4])
+        return 0
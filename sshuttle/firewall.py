@@ -2,6 +2,7 @@ import errno
 import socket
 import signal
 import sshuttle.ssyslog as ssyslog
+import sshuttle.helpers as helpers
 import sys
 import os
 import platform
@@ -97,6 +98,7 @@ def main(ttl_hack, method_name, syslog):
     if syslog:
         ssyslog.start_syslog()
         ssyslog.stderr_to_syslog()
+        helpers.log_sink = ssyslog.devlog_sink()
 
     debug1('firewall manager: ready method name %s.\n' % method.name)
     stdout.write('READY %s\n' % method.name)
@@ -1,56 +1,164 @@
 import sys
+import os
 import socket
 import errno
+from collections import deque
 
 logprefix = ''
 verbose = 0
 
+# where log() writes its messages to, if not stderr
+log_sink = None
+# how many messages start_log_writer()'s queue had no room for
+log_dropped = 0
+LOG_QUEUE_MAX = 1000
+# (pid, queue, condition) once start_log_writer() has been called
+_log_queue = None
 
-def log(s):
-    global logprefix
+
+def _log_lines(s):
+    if s.find("\n") == -1:
+        return [logprefix + s]
+    lines = []
+    prefix = logprefix
+    for line in s.rstrip("\n").split("\n"):
+        lines.append(prefix + line + "\n")
+        prefix = "---> "
+    return lines
+
+
+def _write_log(lines):
     try:
-        sys.stdout.flush()
-        if s.find("\n") != -1:
-            prefix = logprefix
-            s = s.rstrip("\n")
-            for line in s.split("\n"):
-                sys.stderr.write(prefix + line + "\n")
-                prefix = "---> "
+        if log_sink:
+            log_sink(''.join(lines))
         else:
-            sys.stderr.write(logprefix + s)
-        sys.stderr.flush()
-    except IOError:
+            for line in lines:
+                sys.stderr.write(line)
+            sys.stderr.flush()
+    except (IOError, OSError):
         # this could happen if stderr gets forcibly disconnected, eg. because
         # our tty closes.  That sucks, but it's no reason to abort the program.
         pass
 
 
-def debug1(s):
+def log(s):
+    global log_dropped
+    lines = _log_lines(s)
+    q = _log_queue
+    if q and q[0] == os.getpid():
+        (pid, queue, cond) = q
+        with cond:
+            if len(queue) >= LOG_QUEUE_MAX:
+                log_dropped += 1
+            else:
+                queue.extend(lines)
+                cond.notify()
+        return
+    try:
+        sys.stdout.flush()
+    except IOError:
+        pass
+    _write_log(lines)
+
+
+def start_log_writer():
+    """Hand log messages to a thread that writes them out.
+
+    log() then only queues them, so a slow stderr (a pipe into logger(1)
+    with --syslog, say) or log_sink can't hold up the event loop.  When
+    LOG_QUEUE_MAX messages are waiting, further ones are dropped and
+    counted in log_dropped.  Only this process is affected: a child
+    forked afterwards logs directly, unless it calls this again.
+    """
+    global _log_queue
+    import threading
+    import atexit
+    queue = deque()
+    cond = threading.Condition()
+    _log_queue = (os.getpid(), queue, cond)
+    writer = threading.Thread(target=_log_writer, args=(queue, cond))
+    writer.daemon = True
+    writer.start()
+    atexit.register(_flush_log, queue, cond)
+
+
+def _log_writer(queue, cond):
+    reported = 0
+    while True:
+        with cond:
+            while not queue:
+                cond.wait()
+            lines = list(queue)
+            queue.clear()
+            dropped = log_dropped
+        if dropped != reported:
+            lines.append('%sdropped %d log messages\n'
+                         % (logprefix, dropped - reported))
+            reported = dropped
+        _write_log(lines)
+
+
+def flush_log():
+    """Write out whatever log() has queued in this process.
+
+    For a process that leaves through os._exit(), which doesn't run the
+    atexit handler start_log_writer() registered.
+    """
+    q = _log_queue
+    if q and q[0] == os.getpid():
+        _flush_log(q[1], q[2])
+
+
+def _flush_log(queue, cond):
+    # whatever the writer didn't get to before we exit
+    with cond:
+        lines = list(queue)
+        queue.clear()
+    if lines:
+        _write_log(lines)
+
+
+# The debug functions take the format arguments separately, so that
+# nothing gets formatted unless the message is going to be logged.
+def debug1(s, *args):
     if verbose >= 1:
-        log(s)
+        log(s % args if args else s)
 
 
-def debug2(s):
+def debug2(s, *args):
     if verbose >= 2:
-        log(s)
+        log(s % args if args else s)
 
 
-def debug3(s):
+def debug3(s, *args):
     if verbose >= 3:
-        log(s)
+        log(s % args if args else s)
 
 
 class Fatal(Exception):
     pass
 
 
+# (stat signature, nameservers) of the last /etc/resolv.conf we parsed
+_resolvconf = (None, [])
+
+
 def resolvconf_nameservers():
-    l = []
-    for line in open('/etc/resolv.conf'):
-        words = line.lower().split()
-        if len(words) >= 2 and words[0] == 'nameserver':
-            l.append(family_ip_tuple(words[1]))
-    return l
+    # only re-read the file when it has been changed or replaced
+    global _resolvconf
+    try:
+        st = os.stat('/etc/resolv.conf')
+        sig = (st.st_mtime, st.st_size, st.st_ino)
+    except OSError:
+        sig = None
+    if sig is None or sig != _resolvconf[0]:
+        l = []
+        for line in open('/etc/resolv.conf'):
+            words = line.lower().split()
+            if len(words) >= 2 and words[0] == 'nameserver':
+                l.append(family_ip_tuple(words[1]))
+        _resolvconf = (sig, l)
+    return list(_resolvconf[1])
 
 
 def resolvconf_random_nameserver():
@@ -40,6 +40,7 @@ class BaseMethod(object):
         result.ipv6 = False
         result.udp = False
         result.dns = True
+        result.workers = True
         return result
 
     def get_tcp_dstip(self, sock):
@@ -50,12 +51,31 @@ class BaseMethod(object):
         data, srcip = udp_listener.recvfrom(bufsize)
         return (srcip, None, data)
 
+    def recv_udp_batch(self, udp_listener, bufsize, count):
+        # up to count datagrams that are ready on udp_listener; methods
+        # that can tell when it's drained take more than one.
+        t = self.recv_udp(udp_listener, bufsize)
+        return [t] if t else []
+
     def send_udp(self, sock, srcip, dstip, data):
         if srcip is not None:
             Fatal("Method %s send_udp does not support setting srcip to %r"
                   % (self.name, srcip))
         sock.sendto(data, dstip)
 
+    def udp_senders(self):
+        # (sock, listener) for the sockets send_udp() keeps open, which
+        # get datagrams meant for that listener too
+        return []
+
+    def udp_senders_changed(self):
+        # replaced by whoever watches udp_senders()
+        pass
+
+    def forget_udp(self, peer):
+        # the UDP peer has gone away; any state kept for it can go
+        pass
+
     def setup_tcp_listener(self, tcp_listener):
         pass
 
@@ -64,7 +84,7 @@ class BaseMethod(object):
 
     def assert_features(self, features):
         avail = self.get_supported_features()
-        for key in ["udp", "dns", "ipv6"]:
+        for key in ["udp", "dns", "ipv6", "workers"]:
             if getattr(features, key) and not getattr(avail, key):
                 raise Fatal(
                     "Feature %s not supported with method %s.\n" %
@@ -347,6 +347,14 @@ def pf_get_dev():
 
 class Method(BaseMethod):
 
+    def get_supported_features(self):
+        result = super(Method, self).get_supported_features()
+        # every process would share the firewall's pipe for the
+        # QUERY_PF_NAT lookups in get_tcp_dstip(), and read each other's
+        # answers
+        result.workers = False
+        return result
+
     def get_tcp_dstip(self, sock):
         pfile = self.firewall.pfile
 
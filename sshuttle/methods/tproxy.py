@@ -1,4 +1,6 @@
 import struct
+import errno
+from collections import OrderedDict
 from sshuttle.helpers import family_to_string
 from sshuttle.linux import ipt, ipt_ttl, ipt_chain_exists
 from sshuttle.methods import BaseMethod
@@ -29,11 +31,14 @@ SOL_IPV6 = 41
 IPV6_ORIGDSTADDR = 74
 IPV6_RECVORIGDSTADDR = IPV6_ORIGDSTADDR
 
+# transparent sockets kept open to send UDP replies from
+UDP_SENDERS = 256
+
 if recvmsg == "python":
-    def recv_udp(listener, bufsize):
+    def recv_udp(listener, bufsize, flags=0):
         debug3('Accept UDP python using recvmsg.\n')
         data, ancdata, msg_flags, srcip = listener.recvmsg(
-            4096, socket.CMSG_SPACE(24))
+            bufsize, socket.CMSG_SPACE(24), flags)
         dstip = None
         family = None
         for cmsg_level, cmsg_type, cmsg_data in ancdata:
@@ -102,6 +107,15 @@ else:
 
 class Method(BaseMethod):
 
+    def __init__(self, name):
+        super(Method, self).__init__(name)
+        # (family, srcip) -> sender, least recently used first
+        self.senders = OrderedDict()
+        # sender -> (key, listener it replies for, peers it replied to)
+        self.sender_info = {}
+        # peer -> senders that replied to it
+        self.peer_senders = {}
+
     def get_supported_features(self):
         result = super(Method, self).get_supported_features()
         result.ipv6 = True
@@ -117,7 +131,24 @@ class Method(BaseMethod):
         return sock.getsockname()
 
     def recv_udp(self, udp_listener, bufsize):
-        srcip, dstip, data = recv_udp(udp_listener, bufsize)
+        return self._check_dstip(recv_udp(udp_listener, bufsize))
+
+    def recv_udp_batch(self, udp_listener, bufsize, count):
+        # the listener is readable, so the first one is there; take
+        # whatever else is already queued behind it without waiting.
+        batch = [self.recv_udp(udp_listener, bufsize)]
+        while recvmsg == "python" and len(batch) < count:
+            try:
+                t = recv_udp(udp_listener, bufsize, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            batch.append(self._check_dstip(t))
+        return [t for t in batch if t]
+
+    def _check_dstip(self, t):
+        srcip, dstip, data = t
         if not dstip:
             debug1(
                 "-- ignored UDP from %r: "
@@ -131,13 +162,59 @@ class Method(BaseMethod):
                 "-- ignored UDP to %r: "
                 "couldn't determine source IP address\n" % (dstip,))
             return
+        key = (sock.family, srcip)
+        sender = self.senders.pop(key, None)
+        if sender is None:
+            sender = self._open_sender(sock, key)
+        self.senders[key] = sender
+        self.sender_info[sender][2].add(dstip)
+        self.peer_senders.setdefault(dstip, set()).add(sender)
+        sender.sendto(data, dstip)
+
+    def _open_sender(self, sock, key):
+        while len(self.senders) >= UDP_SENDERS:
+            self._close_sender(self.senders.popitem(last=False)[1])
+        # a sender gets the datagrams sent to the address it is bound to
+        # as well, so it needs to tell us where they were going, just
+        # like the listener.
         sender = socket.socket(sock.family, socket.SOCK_DGRAM)
         sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sender.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
-        sender.bind(srcip)
-        sender.sendto(data, dstip)
+        if sock.family == socket.AF_INET6:
+            sender.setsockopt(SOL_IPV6, IPV6_RECVORIGDSTADDR, 1)
+        else:
+            sender.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
+        sender.bind(key[1])
+        if sock in self.sender_info:
+            sock = self.sender_info[sock][1]
+        self.sender_info[sender] = (key, sock, set())
+        self.udp_senders_changed()
+        return sender
+
+    def _close_sender(self, sender):
+        (key, listener, peers) = self.sender_info.pop(sender)
+        if self.senders.get(key) is sender:
+            del self.senders[key]
+        for peer in peers:
+            self.peer_senders[peer].discard(sender)
+            if not self.peer_senders[peer]:
+                del self.peer_senders[peer]
+        self.udp_senders_changed()
         sender.close()
 
+    def udp_senders(self):
+        return [(sender, info[1])
+                for (sender, info) in self.sender_info.items()]
+
+    def forget_udp(self, peer):
+        for sender in list(self.peer_senders.get(peer, ())):
+            peers = self.sender_info[sender][2]
+            peers.discard(peer)
+            self.peer_senders[peer].discard(sender)
+            if not peers:
+                self._close_sender(sender)
+        self.peer_senders.pop(peer, None)
+
     def setup_tcp_listener(self, tcp_listener):
         tcp_listener.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
 
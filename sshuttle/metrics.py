@@ -0,0 +1,279 @@
+import bisect
+import errno
+import os
+import socket
+import stat
+import time
+
+import sshuttle.helpers as helpers
+from sshuttle.ssnet import Handler, _add
+from sshuttle.helpers import debug1, debug2, Fatal
+
+# Counters are kept whether or not anyone asks for them; they're cheap.
+counters = {
+    'tcp_accepted': 0,
+    'tcp_denied': 0,
+    'udp_datagrams': 0,
+    'dns_requests': 0,
+}
+
+COUNTERS = [
+    ('tcp_accepted', 'sshuttle_tcp_accepted_total',
+     'TCP connections accepted'),
+    ('tcp_denied', 'sshuttle_tcp_denied_total',
+     'TCP connections refused by the ACLs'),
+    ('udp_datagrams', 'sshuttle_udp_datagrams_total',
+     'UDP datagrams captured'),
+    ('dns_requests', 'sshuttle_dns_requests_total',
+     'DNS requests captured'),
+]
+
+# don't keep more than this many scrapes waiting
+METRICS_CONNS_MAX = 16
+# ...nor any of them for longer than this
+METRICS_TIMEOUT = 10
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # the bucket bounds are inclusive ("le")
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, out, name, help):
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s histogram' % name)
+        total = 0
+        for (le, n) in zip(self.buckets, self.counts):
+            total += n
+            out.append('%s_bucket{le="%g"} %d' % (name, le, total))
+        total += self.counts[-1]
+        out.append('%s_bucket{le="+Inf"} %d' % (name, total))
+        out.append('%s_sum %.6f' % (name, self.sum))
+        out.append('%s_count %d' % (name, total))
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10]
+
+dns_latency = Histogram(LATENCY_BUCKETS)
+ping_rtt = Histogram(LATENCY_BUCKETS)
+
+
+def _metric(out, name, type, help, samples):
+    out.append('# HELP %s %s' % (name, help))
+    out.append('# TYPE %s %s' % (name, type))
+    for (labels, value) in samples:
+        if labels:
+            out.append('%s{%s} %s' % (name, labels, value))
+        else:
+            out.append('%s %s' % (name, value))
+
+
+def _directions(sent, received):
+    return [(',direction="out"', sent), (',direction="in"', received)]
+
+
+def render(muxes, gauges=()):
+    """Return everything we know, in Prometheus' text format.
+
+    gauges is a list of (name, type, help, value) for whatever the
+    caller keeps track of itself.
+    """
+    out = []
+    for (key, name, help) in COUNTERS:
+        _metric(out, name, 'counter', help, [('', counters[key])])
+    for (name, type, help, value) in gauges:
+        _metric(out, name, type, help, [('', value)])
+    _metric(out, 'sshuttle_log_dropped_total', 'counter',
+            'log messages dropped because logging fell behind',
+            [('', helpers.log_dropped)])
+    dns_latency.render(out, 'sshuttle_dns_latency_seconds',
+                       'time until the answer to a DNS request arrived')
+    ping_rtt.render(out, 'sshuttle_ping_rtt_seconds',
+                    'round trip time of PINGs through the ssh sessions')
+
+    per_mux = [
+        ('sshuttle_mux_channels', 'gauge', 'open channels',
+         lambda m: [('', len(m.channels))]),
+        ('sshuttle_mux_queued_bytes', 'gauge',
+         'bytes waiting to be sent to the server',
+         lambda m: [('', m.queued)]),
+        ('sshuttle_mux_frames_total', 'counter', 'frames sent or received',
+         lambda m: _directions(m.frames_out, m.frames_in)),
+        ('sshuttle_mux_bytes_total', 'counter',
+         'bytes sent or received through ssh',
+         lambda m: _directions(m.bytes_out, m.bytes_in)),
+        ('sshuttle_tcp_bytes_total', 'counter',
+         'TCP data sent or received, before compression',
+         lambda m: _directions(m.tcp_out, m.tcp_in)),
+        ('sshuttle_mux_ping_rtt_seconds', 'gauge',
+         'round trip time of the last PING',
+         lambda m: [('', 'NaN' if m.rtt is None else '%.6f' % m.rtt)]),
+        ('sshuttle_mux_compression_ratio', 'gauge',
+         'compressed size of TCP data relative to the original',
+         lambda m: [('', '%.3f' % m.compression_ratio())]),
+    ]
+    for (name, type, help, get) in per_mux:
+        samples = []
+        for (i, m) in enumerate(muxes):
+            for (labels, value) in get(m):
+                samples.append(('mux="%d"%s' % (i, labels), value))
+        _metric(out, name, type, help, samples)
+    return '\n'.join(out) + '\n'
+
+
+def parse_address(s):
+    """PATH for a Unix socket, or [HOST:]PORT for HTTP over TCP."""
+    if '/' in s:
+        # absolute, as --daemon changes to / before we get to bind it
+        return os.path.abspath(s)
+    (host, sep, port) = s.rpartition(':')
+    if not port.isdigit():
+        raise Fatal('%s is not a valid metrics address' % s)
+    return (host.strip('[]') or '127.0.0.1', int(port))
+
+
+def worker_address(address, worker):
+    # every worker process answers for itself, on an address of its own
+    if not worker:
+        return address
+    if isinstance(address, tuple):
+        return (address[0], address[1] + worker)
+    return '%s.%d' % (address, worker)
+
+
+class MetricsServer(Handler):
+
+    """Answer HTTP requests for render()'s output.
+
+    Whatever the request, it gets the metrics; each one also sends a PING
+    through every mux that isn't waiting for a PONG already, so that
+    sshuttle_ping_rtt_seconds is up to date even when latency control
+    doesn't send any.
+    """
+
+    def __init__(self, address, muxes, gauges):
+        if isinstance(address, tuple):
+            family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _unlink_socket(address)
+        try:
+            sock.bind(address)
+        except socket.error as e:
+            sock.close()
+            raise Fatal('metrics: could not listen on %r: %s' % (address, e))
+        sock.listen(10)
+        sock.setblocking(False)
+        Handler.__init__(self, [sock])
+        self.sock = sock
+        self.address = address
+        self.muxes = muxes
+        self.gauges = gauges
+        self.conns = []
+        debug1('metrics listening on %r.\n', address)
+
+    def close(self):
+        self.ok = False
+        self.sock.close()
+        if not isinstance(self.address, tuple):
+            _unlink_socket(self.address)
+
+    def render(self):
+        text = render(self.muxes, self.gauges())
+        for m in self.muxes:
+            if not m.pings:
+                m.ping()
+        return text
+
+    def callback(self, sock):
+        try:
+            (conn, peer) = self.sock.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        debug2('metrics: request from %r\n', peer)
+        now = time.time()
+        for c in self.conns:
+            if c.ok and c.started + METRICS_TIMEOUT <= now:
+                c.close()
+        self.conns = [c for c in self.conns if c.ok]
+        while len(self.conns) >= METRICS_CONNS_MAX:
+            self.conns.pop(0).close()
+        c = MetricsConn(conn, self.render, now)
+        self.conns.append(c)
+        if self.dispatcher:
+            self.dispatcher.add(c)
+
+
+class MetricsConn(Handler):
+
+    def __init__(self, sock, render, now):
+        sock.setblocking(False)
+        Handler.__init__(self, [sock])
+        self.sock = sock
+        self.render = render
+        self.started = now
+        self.inbuf = b''
+        self.outbuf = None
+
+    def pre_select(self, r, w, x):
+        if self.outbuf is None:
+            _add(r, self.sock)
+        else:
+            _add(w, self.sock)
+
+    def close(self):
+        self.ok = False
+        self.sock.close()
+
+    def callback(self, sock):
+        try:
+            if self.outbuf is None:
+                data = self.sock.recv(4096)
+                if not data and not self.inbuf:
+                    self.close()
+                    return
+                self.inbuf += data
+                # answer once we've read the whole request, so closing the
+                # socket doesn't reset the connection on the asker
+                if (data and b'\r\n\r\n' not in self.inbuf and
+                        b'\n\n' not in self.inbuf and
+                        len(self.inbuf) < 65536):
+                    return
+                body = self.render().encode('ASCII')
+                self.outbuf = (
+                    b'HTTP/1.0 200 OK\r\n'
+                    b'Content-Type: text/plain; version=0.0.4\r\n'
+                    b'Content-Length: ' + str(len(body)).encode('ASCII') +
+                    b'\r\n\r\n' + body)
+                self.changed()
+            self.outbuf = self.outbuf[self.sock.send(self.outbuf):]
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            debug1('metrics: %s\n', e)
+            self.close()
+            return
+        if not self.outbuf:
+            self.close()
+
+
+def _unlink_socket(path):
+    # only ever remove a stale socket, not something else that's there
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
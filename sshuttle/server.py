@@ -6,14 +6,16 @@ import time
 import sys
 import os
 import platform
+import errno
+import random
 
 import sshuttle.ssnet as ssnet
 import sshuttle.helpers as helpers
 import sshuttle.hostwatch as hostwatch
 import subprocess as ssubprocess
-from sshuttle.ssnet import Handler, Proxy, Mux, MuxWrapper
+from sshuttle.ssnet import Handler, Proxy, Mux, MuxWrapper, _add
 from sshuttle.helpers import log, debug1, debug2, debug3, Fatal, \
-    resolvconf_random_nameserver
+    resolvconf_nameservers
 
 
 def _ipmatch(ipstr):
@@ -103,6 +105,10 @@ def start_hostwatch(seed_hosts):
                 os.dup2(s1.fileno(), 1)
                 os.dup2(s1.fileno(), 0)
                 s1.close()
+                # our log writer thread may have been in the middle of
+                # writing to stderr when we forked, holding its lock for
+                # good as far as we're concerned; log through a new one
+                sys.stderr = os.fdopen(os.dup(2), 'w')
                 rv = hostwatch.hw_main(seed_hosts) or 0
             except Exception:
                 log('%s\n' % _exc_dump())
@@ -120,130 +126,401 @@ class Hostwatch:
         self.sock = None
 
 
-class DnsProxy(Handler):
-
-    def __init__(self, ttl_hack, mux, chan, request):
-        Handler.__init__(self, [])
-        self.timeout = time.time() + 30
-        self.ttl_hack = ttl_hack
-        self.mux = mux
+def dns_payload_size(request):
+    # the largest answer the asker can take over UDP: its EDNS0 OPT
+    # record's payload size, or the classic 512 bytes (RFC 6891)
+    try:
+        b = bytearray(request)
+        counts = struct.unpack('!4H', bytes(b[4:12]))
+        pos = 12
+        for n in range(sum(counts)):
+            while b[pos] and b[pos] & 0xc0 != 0xc0:
+                pos += 1 + b[pos]
+            pos += 1 if not b[pos] else 2
+            if n < counts[0]:
+                pos += 4
+                continue
+            (rtype, rclass, ttl, rdlen) = struct.unpack(
+                '!HHIH', bytes(b[pos:pos + 10]))
+            if rtype == 41:
+                return max(rclass, 512)
+            pos += 10 + rdlen
+    except (IndexError, struct.error):
+        pass
+    return 512
+
+
+# upstream sockets kept open per nameserver
+DNS_SOCKETS = 4
+# nameservers a query is sent to before we give up on it
+DNS_TRIES = 3
+# how long we wait for an answer
+DNS_TIMEOUT = 30
+# a truncated answer is only fetched again over TCP if the asker can take
+# at least this much more than what came back; the whole answer won't
+# fit otherwise, and the asker would only get the truncated one anyway
+DNS_TCP_MARGIN = 512
+DNS_PORT = 53
+
+
+class DnsProxy(object):
+
+    def __init__(self, chan, request):
+        self.timeout = time.time() + DNS_TIMEOUT
         self.chan = chan
         self.tries = 0
         self.request = request
-        self.peers = {}
-        self.try_send()
+        self.qid = None
+        self.sock = None
+        self.tcp = None
+        self.truncated = None
 
-    def try_send(self):
-        if self.tries >= 3:
-            return
-        self.tries += 1
 
-        family, peer = resolvconf_random_nameserver()
+class DnsTcpQuery(Handler):
+    """Asks a nameserver again over TCP, for an answer that was truncated."""
 
-        sock = socket.socket(family, socket.SOCK_DGRAM)
-        if self.ttl_hack:
+    def __init__(self, ttl_hack, peer, req, ondone):
+        (family, ip) = peer
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        Handler.__init__(self, [sock])
+        self.sock = sock
+        self.peer = peer
+        self.req = req
+        self.ondone = ondone
+        self.outbuf = struct.pack('!H', len(req.request)) + req.request
+        self.inbuf = b''
+        if family == socket.AF_INET and ttl_hack:
             sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
-        sock.connect((peer, 53))
-
-        self.peers[sock] = peer
+        sock.setblocking(False)
+        err = sock.connect_ex((ip, DNS_PORT))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            debug2('DNS TCP connect to %r: %s\n', ip, os.strerror(err))
+            self.outbuf = b''
+
+    def pre_select(self, r, w, x):
+        if self.outbuf:
+            _add(w, self.sock)
+        else:
+            _add(r, self.sock)
 
-        debug2('DNS: sending to %r (try %d)\n' % (peer, self.tries))
+    def callback(self, sock):
         try:
-            sock.send(self.request)
-            self.socks.append(sock)
+            if self.outbuf:
+                n = sock.send(self.outbuf)
+                self.outbuf = self.outbuf[n:]
+                return
+            data = sock.recv(65536)
         except socket.error as e:
-            if e.args[0] in ssnet.NET_ERRS:
-                # might have been spurious; try again.
-                # Note: these errors sometimes are reported by recv(),
-                # and sometimes by send().  We have to catch both.
-                debug2('DNS send to %r: %s\n' % (peer, e))
-                self.try_send()
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
                 return
-            else:
-                log('DNS send to %r: %s\n' % (peer, e))
+            debug2('DNS TCP to %r: %s\n', self.peer[1], e)
+            data = b''
+        self.inbuf += data
+        if len(self.inbuf) >= 2:
+            (size,) = struct.unpack('!H', self.inbuf[:2])
+            if len(self.inbuf) >= 2 + size:
+                self.finish(self.inbuf[2:2 + size])
                 return
+        if not data:
+            self.finish(None)
 
-    def callback(self, sock):
-        peer = self.peers[sock]
-
-        try:
-            data = sock.recv(4096)
-        except socket.error as e:
-            self.socks.remove(sock)
-            del self.peers[sock]
+    def finish(self, answer):
+        self.close()
+        self.ondone(self.req, answer)
 
-            if e.args[0] in ssnet.NET_ERRS:
-                # might have been spurious; try again.
-                # Note: these errors sometimes are reported by recv(),
-                # and sometimes by send().  We have to catch both.
-                debug2('DNS recv from %r: %s\n' % (peer, e))
-                self.try_send()
-                return
-            else:
-                log('DNS recv from %r: %s\n' % (peer, e))
-                return
-        debug2('DNS response: %d bytes\n' % len(data))
-        self.mux.send(self.chan, ssnet.CMD_DNS_RESPONSE, data)
+    def close(self):
         self.ok = False
+        self.sock.close()
 
 
-class UdpProxy(Handler):
+class DnsUpstream(Handler):
+    """Forwards DNS requests to the nameservers in /etc/resolv.conf.
 
-    def __init__(self, ttl_hack, mux, chan, family):
-        sock = socket.socket(family, socket.SOCK_DGRAM)
-        Handler.__init__(self, [sock])
-        self.timeout = time.time() + 30
+    All requests share a few long-lived, connected UDP sockets per
+    nameserver.  Each request goes out with a random transaction ID that
+    isn't in use on its socket, which is what its answer is matched on,
+    and the asker's own ID is put back before the answer is returned.
+    Answers that come back truncated although the asker could have taken
+    a good deal more are fetched again over TCP.
+    """
+
+    def __init__(self, ttl_hack, mux, handlers):
+        Handler.__init__(self, [])
         self.ttl_hack = ttl_hack
         self.mux = mux
-        self.chan = chan
-        self.sock = sock
-        if family == socket.AF_INET and self.ttl_hack:
-            self.sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
+        self.handlers = handlers
+        self.servers = []
+        # (family, ip) -> [sock]
+        self.pool = {}
+        # sock -> (family, ip)
+        self.peers = {}
+        # (sock, qid) -> DnsProxy
+        self.pending = {}
+        # channel -> DnsProxy
+        self.requests = {}
+
+    def nameservers(self):
+        servers = resolvconf_nameservers() or [(socket.AF_INET, '127.0.0.1')]
+        if servers != self.servers:
+            self.servers = servers
+            for peer in list(self.pool):
+                if peer not in servers:
+                    debug2('DNS: %r is gone from resolv.conf\n', peer[1])
+                    for sock in self.pool.pop(peer):
+                        self.close_sock(sock)
+        return servers
+
+    def get_sock(self, peer):
+        socks = self.pool.setdefault(peer, [])
+        if len(socks) < DNS_SOCKETS:
+            (family, ip) = peer
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if family == socket.AF_INET and self.ttl_hack:
+                sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
+            sock.connect((ip, DNS_PORT))
+            sock.setblocking(False)
+            socks.append(sock)
+            self.peers[sock] = peer
+            self.socks.append(sock)
+            self.changed()
+            return sock
+        return random.choice(socks)
+
+    def close_sock(self, sock):
+        peer = self.peers.pop(sock)
+        self.socks.remove(sock)
+        self.changed()
+        sock.close()
+        for (key, req) in list(self.pending.items()):
+            if key[0] is sock:
+                del self.pending[key]
+                req.sock = None
+                self.try_send(req)
+        return peer
+
+    def query(self, chan, request):
+        if len(request) < 12:
+            debug1('DNS: request on channel %d is too short\n', chan)
+            return
+        req = DnsProxy(chan, request)
+        self.requests[chan] = req
+        self.try_send(req)
+
+    def try_send(self, req):
+        if req.tries >= DNS_TRIES:
+            return
+        req.tries += 1
+
+        peer = random.choice(self.nameservers())
+        sock = self.get_sock(peer)
+        qid = random.randint(0, 0xffff)
+        while (sock, qid) in self.pending:
+            qid = random.randint(0, 0xffff)
 
-    def send(self, dstip, data):
-        debug2('UDP: sending to %r port %d\n' % dstip)
+        debug2('DNS: sending to %r (try %d)\n', peer[1], req.tries)
         try:
-            self.sock.sendto(data, dstip)
+            sock.send(struct.pack('!H', qid) + req.request[2:])
         except socket.error as e:
-            log('UDP send to %r port %d: %s\n' % (dstip[0], dstip[1], e))
+            if e.args[0] in ssnet.NET_ERRS + [errno.EAGAIN,
+                                              errno.EWOULDBLOCK]:
+                # might have been spurious; try again.
+                # Note: these errors sometimes are reported by recv(),
+                # and sometimes by send().  We have to catch both.
+                debug2('DNS send to %r: %s\n', peer[1], e)
+                self.try_send(req)
+            else:
+                log('DNS send to %r: %s\n' % (peer[1], e))
             return
+        req.sock = sock
+        req.qid = qid
+        self.pending[(sock, qid)] = req
 
     def callback(self, sock):
+        peer = self.peers[sock]
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in ssnet.NET_ERRS:
+                    # an ICMP error on a shared socket doesn't tell us
+                    # which request it was for; move them all elsewhere.
+                    debug2('DNS recv from %r: %s\n', peer[1], e)
+                else:
+                    log('DNS recv from %r: %s\n' % (peer[1], e))
+                self.pool[peer].remove(sock)
+                self.close_sock(sock)
+                return
+            if len(data) < 12:
+                continue
+            (qid,) = struct.unpack('!H', data[:2])
+            req = self.pending.pop((sock, qid), None)
+            if req is None:
+                debug3('DNS: unexpected answer from %r\n', peer[1])
+                continue
+            req.sock = None
+            data = req.request[:2] + data[2:]
+            if (bytearray(data)[2] & 0x02 and
+                    len(data) + DNS_TCP_MARGIN <=
+                    dns_payload_size(req.request)):
+                debug2('DNS response truncated at %d bytes; '
+                       'asking again over TCP\n', len(data))
+                req.truncated = data
+                req.tcp = DnsTcpQuery(self.ttl_hack, peer, req, self.tcp_done)
+                self.handlers.append(req.tcp)
+                continue
+            self.respond(req, data)
+
+    def tcp_done(self, req, answer):
+        req.tcp = None
+        if not answer or len(answer) > dns_payload_size(req.request):
+            # the asker will have to go for it over TCP itself
+            answer = req.truncated
+        self.respond(req, answer)
+
+    def respond(self, req, data):
+        del self.requests[req.chan]
+        debug2('DNS response: %d bytes\n', len(data))
+        self.mux.send(req.chan, ssnet.CMD_DNS_RESPONSE, data)
+
+    def expire(self, now):
+        for (chan, req) in list(self.requests.items()):
+            if req.timeout < now or not (req.sock or req.tcp):
+                debug3('expiring dnsreqs channel=%d\n', chan)
+                del self.requests[chan]
+                if req.sock:
+                    del self.pending[(req.sock, req.qid)]
+                if req.tcp:
+                    req.tcp.close()
+
+
+# datagrams read from one UDP socket per wakeup, at most
+UDP_BATCH = 64
+
+
+class UdpRelay(Handler):
+    """Sends and receives the datagrams of all of the client's UDP channels.
+
+    Channels share sockets.  Each socket knows which channel talks to
+    which peer through it, and that's who gets the peer's datagrams.  A
+    channel keeps using the same socket unless another channel on it
+    already talks to the peer, in which case it moves to one where
+    nobody does; a new socket is only opened if there's no such socket.
+    """
+
+    def __init__(self, ttl_hack, mux):
+        Handler.__init__(self, [])
+        self.ttl_hack = ttl_hack
+        self.mux = mux
+        # sock -> {peer: channel}
+        self.owners = {}
+        # channel -> [family, current sock, {sock: set of peers}]
+        self.channels = {}
+
+    def open(self, chan, family):
+        self.channels[chan] = [family, None, {}]
+
+    def close(self, chan):
+        (family, current, used) = self.channels.pop(chan)
+        for (sock, peers) in used.items():
+            owners = self.owners[sock]
+            for peer in peers:
+                if owners.get(peer) == chan:
+                    del owners[peer]
+            if not owners:
+                self.close_sock(sock)
+
+    def get_sock(self, family, peer):
+        for sock in self.socks:
+            if sock.family == family and peer not in self.owners[sock]:
+                return sock
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_INET and self.ttl_hack:
+            sock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
+        sock.setblocking(False)
+        self.owners[sock] = {}
+        self.socks.append(sock)
+        self.changed()
+        return sock
+
+    def close_sock(self, sock):
+        del self.owners[sock]
+        self.socks.remove(sock)
+        self.changed()
+        sock.close()
+
+    def send(self, chan, peer, data):
+        state = self.channels[chan]
+        (family, sock, used) = state
+        if sock is None or self.owners[sock].get(peer, chan) != chan:
+            sock = state[1] = self.get_sock(family, peer)
+        self.owners[sock][peer] = chan
+        used.setdefault(sock, set()).add(peer)
+        debug2('UDP: sending to %r port %d\n', *peer)
         try:
-            data, peer = sock.recvfrom(4096)
+            sock.sendto(data, peer)
         except socket.error as e:
-            log('UDP recv from %r port %d: %s\n' % (peer[0], peer[1], e))
-            return
-        debug2('UDP response: %d bytes\n' % len(data))
-        hdr = "%s,%r," % (peer[0], peer[1])
-        self.mux.send(self.chan, ssnet.CMD_UDP_DATA, hdr + data)
-
+            log('UDP send to %r port %d: %s\n' % (peer[0], peer[1], e))
 
-def main(ttl_hack, latency_control):
-    debug1('Starting server with Python version %s\n'
-           % platform.python_version())
+    def callback(self, sock):
+        owners = self.owners[sock]
+        for i in range(UDP_BATCH):
+            try:
+                data, peer = sock.recvfrom(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # most likely an ICMP error for something we sent
+                debug2('UDP recv: %s\n', e)
+                continue
+            peer = peer[:2]
+            chan = owners.get(peer)
+            if chan is None:
+                debug3('UDP from %r port %d: nobody asked\n', *peer)
+                continue
+            debug2('UDP response: %d bytes\n', len(data))
+            self.mux.send(chan, ssnet.CMD_UDP_DATA,
+                          ssnet.udp_header(self.mux.protocol, peer) + data)
+
+
+def main(ttl_hack, latency_control, protocol=ssnet.PROTOCOL_MIN,
+         compress=None):
+    debug1('Starting server with Python version %s\n',
+           platform.python_version())
 
     if helpers.verbose >= 1:
         helpers.logprefix = ' s: '
     else:
         helpers.logprefix = 'server: '
-    debug1('latency control setting = %r\n' % latency_control)
+    debug1('latency control setting = %r\n', latency_control)
+    protocol = min(protocol, ssnet.PROTOCOL_VERSION)
+    debug1('protocol version = %d\n', protocol)
 
     routes = list(list_routes())
     debug1('available routes:\n')
     for r in routes:
-        debug1('  %d/%s/%d\n' % r)
+        debug1('  %d/%s/%d\n', *r)
 
     # synchronization header
-    sys.stdout.write('\0\0SSHUTTLE0001')
+    sys.stdout.write('\0\0SSHUTTLE%04d' % protocol)
     sys.stdout.flush()
+    helpers.start_log_writer()
 
     handlers = []
+    dispatcher = ssnet.Dispatcher()
     mux = Mux(socket.fromfd(sys.stdin.fileno(),
                             socket.AF_INET, socket.SOCK_STREAM),
               socket.fromfd(sys.stdout.fileno(),
                             socket.AF_INET, socket.SOCK_STREAM))
+    mux.protocol = protocol
     handlers.append(mux)
+    if compress and protocol >= ssnet.PROTOCOL_COMPRESS:
+        if compress not in ssnet.COMPRESSORS:
+            debug1('%s compression not available; using zlib\n', compress)
+            compress = 'zlib'
+        mux.set_compression(compress)
+        mux.send(0, ssnet.CMD_COMPRESS, compress.encode("ASCII"))
     routepkt = b''
     for r in routes:
         routepkt += b'%d,%s,%d\n' % (r[0], r[1].encode("ASCII"), r[2])
@@ -275,48 +552,42 @@ def main(ttl_hack, latency_control):
     mux.got_host_req = got_host_req
 
     def new_channel(channel, data):
-        (family, dstip, dstport) = data.split(b',', 2)
-        family = int(family)
-        dstport = int(dstport)
+        (family, (dstip, dstport)) = ssnet.split_tcp_connect(mux.protocol,
+                                                             data)
         outwrap = ssnet.connect_dst(ttl_hack, family, dstip, dstport)
         handlers.append(Proxy(MuxWrapper(mux, channel), outwrap))
     mux.new_channel = new_channel
 
-    dnshandlers = {}
+    dns = DnsUpstream(ttl_hack, mux, handlers)
+    handlers.append(dns)
 
     def dns_req(channel, data):
-        debug2('Incoming DNS request channel=%d.\n' % channel)
-        h = DnsProxy(ttl_hack, mux, channel, data)
-        handlers.append(h)
-        dnshandlers[channel] = h
+        debug2('Incoming DNS request channel=%d.\n', channel)
+        dns.query(channel, data)
     mux.got_dns_req = dns_req
 
-    udphandlers = {}
+    udp = UdpRelay(ttl_hack, mux)
+    handlers.append(udp)
 
     def udp_req(channel, cmd, data):
-        debug2('Incoming UDP request channel=%d, cmd=%d\n' % (channel, cmd))
+        debug2('Incoming UDP request channel=%d, cmd=%d\n', channel, cmd)
         if cmd == ssnet.CMD_UDP_DATA:
-            (dstip, dstport, data) = data.split(",", 2)
-            dstport = int(dstport)
-            debug2('is incoming UDP data. %r %d.\n' % (dstip, dstport))
-            h = udphandlers[channel]
-            h.send((dstip, dstport), data)
+            (peer, data) = ssnet.split_udp_data(mux.protocol, data)
+            debug2('is incoming UDP data. %r %d.\n', *peer)
+            udp.send(channel, peer, data)
         elif cmd == ssnet.CMD_UDP_CLOSE:
             debug2('is incoming UDP close\n')
-            h = udphandlers[channel]
-            h.ok = False
+            udp.close(channel)
             del mux.channels[channel]
 
     def udp_open(channel, data):
         debug2('Incoming UDP open.\n')
-        family = int(data)
+        family = ssnet.split_udp_open(mux.protocol, data)
         mux.channels[channel] = lambda cmd, data: udp_req(channel, cmd, data)
-        if channel in udphandlers:
+        if channel in udp.channels:
             raise Fatal('UDP connection channel %d already open' % channel)
         else:
-            h = UdpProxy(ttl_hack, mux, channel, family)
-            handlers.append(h)
-            udphandlers[channel] = h
+            udp.open(channel, family)
     mux.got_udp_open = udp_open
 
     while mux.ok:
@@ -327,26 +598,13 @@ def main(ttl_hack, latency_control):
                 raise Fatal(
                     'hostwatch exited unexpectedly: code 0x%04x\n' % rv)
 
-        ssnet.runonce(handlers, mux)
+        ssnet.runonce(handlers, mux, dispatcher)
         if latency_control:
             mux.check_fullness()
 
-        if dnshandlers:
-            now = time.time()
-            remove = []
-            for channel, h in dnshandlers.items():
-                if h.timeout < now or not h.ok:
-                    debug3('expiring dnsreqs channel=%d\n' % channel)
-                    remove.append(channel)
-                    h.ok = False
-            for channel in remove:
-                del dnshandlers[channel]
-        if udphandlers:
-            remove = []
-            for channel, h in udphandlers.items():
-                if not h.ok:
-                    debug3('expiring UDP channel=%d\n' % channel)
-                    remove.append(channel)
-                    h.ok = False
-            for channel in remove:
-                del udphandlers[channel]
+        if dns.requests:
+            dns.expire(time.time())
+
+    if mux.compression:
+        debug1('%s compression ratio: %.3f\n',
+               mux.compression, mux.compression_ratio())
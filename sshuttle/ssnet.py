@@ -2,9 +2,20 @@ import struct
 import socket
 import errno
 import select
+import sys
 import os
+import zlib
+import math
+import time
+from collections import deque
+import sshuttle.helpers as helpers
 from sshuttle.helpers import log, debug1, debug2, debug3, Fatal
 
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
 MAX_CHANNEL = 65535
 
 # these don't exist in the socket module in python 2.3!
@@ -13,7 +24,23 @@ SHUT_WR = 1
 SHUT_RDWR = 2
 
 
+# Frames start with b'SS' and a 16-bit length.  Frames too large for that
+# start with b'SL' and have a 32-bit length instead.
 HDR_LEN = 8
+HDR_LEN_LARGE = 10
+
+# the mux receive buffer; we always leave room for at least MUX_READ_SIZE
+# bytes at the end of it before reading.
+MUX_BUF_SIZE = 131072
+MUX_READ_SIZE = 32768
+
+# how many chunks of the mux outbuf we hand to a single writev()
+try:
+    MUX_IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    MUX_IOV_MAX = 16
+if MUX_IOV_MAX <= 0:
+    MUX_IOV_MAX = 16
 
 
 CMD_EXIT = 0x4200
@@ -31,6 +58,9 @@ CMD_DNS_RESPONSE = 0x420b
 CMD_UDP_OPEN = 0x420c
 CMD_UDP_DATA = 0x420d
 CMD_UDP_CLOSE = 0x420e
+CMD_TCP_WINDOW = 0x420f
+CMD_COMPRESS = 0x4210
+CMD_TCP_DATA_Z = 0x4211
 
 cmd_to_name = {
     CMD_EXIT: 'EXIT',
@@ -48,7 +78,118 @@ cmd_to_name = {
     CMD_UDP_OPEN: 'UDP_OPEN',
     CMD_UDP_DATA: 'UDP_DATA',
     CMD_UDP_CLOSE: 'UDP_CLOSE',
+    CMD_TCP_WINDOW: 'TCP_WINDOW',
+    CMD_COMPRESS: 'COMPRESS',
+    CMD_TCP_DATA_Z: 'TCP_DATA_Z',
+}
+
+
+# Mux protocol versions.  The client asks for the newest one it knows and
+# the server announces the one both ends will use in its sync header,
+# SSHUTTLE0001 being the original protocol.
+PROTOCOL_MIN = 1
+PROTOCOL_WINDOW = 2   # per-channel flow control with CMD_TCP_WINDOW
+PROTOCOL_COMPRESS = 3  # CMD_COMPRESS and CMD_TCP_DATA_Z
+PROTOCOL_LARGE = 4    # frames longer than 65535 bytes
+PROTOCOL_UDP = 5      # binary peer address in front of CMD_UDP_DATA
+PROTOCOL_BINARY = 6   # binary CMD_TCP_CONNECT and CMD_UDP_OPEN
+PROTOCOL_VERSION = 6
+
+# the largest frame we send once PROTOCOL_LARGE is in use
+MUX_MAX_FRAME = 262144
+
+# how much data a channel may send before the other end gives it credit
+MUX_WINDOW = 1048576
+# with flow control, latency control only keeps the local queue this short
+MUX_QUEUE_MAX = 262144
+
+
+def _zlib_compress(data):
+    return zlib.compress(data, 1)
+
+
+# name -> (compress, decompress); each frame is compressed on its own, so
+# that frames which don't get smaller can simply be sent as they are.
+COMPRESSORS = {
+    'zlib': (_zlib_compress, zlib.decompress),
 }
+if lz4:
+    COMPRESSORS['lz4'] = (lz4.compress, lz4.decompress)
+
+# TCP_DATA smaller than this isn't worth compressing
+MUX_COMPRESS_MIN = 256
+# a channel whose data didn't get any smaller this many frames in a row
+# (TLS, say) is sent as it is; every MUX_COMPRESS_RETRY frames we look
+# again, in case what it carries has changed
+MUX_COMPRESS_TRIES = 4
+MUX_COMPRESS_RETRY = 64
+
+
+# Addresses on the wire, from PROTOCOL_UDP on: the length of the packed
+# address (4 or 16), the port and the address itself.  The address family
+# follows from the length, so the two ends don't need to agree on the
+# numbers their OSes use for AF_INET6.
+def pack_addr(addr):
+    (ip, port) = addr[:2]
+    if ':' in ip:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    else:
+        packed = socket.inet_aton(ip)
+    return struct.pack('!BH', len(packed), port) + packed
+
+
+def unpack_addr(data):
+    # -> (family, (ip, port), whatever follows the address)
+    (n, port) = struct.unpack('!BH', data[:3])
+    family = socket.AF_INET6 if n == 16 else socket.AF_INET
+    ip = socket.inet_ntop(family, data[3:3 + n])
+    return (family, (ip, port), data[3 + n:])
+
+
+def udp_header(protocol, addr):
+    # the (ip, port) a CMD_UDP_DATA datagram goes to, or comes from
+    if protocol < PROTOCOL_UDP:
+        return b'%s,%d,' % (addr[0].encode('ASCII'), addr[1])
+    return pack_addr(addr)
+
+
+def split_udp_data(protocol, data):
+    # CMD_UDP_DATA -> ((ip, port), datagram)
+    if protocol < PROTOCOL_UDP:
+        (ip, port, data) = data.split(b',', 2)
+        return ((ip.decode('ASCII'), int(port)), data)
+    (family, addr, data) = unpack_addr(data)
+    return (addr, data)
+
+
+def tcp_connect_data(protocol, family, addr):
+    if protocol < PROTOCOL_BINARY:
+        return b'%d,%s,%d' % (family, addr[0].encode('ASCII'), addr[1])
+    return pack_addr(addr)
+
+
+def split_tcp_connect(protocol, data):
+    # CMD_TCP_CONNECT -> (family, (ip, port))
+    if protocol < PROTOCOL_BINARY:
+        (family, ip, port) = data.split(b',', 2)
+        return (int(family), (ip.decode('ASCII'), int(port)))
+    (family, addr, rest) = unpack_addr(data)
+    return (family, addr)
+
+
+def udp_open_data(protocol, family):
+    if protocol < PROTOCOL_BINARY:
+        return b'%d' % family
+    return struct.pack('!B', 6 if family == socket.AF_INET6 else 4)
+
+
+def split_udp_open(protocol, data):
+    # CMD_UDP_OPEN -> family
+    if protocol < PROTOCOL_BINARY:
+        return int(data)
+    if struct.unpack('!B', data[:1])[0] == 6:
+        return socket.AF_INET6
+    return socket.AF_INET
 
 
 NET_ERRS = [errno.ECONNREFUSED, errno.ETIMEDOUT,
@@ -56,22 +197,46 @@ NET_ERRS = [errno.ECONNREFUSED, errno.ETIMEDOUT,
             errno.EHOSTDOWN, errno.ENETDOWN]
 
 
+# event bits used by all the poller backends.  These happen to be the same
+# values poll() and epoll() use on Linux, but we translate anyway.
+POLL_IN = 0x001
+POLL_OUT = 0x004
+
+
 def _add(l, elem):
     if elem not in l:
         l.append(elem)
 
 
-def _fds(l):
-    out = []
-    for i in l:
-        try:
-            out.append(i.fileno())
-        except AttributeError:
-            out.append(i)
-    out.sort()
+def _fdmap(l):
+    out = {}
+    for s in l:
+        fd = s.fileno()
+        if fd >= 0:
+            out[fd] = s
     return out
 
 
+if hasattr(os, 'readv'):
+    def _readinto(fd, buf):
+        return os.readv(fd, [buf])
+else:
+    # python 2.7
+    def _readinto(fd, buf):
+        b = os.read(fd, len(buf))
+        buf[:len(b)] = b
+        return len(b)
+
+
+if hasattr(os, 'writev'):
+    _writev = os.writev
+else:
+    # python 2.7
+    def _writev(fd, bufs):
+        return os.write(fd, b''.join(
+            b.tobytes() if isinstance(b, memoryview) else b for b in bufs))
+
+
 def _nb_clean(func, *args):
     try:
         return func(*args)
@@ -79,7 +244,7 @@ def _nb_clean(func, *args):
         if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
             raise
         else:
-            debug3('%s: err was: %s\n' % (func.__name__, e))
+            debug3('%s: err was: %s\n', func.__name__, e)
             return None
 
 
@@ -102,7 +267,7 @@ class SockWrapper:
     def __init__(self, rsock, wsock, connect_to=None, peername=None, connection_is_allowed_callback=None):
         global _swcount
         _swcount += 1
-        debug3('creating new SockWrapper (%d now exist)\n' % _swcount)
+        debug3('creating new SockWrapper (%d now exist)\n', _swcount)
         self.exc = None
         self.rsock = rsock
         self.wsock = wsock
@@ -112,14 +277,16 @@ class SockWrapper:
         self.connect_to = connect_to
         self.peername = peername or _try_peername(self.rsock)
         self.connection_is_allowed_callback = connection_is_allowed_callback
+        self.handler = None
+        self.readsize = 65536
         self.try_connect()
 
     def __del__(self):
         global _swcount
         _swcount -= 1
-        debug1('%r: deleting (%d remain)\n' % (self, _swcount))
+        debug1('%r: deleting (%d remain)\n', self, _swcount)
         if self.exc:
-            debug1('%r: error was: %s\n' % (self, self.exc))
+            debug1('%r: error was: %s\n', self, self.exc)
 
     def __repr__(self):
         if self.rsock == self.wsock:
@@ -128,6 +295,10 @@ class SockWrapper:
             fds = '#%d,%d' % (self.rsock.fileno(), self.wsock.fileno())
         return 'SW%s:%s' % (fds, self.peername)
 
+    def wakeup(self):
+        if self.handler:
+            self.handler.wakeup()
+
     def seterr(self, e):
         if not self.exc:
             self.exc = e
@@ -141,13 +312,13 @@ class SockWrapper:
         if not self.connect_to:
             return  # already connected
         self.rsock.setblocking(False)
-        debug3('%r: trying connect to %r\n' % (self, self.connect_to))
+        debug3('%r: trying connect to %r\n', self, self.connect_to)
         try:
             self.rsock.connect(self.connect_to)
             # connected successfully (Linux)
             self.connect_to = None
         except socket.error as e:
-            debug3('%r: connect result: %s\n' % (self, e))
+            debug3('%r: connect result: %s\n', self, e)
             if e.args[0] == errno.EINVAL:
                 # this is what happens when you call connect() on a socket
                 # that is now connected but returned EINPROGRESS last time,
@@ -157,7 +328,7 @@ class SockWrapper:
                 realerr = self.rsock.getsockopt(socket.SOL_SOCKET,
                                                 socket.SO_ERROR)
                 e = socket.error(realerr, os.strerror(realerr))
-                debug3('%r: fixed connect result: %s\n' % (self, e))
+                debug3('%r: fixed connect result: %s\n', self, e)
             if e.args[0] in [errno.EINPROGRESS, errno.EALREADY]:
                 pass  # not connected yet
             elif e.args[0] == 0:
@@ -183,13 +354,13 @@ class SockWrapper:
 
     def noread(self):
         if not self.shut_read:
-            debug2('%r: done reading\n' % self)
+            debug2('%r: done reading\n', self)
             self.shut_read = True
             # self.rsock.shutdown(SHUT_RD)  # doesn't do anything anyway
 
     def nowrite(self):
         if not self.shut_write:
-            debug2('%r: done writing\n' % self)
+            debug2('%r: done writing\n', self)
             self.shut_write = True
             try:
                 self.wsock.shutdown(SHUT_WR)
@@ -207,7 +378,7 @@ class SockWrapper:
             return _nb_clean(os.write, self.wsock.fileno(), buf)
         except OSError as e:
             if e.errno == errno.EPIPE:
-                debug1('%r: uwrite: got EPIPE\n' % self)
+                debug1('%r: uwrite: got EPIPE\n', self)
                 self.nowrite()
                 return 0
             else:
@@ -226,7 +397,7 @@ class SockWrapper:
             return
         self.rsock.setblocking(False)
         try:
-            return _nb_clean(os.read, self.rsock.fileno(), 65536)
+            return _nb_clean(os.read, self.rsock.fileno(), self.readsize)
         except OSError as e:
             self.seterr('uread: %s' % e)
             return b''  # unexpected error... we'll call it EOF
@@ -254,14 +425,42 @@ class SockWrapper:
             outwrap.nowrite()
 
 
-class Handler:
+class Handler(object):
 
     def __init__(self, socks=None, callback=None):
+        self.dispatcher = None
+        self.onclose = None
+        self._ok = False
         self.ok = True
         self.socks = socks or []
         if callback:
             self.callback = callback
 
+    @property
+    def ok(self):
+        return self._ok
+
+    @ok.setter
+    def ok(self, ok):
+        was_ok = self._ok
+        self._ok = ok
+        if not ok and self.dispatcher:
+            self.dispatcher.remove(self)
+        if was_ok and not ok and self.onclose:
+            self.onclose(self)
+
+    def changed(self):
+        # our pre_select() result may be different now; have the dispatcher
+        # ask again before the next poll.
+        if self.dispatcher:
+            self.dispatcher.dirty.add(self)
+
+    def wakeup(self):
+        # call us back during this loop even if none of our sockets is
+        # ready, eg. because another handler gave us data or an EOF.
+        if self.dispatcher:
+            self.dispatcher.woken.add(self)
+
     def pre_select(self, r, w, x):
         for i in self.socks:
             _add(r, i)
@@ -284,6 +483,21 @@ class Proxy(Handler):
                                 wrap2.rsock, wrap2.wsock])
         self.wrap1 = wrap1
         self.wrap2 = wrap2
+        wrap1.handler = wrap2.handler = self
+        if isinstance(wrap1, MuxWrapper):
+            self.muxwrap = wrap1
+            wrap2.readsize = max(wrap2.readsize, wrap1.mux.max_frame())
+        elif isinstance(wrap2, MuxWrapper):
+            self.muxwrap = wrap2
+            wrap1.readsize = max(wrap1.readsize, wrap2.mux.max_frame())
+        else:
+            self.muxwrap = None
+
+    def total_wrote(self):
+        # how much this connection has received through the mux so far
+        if self.muxwrap:
+            return self.muxwrap.total_wrote
+        return 0
 
     def pre_select(self, r, w, x):
         if self.wrap1.shut_write:
@@ -295,17 +509,32 @@ class Proxy(Handler):
             _add(w, self.wrap1.rsock)
         elif self.wrap1.buf:
             if not self.wrap2.too_full():
-                _add(w, self.wrap2.wsock)
+                self._want_write(w, self.wrap2)
         elif not self.wrap1.shut_read:
-            _add(r, self.wrap1.rsock)
+            self._want_read(r, self.wrap1)
 
         if self.wrap2.connect_to:
             _add(w, self.wrap2.rsock)
         elif self.wrap2.buf:
             if not self.wrap1.too_full():
-                _add(w, self.wrap1.wsock)
+                self._want_write(w, self.wrap1)
         elif not self.wrap2.shut_read:
-            _add(r, self.wrap2.rsock)
+            self._want_read(r, self.wrap2)
+
+    # A mux channel's data, EOF and window credit reach us through
+    # wakeup(), as does room in a drained mux (Mux.unblock()); waiting on
+    # the mux's own sockets would call back every proxy on the mux
+    # whenever any frame arrives.
+
+    def _want_read(self, r, wrap):
+        if not isinstance(wrap, MuxWrapper):
+            _add(r, wrap.rsock)
+
+    def _want_write(self, w, wrap):
+        if isinstance(wrap, MuxWrapper):
+            self.wakeup()  # it has room, so no need to wait
+        else:
+            _add(w, wrap.wsock)
 
     def callback(self, sock):
         self.wrap1.try_connect()
@@ -326,78 +555,7 @@ class Proxy(Handler):
             self.wrap1.nowrite()
             self.wrap2.nowrite()
 
-# Separate out the proxy from the comparison functions for sorting so that they don't interfere with proxy lists
-class ProxyWrapper:
-    
-    def __init__(self, proxy):
-        self.proxy = proxy
-
-    def get_total_wrote(self):
-        self_total_wrote = 0
-        if isinstance(self.proxy.wrap1, MuxWrapper) and hasattr(self.proxy.wrap1, 'total_wrote') and \
-                self.proxy.wrap1.total_wrote > 0:
-            self_total_wrote = self.proxy.wrap1.total_wrote
-        elif isinstance(self.proxy.wrap2, MuxWrapper) and hasattr(self.proxy.wrap2, 'total_wrote') and \
-                self.proxy.wrap2.total_wrote > 0:
-            self_total_wrote = self.proxy.wrap2.total_wrote
-        
-        return self_total_wrote
-
-    def __lt__(self, other):
-        self_total_wrote = 0
-        if hasattr(self, 'get_total_wrote'):
-            self_total_wrote = self.get_total_wrote()
-
-        other_total_wrote = 0
-        if hasattr(other, 'get_total_wrote'):
-            other_total_wrote = other.get_total_wrote()
-
-        return self_total_wrote < other_total_wrote
-
-    def __le__(self, other):
-        self_total_wrote = 0
-        if hasattr(self, 'get_total_wrote'):
-            self_total_wrote = self.get_total_wrote()
-
-        other_total_wrote = 0
-        if hasattr(other, 'get_total_wrote'):
-            other_total_wrote = other.get_total_wrote()
-
-        return self_total_wrote <= other_total_wrote
-
-    def __gt__(self, other):
-        self_total_wrote = 0
-        if hasattr(self, 'get_total_wrote'):
-            self_total_wrote = self.get_total_wrote()
-
-        other_total_wrote = 0
-        if hasattr(other, 'get_total_wrote'):
-            other_total_wrote = other.get_total_wrote()
-
-        return self_total_wrote > other_total_wrote
-
-    def __ge__(self, other):
-        self_total_wrote = 0
-        if hasattr(self, 'get_total_wrote'):
-            self_total_wrote = self.get_total_wrote()
-
-        other_total_wrote = 0
-        if hasattr(other, 'get_total_wrote'):
-            other_total_wrote = other.get_total_wrote()
-
-        return self_total_wrote >= other_total_wrote
-
-    def __cmp__(self, other):
-        self_total_wrote = 0
-        if hasattr(self, 'get_total_wrote'):
-            self_total_wrote = self.get_total_wrote()
-
-        other_total_wrote = 0
-        if hasattr(other, 'get_total_wrote'):
-            other_total_wrote = other.get_total_wrote()
-
-        return cmp(self_total_wrote, other_total_wrote)
-    
+
 class Mux(Handler):
 
     def __init__(self, rsock, wsock):
@@ -409,12 +567,30 @@ class Mux(Handler):
         self.got_host_req = self.got_host_list = None
         self.channels = {}
         self.chani = 0
-        self.want = 0
-        self.inbuf = b''
-        self.outbuf = []
+        self.inbuf = bytearray(MUX_BUF_SIZE)
+        self.inpos = 0   # start of the first frame we haven't handled yet
+        self.inend = 0   # end of the data read into inbuf
+        self.outbuf = deque()  # frame headers and payloads, not joined
+        self.outpos = 0        # how much of outbuf[0] was already written
+        self.queued = 0        # bytes in outbuf not written yet
+        self.protocol = PROTOCOL_MIN
+        self.compression = None
+        self.compress = self.decompress = None
+        self.compress_in = 0   # TCP_DATA bytes we tried to compress
+        self.compress_out = 0  # ...and what we actually sent for them
+        self.compress_misses = {}  # channel -> frames in a row not shrunk
+        self.inwant = 0        # length of the partial frame at inpos
         self.fullness = 0
         self.too_full = False
-        self.send(0, CMD_PING, b'chicken')
+        self.blocked = set()
+        # running totals, for the metrics endpoint
+        self.frames_in = self.frames_out = 0
+        self.bytes_in = self.bytes_out = 0    # as sent through ssh
+        self.tcp_in = self.tcp_out = 0        # TCP_DATA, uncompressed
+        self.pings = deque()   # when each PING we're waiting on went out
+        self.rtt = None        # how long the last PONG took
+        self.got_rtt = None
+        self.ping(b'chicken')
 
     def next_channel(self):
         # channel 0 is special, so we never allocate it
@@ -426,12 +602,17 @@ class Mux(Handler):
                 return self.chani
 
     def amount_queued(self):
-        total = 0
-        for b in self.outbuf:
-            total += len(b)
-        return total
+        return self.queued
 
     def check_fullness(self):
+        if self.protocol >= PROTOCOL_WINDOW:
+            # What is in flight is already limited per channel by the
+            # windows; just keep the local queue short, so that interactive
+            # channels don't wait behind bulk ones.  flush() clears this.
+            if self.queued > MUX_QUEUE_MAX:
+                self.too_full = True
+            return
+
         # Fullness is a factor of the number of channels. The more the channels, the smaller the fullness factor.
         # This is so that the mux bandwidth can become full faster with many channels to give all channels a fair
         # chance to go through.
@@ -445,7 +626,7 @@ class Mux(Handler):
 
             if self.fullness > max_fullness:
                 if not self.too_full:
-                    self.send(0, CMD_PING, b'rttest')
+                    self.ping()
                 self.too_full = True
         # ob = []
         # for b in self.outbuf:
@@ -453,27 +634,95 @@ class Mux(Handler):
         #    ob.append(c)
         # log('outbuf: %d %r\n' % (self.amount_queued(), ob))
 
+    def set_compression(self, name):
+        (self.compress, self.decompress) = COMPRESSORS[name]
+        self.compression = name
+
+    def compression_ratio(self):
+        if not self.compress_in:
+            return 1.0
+        return float(self.compress_out) / self.compress_in
+
+    def ping(self, data=b'rttest'):
+        self.pings.append(time.time())
+        self.send(0, CMD_PING, data)
+
+    def max_frame(self):
+        if self.protocol >= PROTOCOL_LARGE:
+            return MUX_MAX_FRAME
+        return 65535
+
     def send(self, channel, cmd, data):
         assert isinstance(data, bytes)
-        assert len(data) <= 65535
-        p = struct.pack('!ccHHH', b'S', b'S', channel, cmd, len(data)) + data
-        self.outbuf.append(p)
-        debug2(' > channel=%d cmd=%s len=%d (fullness=%d)\n'
-               % (channel, cmd_to_name.get(cmd, hex(cmd)),
-                  len(data), self.fullness))
+        self.frames_out += 1
+        if cmd == CMD_TCP_DATA:
+            self.tcp_out += len(data)
+        if (cmd == CMD_TCP_DATA and self.compress and
+                len(data) >= MUX_COMPRESS_MIN):
+            misses = self.compress_misses.get(channel, 0)
+            if (misses < MUX_COMPRESS_TRIES or
+                    misses % MUX_COMPRESS_RETRY == 0):
+                z = self.compress(data)
+                self.compress_in += len(data)
+                if len(z) < len(data):
+                    (cmd, data) = (CMD_TCP_DATA_Z, z)
+                self.compress_out += len(data)
+            if cmd == CMD_TCP_DATA_Z:
+                self.compress_misses.pop(channel, None)
+            else:
+                self.compress_misses[channel] = misses + 1
+        elif cmd == CMD_TCP_EOF:
+            # nothing more to send on this channel
+            self.compress_misses.pop(channel, None)
+        if len(data) <= 65535:
+            hdr = struct.pack('!ccHHH', b'S', b'S', channel, cmd, len(data))
+        else:
+            assert len(data) <= self.max_frame()
+            hdr = struct.pack('!ccHHI', b'S', b'L', channel, cmd, len(data))
+        self.outbuf.append(hdr)
+        if data:
+            self.outbuf.append(data)
+        self.queued += len(hdr) + len(data)
+        self.changed()
+        if helpers.verbose >= 2:
+            debug2(' > channel=%d cmd=%s len=%d (fullness=%d)\n',
+                   channel, cmd_to_name.get(cmd, hex(cmd)), len(data),
+                   self.fullness)
         self.fullness += len(data)
 
+    def unblock(self):
+        for wrap in self.blocked:
+            wrap.wakeup()
+        self.blocked.clear()
+
     def got_packet(self, channel, cmd, data):
-        debug2('<  channel=%d cmd=%s len=%d\n'
-               % (channel, cmd_to_name.get(cmd, hex(cmd)), len(data)))
+        if helpers.verbose >= 2:
+            debug2('<  channel=%d cmd=%s len=%d\n',
+                   channel, cmd_to_name.get(cmd, hex(cmd)), len(data))
+        self.frames_in += 1
+        if cmd == CMD_TCP_DATA_Z:
+            (cmd, data) = (CMD_TCP_DATA, self.decompress(data))
+        if cmd == CMD_TCP_DATA:
+            self.tcp_in += len(data)
         if cmd == CMD_PING:
             self.send(0, CMD_PONG, data)
         elif cmd == CMD_PONG:
             debug2('received PING response\n')
-            self.too_full = False
-            self.fullness = 0
+            if self.pings:
+                # PONGs come back in the order we sent the PINGs
+                self.rtt = time.time() - self.pings.popleft()
+                if self.got_rtt:
+                    self.got_rtt(self.rtt)
+            if self.protocol < PROTOCOL_WINDOW:
+                # with windows, too_full only follows the queue (flush())
+                self.too_full = False
+                self.fullness = 0
+                self.unblock()
         elif cmd == CMD_EXIT:
             self.ok = False
+        elif cmd == CMD_COMPRESS:
+            debug1('compressing TCP data with %s\n', data.decode("ASCII"))
+            self.set_compression(data.decode("ASCII"))
         elif cmd == CMD_TCP_CONNECT:
             assert(not self.channels.get(channel))
             if self.new_channel:
@@ -504,51 +753,94 @@ class Mux(Handler):
         else:
             callback = self.channels.get(channel)
             if not callback:
-                debug1('warning: closed channel %d got cmd=%s len=%d\n'
-                    % (channel, cmd_to_name.get(cmd, hex(cmd)), len(data)))
+                debug1('warning: closed channel %d got cmd=%s len=%d\n',
+                       channel, cmd_to_name.get(cmd, hex(cmd)), len(data))
             else:
                 callback(cmd, data)
 
     def flush(self):
         self.wsock.setblocking(False)
-        if self.outbuf and self.outbuf[0]:
-            wrote = _nb_clean(os.write, self.wsock.fileno(), self.outbuf[0])
-            debug2('mux wrote: %r/%d\n' % (wrote, len(self.outbuf[0])))
-            if wrote:
-                self.outbuf[0] = self.outbuf[0][wrote:]
-        while self.outbuf and not self.outbuf[0]:
-            self.outbuf[0:1] = []
+        if not self.outbuf:
+            return
+        bufs = []
+        for b in self.outbuf:
+            bufs.append(b)
+            if len(bufs) >= MUX_IOV_MAX:
+                break
+        if self.outpos:
+            bufs[0] = memoryview(bufs[0])[self.outpos:]
+        wrote = _nb_clean(_writev, self.wsock.fileno(), bufs)
+        debug2('mux wrote: %r (%d chunks)\n', wrote, len(bufs))
+        if wrote:
+            self.queued -= wrote
+            self.bytes_out += wrote
+            wrote += self.outpos
+            while self.outbuf and wrote >= len(self.outbuf[0]):
+                wrote -= len(self.outbuf.popleft())
+            self.outpos = wrote
+        if (self.too_full and self.protocol >= PROTOCOL_WINDOW and
+                self.queued <= MUX_QUEUE_MAX // 2):
+            self.too_full = False
+            self.unblock()
+
+    def _make_room(self):
+        # Frames are handled as soon as they are complete, so all that is
+        # left to move is the start of one partial frame.
+        pending = self.inend - self.inpos
+        if self.inpos:
+            self.inbuf[:pending] = self.inbuf[self.inpos:self.inend]
+            self.inpos = 0
+            self.inend = pending
+        # grow in one go if the frame is larger than what we have
+        need = max(self.inwant, self.inend + MUX_READ_SIZE)
+        if len(self.inbuf) < need:
+            self.inbuf.extend(bytearray(need - len(self.inbuf)))
 
     def fill(self):
         self.rsock.setblocking(False)
+        if self.inpos == self.inend:
+            self.inpos = self.inend = 0
+        elif (len(self.inbuf) - self.inend < MUX_READ_SIZE or
+                self.inpos + self.inwant > len(self.inbuf)):
+            self._make_room()
         try:
-            b = _nb_clean(os.read, self.rsock.fileno(), 32768)
+            n = _nb_clean(_readinto, self.rsock.fileno(),
+                          memoryview(self.inbuf)[self.inend:])
         except OSError as e:
             raise Fatal('other end: %r' % e)
-        # log('<<< %r\n' % b)
-        if b == b'':  # EOF
+        # log('<<< %r\n' % self.inbuf[self.inend:self.inend + n])
+        if n == 0:  # EOF
             self.ok = False
-        if b:
-            self.inbuf += b
+        elif n:
+            self.inend += n
+            self.bytes_in += n
 
     def handle(self):
         self.fill()
-        # log('inbuf is: (%d,%d) %r\n'
-        #     % (self.want, len(self.inbuf), self.inbuf))
-        while 1:
-            if len(self.inbuf) >= (self.want or HDR_LEN):
+        # log('inbuf is: (%d,%d)\n' % (self.inpos, self.inend))
+        buf = memoryview(self.inbuf)
+        self.inwant = 0
+        while self.inend - self.inpos >= HDR_LEN:
+            (s1, s2, channel, cmd, datalen) = \
+                struct.unpack_from('!ccHHH', self.inbuf, self.inpos)
+            assert(s1 == b'S')
+            if s2 == b'L':
+                if self.inend - self.inpos < HDR_LEN_LARGE:
+                    break
                 (s1, s2, channel, cmd, datalen) = \
-                    struct.unpack('!ccHHH', self.inbuf[:HDR_LEN])
-                assert(s1 == b'S')
-                assert(s2 == b'S')
-                self.want = datalen + HDR_LEN
-            if self.want and len(self.inbuf) >= self.want:
-                data = self.inbuf[HDR_LEN:self.want]
-                self.inbuf = self.inbuf[self.want:]
-                self.want = 0
-                self.got_packet(channel, cmd, data)
+                    struct.unpack_from('!ccHHI', self.inbuf, self.inpos)
+                start = self.inpos + HDR_LEN_LARGE
             else:
+                assert(s2 == b'S')
+                start = self.inpos + HDR_LEN
+            end = start + datalen
+            if end > self.inend:
+                self.inwant = end - self.inpos
                 break
+            data = buf[start:end].tobytes()
+            self.inpos = end
+            self.got_packet(channel, cmd, data)
+        del buf  # inbuf can't be resized while a view of it exists
 
     def pre_select(self, r, w, x):
         _add(r, self.rsock)
@@ -556,10 +848,16 @@ class Mux(Handler):
             _add(w, self.wsock)
 
     def callback(self, sock):
-        (r, w, x) = select.select([self.rsock], [self.wsock], [], 0)
-        if self.rsock in r:
+        # the dispatcher only calls us for a socket it saw as ready, and
+        # both fill() and flush() cope with EAGAIN, so no need to select()
+        # again here.  rsock and wsock are often the same socket, though;
+        # only do what it was found ready for.
+        events = POLL_IN | POLL_OUT
+        if self.dispatcher and sock is not None:
+            events = self.dispatcher.events.get(sock.fileno(), events)
+        if sock == self.rsock and events & POLL_IN:
             self.handle()
-        if self.outbuf and self.wsock in w:
+        if sock == self.wsock and events & POLL_OUT and self.outbuf:
             self.flush()
 
 
@@ -571,7 +869,9 @@ class MuxWrapper(SockWrapper):
         self.channel = channel
         self.mux.channels[channel] = self.got_packet
         self.socks = []
-        debug2('new channel: %d\n' % channel)
+        self.window = MUX_WINDOW  # how much more we may send
+        self.unacked = 0          # how much we got but didn't give credit for
+        debug2('new channel: %d\n', channel)
 
     def __del__(self):
         self.nowrite()
@@ -582,35 +882,62 @@ class MuxWrapper(SockWrapper):
 
     def noread(self):
         if not self.shut_read:
-            debug2('%r: done reading\n' % self)
+            debug2('%r: done reading\n', self)
             self.shut_read = True
             self.mux.send(self.channel, CMD_TCP_STOP_SENDING, b'')
             self.maybe_close()
 
     def nowrite(self):
         if not self.shut_write:
-            debug2('%r: done writing\n' % self)
+            debug2('%r: done writing\n', self)
             self.shut_write = True
             self.mux.send(self.channel, CMD_TCP_EOF, b'')
             self.maybe_close()
 
     def maybe_close(self):
         if self.shut_read and self.shut_write:
-            debug2('%r: closing connection\n' % self)
+            debug2('%r: closing connection\n', self)
             # remove the mux's reference to us.
             del self.mux.channels[self.channel]
 
+    def flow_control(self):
+        return self.mux.protocol >= PROTOCOL_WINDOW
+
     def too_full(self):
-        return self.mux.too_full
+        if self.mux.too_full:
+            # remember to wake our proxy once the mux drains
+            self.mux.blocked.add(self)
+            return True
+        # a CMD_TCP_WINDOW from the other end will wake us up
+        return self.flow_control() and self.window <= 0
 
     def uwrite(self, buf):
         if self.mux.too_full:
             return 0  # too much already enqueued
-        if len(buf) > 65535:
-            buf = buf[:65535]
+        if self.flow_control():
+            if self.window <= 0:
+                return 0  # the other end hasn't caught up yet
+            if len(buf) > self.window:
+                buf = buf[:self.window]
+        if len(buf) > self.mux.max_frame():
+            buf = buf[:self.mux.max_frame()]
         self.mux.send(self.channel, CMD_TCP_DATA, buf)
+        self.window -= len(buf)
         return len(buf)
 
+    def copy_to(self, outwrap):
+        wrote = self.total_wrote
+        SockWrapper.copy_to(self, outwrap)
+        if not self.flow_control():
+            return
+        # give the other end credit for what has left our buffer, in
+        # chunks big enough to keep the number of updates down.
+        self.unacked += self.total_wrote - wrote
+        if self.unacked >= MUX_WINDOW // 4 and not self.shut_read:
+            self.mux.send(self.channel, CMD_TCP_WINDOW,
+                          struct.pack('!I', self.unacked))
+            self.unacked = 0
+
     def uread(self):
         if self.shut_read:
             return b''  # EOF
@@ -624,13 +951,16 @@ class MuxWrapper(SockWrapper):
             self.nowrite()
         elif cmd == CMD_TCP_DATA:
             self.buf.append(data)
+        elif cmd == CMD_TCP_WINDOW:
+            self.window += struct.unpack('!I', data)[0]
         else:
             raise Exception('unknown command %d (%d bytes)'
                             % (cmd, len(data)))
+        self.wakeup()
 
 
 def connect_dst(ttl_hack, family, ip, port):
-    debug2('Connecting to %s:%d\n' % (ip, port))
+    debug2('Connecting to %s:%d\n', ip, port)
     outsock = socket.socket(family)
     if ttl_hack:
         outsock.setsockopt(socket.SOL_IP, socket.IP_TTL, 42)
@@ -639,43 +969,292 @@ def connect_dst(ttl_hack, family, ip, port):
                        peername = '%s:%d' % (ip, port))
 
 
-def runonce(handlers, mux):
-    r = []
-    w = []
-    x = []
-    to_remove = [s for s in handlers if not s.ok]
-    for h in to_remove:
-        handlers.remove(h)
-
-    for s in handlers:
-        s.pre_select(r, w, x)
-    debug2('Waiting: %d r=%r w=%r x=%r (fullness=%d/%d)\n'
-           % (len(handlers), _fds(r), _fds(w), _fds(x),
-               mux.fullness, mux.too_full))
-    (r, w, x) = select.select(r, w, x)
-    debug2('  Ready: %d r=%r w=%r x=%r\n'
-           % (len(handlers), _fds(r), _fds(w), _fds(x)))
-    ready = r + w + x
-    did = {}
-    proxywrappers = []
+class SelectPoller(object):
+
+    def __init__(self):
+        self.rfds = set()
+        self.wfds = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if events & POLL_IN:
+            self.rfds.add(fd)
+        else:
+            self.rfds.discard(fd)
+        if events & POLL_OUT:
+            self.wfds.add(fd)
+        else:
+            self.wfds.discard(fd)
+
+    def unregister(self, fd):
+        self.rfds.discard(fd)
+        self.wfds.discard(fd)
+
+    def poll(self, timeout=None):
+        (r, w, x) = select.select(self.rfds, self.wfds, [], timeout)
+        events = {}
+        for fd in r:
+            events[fd] = POLL_IN
+        for fd in w:
+            events[fd] = events.get(fd, 0) | POLL_OUT
+        return list(events.items())
+
+
+class PollPoller(object):
+
+    # errors and hangups are reported whether we asked for them or not;
+    # select() would show such a socket as both readable and writable.
+    IN = select.POLLIN if hasattr(select, 'POLLIN') else 0
+    OUT = select.POLLOUT if hasattr(select, 'POLLOUT') else 0
+    ERR = (select.POLLERR | select.POLLHUP | select.POLLNVAL
+           if hasattr(select, 'POLLERR') else 0)
+
+    def __init__(self):
+        self.p = select.poll()
+
+    def _native(self, events):
+        n = 0
+        if events & POLL_IN:
+            n |= self.IN
+        if events & POLL_OUT:
+            n |= self.OUT
+        return n
+
+    def _events(self, n):
+        events = 0
+        if n & (self.IN | self.ERR):
+            events |= POLL_IN
+        if n & (self.OUT | self.ERR):
+            events |= POLL_OUT
+        return events
+
+    def register(self, fd, events):
+        self.p.register(fd, self._native(events))
+
+    def modify(self, fd, events):
+        self.p.modify(fd, self._native(events))
+
+    def unregister(self, fd):
+        try:
+            self.p.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        return [(fd, self._events(n)) for (fd, n) in self.p.poll(timeout)]
+
+
+class EpollPoller(PollPoller):
 
+    IN = getattr(select, 'EPOLLIN', 0)
+    OUT = getattr(select, 'EPOLLOUT', 0)
+    ERR = getattr(select, 'EPOLLERR', 0) | getattr(select, 'EPOLLHUP', 0)
+
+    def __init__(self):
+        self.p = select.epoll()
+
+    def register(self, fd, events):
+        try:
+            self.p.register(fd, self._native(events))
+        except (IOError, OSError) as e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.p.modify(fd, self._native(events))
+
+    def modify(self, fd, events):
+        try:
+            self.p.modify(fd, self._native(events))
+        except (IOError, OSError) as e:
+            # the kernel forgets about an fd when it is closed, so a reused
+            # fd number has to be registered from scratch.
+            if e.errno != errno.ENOENT:
+                raise
+            self.p.register(fd, self._native(events))
+
+    def unregister(self, fd):
+        try:
+            self.p.unregister(fd)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOENT, errno.EBADF):
+                raise
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        return [(fd, self._events(n)) for (fd, n) in self.p.poll(timeout)]
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    elif hasattr(select, 'poll') and not sys.platform.startswith('darwin'):
+        # poll() on MacOS doesn't work for all kinds of fds
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+
+class Dispatcher(object):
+
+    """Keep track of which fds each handler wants to wait on.
+
+    Rather than asking every handler for its pre_select() on each loop,
+    handlers are only asked again once they have been called back or have
+    told us their state changed (see Handler.changed()), and only the
+    difference is passed on to the poller.
+    """
+
+    def __init__(self, poller=None):
+        self.poller = poller or make_poller()
+        self.handlers = set()
+        self.dirty = set()
+        self.woken = set()
+        self.wants = {}     # handler -> ({fd: sock} read, {fd: sock} write)
+        self.readers = {}   # fd -> {handler: sock}
+        self.writers = {}   # fd -> {handler: sock}
+        self.masks = {}     # fd -> events currently given to the poller
+        self.socks = {}     # fd -> the socket the poller has it for
+        self.events = {}    # fd -> what the last poll() found it ready for
+
+    def add(self, handler):
+        if not handler.ok:
+            return
+        handler.dispatcher = self
+        self.handlers.add(handler)
+        self.dirty.add(handler)
+
+    def remove(self, handler):
+        handler.dispatcher = None
+        self.handlers.discard(handler)
+        self.dirty.discard(handler)
+        self.woken.discard(handler)
+        (r, w) = self.wants.pop(handler, ({}, {}))
+        for fd in r:
+            self._drop(self.readers, fd, handler)
+        for fd in w:
+            self._drop(self.writers, fd, handler)
+
+    def _drop(self, table, fd, handler):
+        hs = table.get(fd)
+        if hs is not None:
+            hs.pop(handler, None)
+            if not hs:
+                del table[fd]
+            self._sync(fd)
+
+    def _sync(self, fd):
+        events = 0
+        if fd in self.readers:
+            events |= POLL_IN
+        if fd in self.writers:
+            events |= POLL_OUT
+        old = self.masks.get(fd, 0)
+        if events == old:
+            return
+        if not events:
+            del self.masks[fd]
+            del self.socks[fd]
+            self.poller.unregister(fd)
+        elif not old:
+            self.masks[fd] = events
+            self.poller.register(fd, events)
+        else:
+            self.masks[fd] = events
+            self.poller.modify(fd, events)
+
+    def _claim(self, fd, sock):
+        # A different socket under an fd number we know means the old one
+        # was closed and the number reused: the kernel has forgotten about
+        # it (epoll) or still has the dead one (poll), and the handlers
+        # still waiting on the old socket would never hear from it again.
+        old = self.socks.get(fd)
+        if old is not None and old is not sock:
+            self.readers.pop(fd, None)
+            self.writers.pop(fd, None)
+            del self.masks[fd]
+            self.poller.unregister(fd)
+        self.socks[fd] = sock
+
+    def _update(self, handler):
+        r = []
+        w = []
+        x = []
+        handler.pre_select(r, w, x)
+        newr = _fdmap(r)
+        neww = _fdmap(w)
+        (oldr, oldw) = self.wants.get(handler, ({}, {}))
+        self.wants[handler] = (newr, neww)
+        for (old, new, table) in ((oldr, newr, self.readers),
+                                  (oldw, neww, self.writers)):
+            for fd in old:
+                if fd not in new:
+                    self._drop(table, fd, handler)
+            for fd, sock in new.items():
+                if old.get(fd) is not sock:
+                    self._claim(fd, sock)
+                    table.setdefault(fd, {})[handler] = sock
+                    self._sync(fd)
+
+    def update(self):
+        while self.dirty:
+            handler = self.dirty.pop()
+            if handler.ok:
+                self._update(handler)
+
+    def poll(self, timeout=None):
+        """Return a list of (handler, sock) pairs that are ready."""
+        ready = []
+        self.events = {}
+        for (fd, events) in self.poller.poll(timeout):
+            self.events[fd] = events
+            hs = {}
+            if events & POLL_IN:
+                hs.update(self.readers.get(fd, {}))
+            if events & POLL_OUT:
+                hs.update(self.writers.get(fd, {}))
+            ready.extend(hs.items())
+        return ready
+
+
+def runonce(handlers, mux, dispatcher, timeout=None):
+    # handlers is the list of newly created handlers; the dispatcher takes
+    # them over from here on and drops them again once they are not ok.
     for h in handlers:
+        dispatcher.add(h)
+    del handlers[:]
+
+    dispatcher.update()
+    if helpers.verbose >= 2:
+        debug2('Waiting: %d handlers, r=%d w=%d (fullness=%d/%d)\n',
+               len(dispatcher.handlers), len(dispatcher.readers),
+               len(dispatcher.writers), mux.fullness, mux.too_full)
+    ready = dispatcher.poll(0 if dispatcher.woken else timeout)
+    debug2('  Ready: %d\n', len(ready))
+
+    # Serve the proxies that moved the least data first, so a few bulk
+    # transfers can't starve the interactive ones.  Grouping them by the
+    # magnitude of total_wrote() gives us that without sorting every
+    # proxy; a proxy with several ready sockets is only called once.
+    buckets = {}
+    for (h, s) in ready:
         if isinstance(h, Proxy):
-            proxywrappers.append(ProxyWrapper(h))
-        else:
-            for s in h.socks:
-                if s in ready:
-                    h.callback(s)
-                    did[s] = 1
-
-    proxywrappers.sort()
-
-    for proxywrapper in proxywrappers:
-        for s in proxywrapper.proxy.socks:
-            if s in ready:
-                proxywrapper.proxy.callback(s)
-                did[s] = 1
-
-    for s in ready:
-        if s not in did:
-            raise Fatal('socket %r was not used by any handler' % s)
+            buckets.setdefault(h.total_wrote().bit_length(), {})[h] = s
+        elif h.ok:
+            h.callback(s)
+            h.changed()
+
+    for n in sorted(buckets):
+        for (h, s) in buckets[n].items():
+            if h.ok:
+                h.callback(s)
+                h.changed()
+
+    while dispatcher.woken:
+        h = dispatcher.woken.pop()
+        if h.ok:
+            h.callback(None)
+            h.changed()
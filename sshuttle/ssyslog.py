@@ -1,7 +1,10 @@
 import sys
 import os
+import socket
 import subprocess as ssubprocess
 
+import sshuttle.helpers as helpers
+
 
 _p = None
 
@@ -17,3 +20,29 @@ def stderr_to_syslog():
     sys.stdout.flush()
     sys.stderr.flush()
     os.dup2(_p.stdin.fileno(), 2)
+
+
+def devlog_sink(path='/dev/log'):
+    """Return a function that sends log text straight to syslogd.
+
+    Each line becomes one datagram on the local syslog socket, with the
+    same facility, priority and tag as start_syslog()'s logger(1), and
+    lines the socket has no room for are dropped rather than waited for.
+    Returns None if there is no syslog socket to talk to.
+    """
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        s.connect(path)
+    except socket.error:
+        return None
+    s.setblocking(False)
+
+    def sink(text):
+        # local2.notice, as for logger(1) above
+        tag = '<149>sshuttle[%d]: ' % os.getpid()
+        for line in text.splitlines():
+            try:
+                s.send((tag + line).encode('utf-8', 'replace'))
+            except socket.error:
+                helpers.log_dropped += 1
+    return sink
@@ -0,0 +1,82 @@
+from sshuttle.acl import AclIndex
+
+
+def test_acl_index():
+    index = AclIndex({
+        "10.1.2.3/32": ["22", "8000-8010"],
+        "10.0.0.0/8": ["80"],
+        "192.168.0.0/16": ["1-1024", "1000-2000", "443"],
+        "fd00::/8": ["443"],
+        "bogus": ["1"],
+        "172.16.0.0/12": ["http"],
+    })
+    assert len(index) == 4
+
+    assert index.match("10.1.2.3", "22")
+    assert index.match("10.1.2.3", 8005)
+    assert index.match("10.1.2.3", "80")
+    assert not index.match("10.1.2.3", "8011")
+    assert index.match("10.9.9.9", "80")
+    assert not index.match("10.9.9.9", "22")
+    assert not index.match("11.1.2.3", "80")
+
+    assert index.match("192.168.5.5", "1")
+    assert index.match("192.168.5.5", "2000")
+    assert not index.match("192.168.5.5", "2001")
+
+    assert index.match("fd12::1", "443")
+    assert not index.match("fe80::1", "443")
+    assert not index.match("not an address", "80")
+
+
+def test_acl_index_global():
+    index = AclIndex({"0.0.0.0/0": ["53"], "1.2.3.0/24": ["80"]})
+    assert index.match("8.8.8.8", "53")
+    assert index.match("::1", "53")
+    assert index.match("1.2.3.4", "80")
+    assert not index.match("8.8.8.8", "80")
+
+    assert not AclIndex().match("1.2.3.4", "80")
+    assert not AclIndex(None).match("1.2.3.4", "80")
+
+
+def test_acl_index_update():
+    index = AclIndex({"10.0.0.0/8": ["80"], "0.0.0.0/0": ["53"]})
+    index.update({
+        "10.0.0.0/8": None,
+        "10.1.0.0/16": ["80", "443"],
+        "0.0.0.0/0": None,
+        "missing/32": None,
+    })
+    assert len(index) == 1
+    assert not index.match("10.2.0.1", "80")
+    assert index.match("10.1.0.1", "443")
+    assert not index.match("8.8.8.8", "53")
+
+    index.update({"10.1.0.0/16": None, "10.1.2.3": ["22"]})
+    assert len(index) == 1
+    assert not index.match("10.1.0.1", "443")
+    assert index.match("10.1.2.3", "22")
+    assert index.tables[4][0][0] == 0
+    assert len(index.tables[4]) == 1
+
+
+def test_acl_index_update_in_place():
+    index = AclIndex({"10.0.0.0/8": ["80"]})
+    seen = []
+
+    class CheckedTable(dict):
+        # what match() would find, each time update() touches the table
+        def __setitem__(self, key, value):
+            dict.__setitem__(self, key, value)
+            seen.append(index.match("10.1.2.3", "80"))
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            seen.append(index.match("10.1.2.3", "80"))
+
+    index.nets[4][8] = CheckedTable(index.nets[4][8])
+    index.update({})
+    index.update({"10.0.0.0/8": ["80", "443"]})
+    assert seen == [True]
+    assert index.match("10.1.2.3", "443")
@@ -0,0 +1,594 @@
+import errno
+import heapq
+import select
+import signal
+import socket
+
+import pytest
+from mock import Mock, patch, call
+from dnslib import DNSRecord, RR, A, EDNS0
+
+import sshuttle.client
+import sshuttle.ssnet as ssnet
+from sshuttle.dnscache import DnsCache
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.dnsreqs', new={})
+@patch('sshuttle.client.dnsreqs2', new={})
+@patch('sshuttle.client.udp_by_src', new={})
+def test_expire_connections():
+    client = sshuttle.client
+    mux = Mock()
+    mux.channels = {1: None, 2: None, 3: None}
+
+    client.dnsreqs[1] = 130
+    client.dnsreqs2[1] = DNSRecord.question('example.com')
+    client.schedule_expiry(130, client.EXPIRE_DNS, 1)
+    client.udp_by_src[('1.2.3.4', 53)] = (2, 130)
+    client.schedule_expiry(130, client.EXPIRE_UDP, ('1.2.3.4', 53))
+    client.udp_by_src[('1.2.3.5', 53)] = (3, 130)
+    client.schedule_expiry(130, client.EXPIRE_UDP, ('1.2.3.5', 53))
+    assert client.next_expiry(100) == 30
+
+    # nothing is due yet
+    client.expire_connections(120, mux)
+    assert mux.mock_calls == []
+    assert len(mux.channels) == 3
+
+    # one UDP peer was active again, so it only gets a new deadline
+    client.udp_by_src[('1.2.3.5', 53)] = (3, 150)
+    method = Mock()
+    client.expire_connections(140, mux, method)
+    assert mux.mock_calls == [call.send(2, ssnet.CMD_UDP_CLOSE, b'')]
+    assert method.mock_calls == [call.forget_udp(('1.2.3.4', 53))]
+    assert mux.channels == {3: None}
+    assert client.dnsreqs == {}
+    assert client.dnsreqs2 == {}
+    assert list(client.udp_by_src) == [('1.2.3.5', 53)]
+    assert client.next_expiry(140) == 10
+
+    client.expire_connections(150, mux)
+    assert mux.channels == {}
+    assert client.udp_by_src == {}
+    assert client.next_expiry(150) is None
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.udp_by_src', new={})
+def test_accept_udp_batch():
+    client = sshuttle.client
+    mux = Mock()
+    mux.channels = {}
+    mux.protocol = ssnet.PROTOCOL_LARGE
+    mux.next_channel.side_effect = [1, 2]
+    method = Mock()
+    method.recv_udp_batch.return_value = [
+        (('1.1.1.1', 1000), ('9.9.9.9', 514), b'one'),
+        (('1.1.1.2', 1000), ('9.9.9.9', 514), b'two'),
+        (('1.1.1.1', 1000), ('9.9.9.9', 515), b'three'),
+    ]
+    listener = Mock()
+    listener.family = socket.AF_INET
+
+    client.onaccept_udp(listener, method, mux, [])
+    assert method.recv_udp_batch.mock_calls == [
+        call(listener, 65536, client.UDP_BATCH)]
+    assert mux.send.mock_calls == [
+        call(1, ssnet.CMD_UDP_OPEN, b'%d' % socket.AF_INET),
+        call(1, ssnet.CMD_UDP_DATA, b'9.9.9.9,514,one'),
+        call(2, ssnet.CMD_UDP_OPEN, b'%d' % socket.AF_INET),
+        call(2, ssnet.CMD_UDP_DATA, b'9.9.9.9,514,two'),
+        call(1, ssnet.CMD_UDP_DATA, b'9.9.9.9,515,three'),
+    ]
+    assert sorted(client.udp_by_src) == [('1.1.1.1', 1000),
+                                         ('1.1.1.2', 1000)]
+
+    mux.channels[1](ssnet.CMD_UDP_DATA, b'9.9.9.9,514,reply')
+    mux.protocol = ssnet.PROTOCOL_UDP
+    mux.channels[2](ssnet.CMD_UDP_DATA,
+                    ssnet.udp_header(mux.protocol, ('9.9.9.9', 515)) + b'x')
+    assert method.send_udp.mock_calls == [
+        call(listener, ('9.9.9.9', 514), ('1.1.1.1', 1000), b'reply'),
+        call(listener, ('9.9.9.9', 515), ('1.1.1.2', 1000), b'x')]
+
+
+def test_udp_senders():
+    client = sshuttle.client
+    method = Mock()
+    listener = Mock()
+    sender = Mock()
+    got = []
+    method.udp_senders.return_value = [(sender, listener)]
+
+    senders = client.UdpSenders(method)
+    assert method.udp_senders_changed == senders.senders_changed
+    senders.add_listener(ssnet.Handler([listener], got.append))
+    r = []
+    senders.pre_select(r, [], [])
+    assert r == [sender]
+    senders.callback(sender)
+    assert got == [sender]
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.tcp_conns', new={})
+@patch('sshuttle.client.tcp_conns_by_src', new={})
+@patch('sshuttle.client.tcp_conns_by_mux', new={})
+@patch('sshuttle.client.tcp_rechecks', new={})
+@patch('sshuttle.client.active_tcp_conns', new={})
+@patch('sshuttle.client.connection_is_allowed')
+def test_acl_watcher(mock_allowed):
+    client = sshuttle.client
+    mock_allowed.return_value = True
+    socks = [Mock(), Mock(), Mock()]
+    proxies = [Mock(), Mock(), Mock()]
+    client.add_tcp_conn(socks[0], ('1.1.1.1', 1000), ('10.0.0.1', 80),
+                        proxies[0], 100)
+    client.add_tcp_conn(socks[1], ('1.1.1.1', 1001), ('10.0.0.2', 22),
+                        proxies[1], 100)
+    client.add_tcp_conn(socks[2], ('2.2.2.2', 1000), ('10.0.0.1', 80),
+                        proxies[2], 100)
+    assert mock_allowed.mock_calls == []
+
+    watcher = client.AclWatcher()
+    try:
+        mock_allowed.return_value = False
+        assert sorted(client.changed_sources(
+            {'1.1.1.1': 1, '2.2.2.2': 2, '3.3.3.3': 3},
+            {'2.2.2.2': 2, '3.3.3.3': 4})) == ['1.1.1.1', '3.3.3.3']
+        watcher.post(client.ACL_SOURCES_CHANGED, ['1.1.1.1', '3.3.3.3'])
+        watcher.callback(watcher.rsock)
+        assert len(mock_allowed.mock_calls) == 2
+        assert proxies[0].ok is False
+        assert proxies[1].ok is False
+        assert list(client.tcp_conns) == [socks[2]]
+        assert list(client.tcp_conns_by_src) == ['2.2.2.2']
+
+        revoked = client.revoked_targets(
+            {'10.0.0.0/24': ['80'], '10.0.1.0/24': ['80']},
+            {'10.0.0.0/24': ['443'], '10.0.1.0/24': ['80']})
+        assert revoked == {'10.0.0.0/24': ['80']}
+        watcher.post(client.ACL_TARGETS_CHANGED, client.AclIndex(revoked))
+        watcher.callback(watcher.rsock)
+        assert client.tcp_conns == {}
+        assert client.active_tcp_conns == {}
+    finally:
+        watcher.rsock.close()
+        watcher.wsock.close()
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.tcp_conns', new={})
+@patch('sshuttle.client.tcp_conns_by_src', new={})
+@patch('sshuttle.client.tcp_conns_by_mux', new={})
+@patch('sshuttle.client.tcp_rechecks', new={})
+@patch('sshuttle.client.active_tcp_conns', new={})
+@patch('sshuttle.client._allowed_sources', new={'1.1.1.1': 500000})
+@patch('sshuttle.client._excluded_sources', new={'1.1.1.1': 200000})
+@patch('sshuttle.client.connection_is_allowed')
+def test_tcp_rechecks(mock_allowed):
+    client = sshuttle.client
+    mock_allowed.return_value = True
+    socks = [Mock() for i in range(4)]
+    for (i, sock) in enumerate(socks[:3]):
+        client.add_tcp_conn(sock, ('1.1.1.1', 1000 + i), ('10.0.0.1', 80),
+                            Mock(), 100)
+    # one check for the source, when its exclusion runs out first
+    assert [e[0] for e in client._expiry] == [200]
+    client.forget_tcp_conn(socks[0])
+    client.add_tcp_conn(socks[3], ('1.1.1.1', 1003), ('10.0.0.1', 80),
+                        Mock(), 150)
+    assert len(client._expiry) == 1
+
+    # at which the connections only the exclusion allowed go away
+    mock_allowed.side_effect = lambda dstip, dstport, srcip: dstport != '22'
+    client.tcp_conns[socks[1]] = (('1.1.1.1', 1001), ('10.0.0.2', 22),
+                                  client.tcp_conns[socks[1]][2])
+    client.expire_connections(200, Mock())
+    assert sorted(client.tcp_conns, key=socks.index) == socks[2:]
+    assert [e[0] for e in client._expiry] == [500]
+    assert client.tcp_rechecks == {'1.1.1.1': 500}
+
+
+@patch('sshuttle.client._allowed_sources', new={'1.1.1.1': 5, '2.2.2.2': 5})
+@patch('sshuttle.client._allowed_targets', new={'10.0.0.0/8': ['80']})
+@patch('sshuttle.client._allowed_index',
+       new=sshuttle.client.AclIndex({'10.0.0.0/8': ['80']}))
+@patch('sshuttle.client.post_acl_change')
+def test_acl_delta(mock_post):
+    client = sshuttle.client
+    redis = Mock()
+
+    redis.hmget.return_value = [None, b'7', b'9']
+    client.AclHandler(redis, client.ACL_SOURCES_TYPE).apply_acl_delta(
+        ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+    assert redis.hmget.mock_calls == [
+        call('sshuttleAclSources', ['1.1.1.1', '2.2.2.2', '3.3.3.3'])]
+    assert client._allowed_sources == {'2.2.2.2': 7, '3.3.3.3': 9}
+    assert mock_post.mock_calls == [
+        call(client.ACL_SOURCES_CHANGED, ['1.1.1.1', '2.2.2.2', '3.3.3.3'])]
+
+    mock_post.reset_mock()
+    redis.hmget.return_value = [b'["443"]', b'["22"]']
+    client.AclHandler(redis, client.ALLOWED_ACL_TYPE).apply_acl_delta(
+        ['10.0.0.0/8', '192.168.0.0/16'])
+    assert client._allowed_targets == {'10.0.0.0/8': ['443'],
+                                       '192.168.0.0/16': ['22']}
+    assert not client._allowed_index.match('10.1.1.1', 80)
+    assert client._allowed_index.match('10.1.1.1', 443)
+    assert client._allowed_index.match('192.168.1.1', 22)
+    ((kind, revoked),) = [c[1] for c in mock_post.mock_calls]
+    assert kind == client.ACL_TARGETS_CHANGED
+    assert revoked.match('10.1.1.1', 80)
+    assert not revoked.match('192.168.1.1', 22)
+
+
+def test_acl_pull_hash():
+    client = sshuttle.client
+    redis = Mock()
+    redis.type.return_value = b'hash'
+    redis.hgetall.return_value = {b'1.1.1.1': b'5', b'2.2.2.2': b'bad'}
+    handler = client.AclHandler(redis, client.ACL_SOURCES_TYPE)
+    handler.pullAcl()
+    assert redis.hgetall.mock_calls == [call('sshuttleAclSources')]
+    assert handler.parseAcl() == {'1.1.1.1': 5}
+
+    redis.type.return_value = b'string'
+    redis.get.return_value = b'{"1.1.1.1": 6}'
+    handler.pullAcl()
+    assert handler.parseAcl() == {'1.1.1.1': 6}
+
+
+def test_dns_forwarder():
+    client = sshuttle.client
+    servers = []
+    for ip in ('127.0.0.1', '127.0.0.2'):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind((ip, 0 if not servers else servers[0].getsockname()[1]))
+        s.settimeout(1)
+        servers.append(s)
+    port = servers[0].getsockname()[1]
+
+    def answer(server):
+        (query, peer) = server.recvfrom(512)
+        server.sendto(query + b'answer', peer)
+        return query
+
+    query = b'\x12\x34' + b'q' * 20
+    got = []
+    with patch.multiple(client, DNS_1='127.0.0.1', DNS_2='127.0.0.2',
+                        preferreddns='127.0.0.1',
+                        notpreferreddns='127.0.0.2',
+                        DNS_PORT=port, _expiry=[]):
+        f = client.DnsForwarder()
+        try:
+            # the preferred server answers
+            f.forward(query, 100, got.append, lambda: got.append('fallback'))
+            sent = answer(servers[0])
+            assert sent[2:] == query[2:]
+            select.select([f.sock], [], [], 1)
+            f.callback(f.sock)
+            assert got == [query + b'answer']
+            assert f.pending == {}
+
+            # it doesn't; the other one gets the query too and answers
+            del got[:]
+            f.forward(query, 200, got.append, lambda: got.append('fallback'))
+            servers[0].recvfrom(512)
+            ((when, seq, kind, qid),) = [e for e in client._expiry
+                                         if e[0] > 200]
+            assert when == 200 + client.DNS_HEDGE_DELAY
+            f.expire(qid, when, when)
+            answer(servers[1])
+            select.select([f.sock], [], [], 1)
+            f.callback(f.sock)
+            assert got == [query + b'answer']
+            assert client.preferreddns == '127.0.0.2'
+
+            # neither answers
+            del got[:]
+            f.forward(query, 300, got.append, lambda: got.append('fallback'))
+            while client._expiry:
+                (when, seq, kind, qid) = heapq.heappop(client._expiry)
+                if when > 300:
+                    f.expire(qid, when, when)
+            assert got == ['fallback']
+            assert f.pending == {}
+        finally:
+            f.sock.close()
+            for s in servers:
+                s.close()
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.dnsreqs', new={})
+@patch('sshuttle.client.dnsreqs2', new={})
+@patch('sshuttle.client.dns_inflight', new={})
+@patch('sshuttle.client.dns_waiters', new={})
+@patch('sshuttle.client.dns_started', new={})
+@patch('sshuttle.client._dns_cache', new=None)
+def test_dns_coalescing():
+    client = sshuttle.client
+    mux = Mock()
+    mux.channels = {}
+    mux.next_channel.side_effect = [1, 2, 3, 4]
+    method = Mock()
+    listener = Mock()
+
+    queries = []
+    for (i, name) in enumerate(['a.com', 'A.com', 'b.com', 'a.com',
+                                'a.com']):
+        q = DNSRecord.question(name)
+        q.header.id = 100 + i
+        if i == 4:
+            # could take a larger answer than the others
+            q.add_ar(EDNS0(udp_len=4096))
+        queries.append(q)
+        method.recv_udp.return_value = (('1.1.1.1', 1000 + i),
+                                        ('9.9.9.9', 53), q.pack())
+        client.ondns(listener, method, mux, [])
+    # only the second 'a.com' asks the very same question as the first
+    assert mux.send.mock_calls == [
+        call(1, ssnet.CMD_DNS_REQ, queries[0].pack()),
+        call(2, ssnet.CMD_DNS_REQ, queries[1].pack()),
+        call(3, ssnet.CMD_DNS_REQ, queries[2].pack()),
+        call(4, ssnet.CMD_DNS_REQ, queries[4].pack()),
+    ]
+    assert sorted(mux.channels) == [1, 2, 3, 4]
+
+    reply = queries[0].reply().pack()
+    mux.channels[1](ssnet.CMD_DNS_RESPONSE, reply)
+    assert [c[1][1:3] for c in method.send_udp.mock_calls] == [
+        (('9.9.9.9', 53), ('1.1.1.1', 1000)),
+        (('9.9.9.9', 53), ('1.1.1.1', 1003)),
+    ]
+    assert [DNSRecord.parse(c[1][3]).header.id
+            for c in method.send_udp.mock_calls] == [100, 103]
+
+    reply = queries[1].reply().pack()
+    mux.channels[2](ssnet.CMD_DNS_RESPONSE, reply)
+    # with the case it asked in
+    response = DNSRecord.parse(method.send_udp.mock_calls[-1][1][3])
+    assert str(response.q.qname) == 'A.com.'
+    assert sorted(client.dns_inflight.values()) == [3, 4]
+    assert sorted(client.dns_waiters) == [3, 4]
+    assert sorted(mux.channels) == [3, 4]
+
+
+@patch('sshuttle.client._expiry', new=[])
+@patch('sshuttle.client.dnsreqs', new={})
+@patch('sshuttle.client.dnsreqs2', new={})
+@patch('sshuttle.client.dns_inflight', new={})
+@patch('sshuttle.client.dns_waiters', new={})
+@patch('sshuttle.client.dns_started', new={})
+@patch('sshuttle.client._dns_cache', new=DnsCache(10))
+@patch.dict('sshuttle.metrics.counters', {'dns_requests': 0})
+def test_dns_cache_fill():
+    client = sshuttle.client
+    mux = Mock()
+    mux.channels = {}
+    mux.next_channel.side_effect = [1]
+    method = Mock()
+    listener = Mock()
+
+    q = DNSRecord.question('a.com')
+    reply = q.reply()
+    reply.add_answer(RR('a.com', rdata=A('10.0.0.1'), ttl=60))
+    method.recv_udp.return_value = (('1.1.1.1', 1000), ('9.9.9.9', 53),
+                                    q.pack())
+    client.ondns(listener, method, mux, [])
+    mux.channels[1](ssnet.CMD_DNS_RESPONSE, reply.pack())
+    # the cache starts out empty, but still has to take the answer
+    assert len(client._dns_cache) == 1
+
+    client.ondns(listener, method, mux, [])
+    assert len(mux.send.mock_calls) == 1
+    assert method.send_udp.mock_calls[-1][1][3] == reply.pack()
+    # nothing else is coming back to the asker from the server's address
+    assert method.forget_udp.mock_calls == [call(('1.1.1.1', 1000))] * 2
+    assert sshuttle.metrics.counters['dns_requests'] == 2
+    assert client.dns_started == {}
+
+
+class Exited(Exception):
+    pass
+
+
+@patch('sshuttle.client.os._exit', side_effect=Exited)
+@patch('sshuttle.client.os.fork')
+@patch('sshuttle.helpers.flush_log')
+def test_start_workers(mock_flush_log, mock_fork, mock_exit):
+    client = sshuttle.client
+    listener = Mock()
+    servers = [(Mock(), Mock()), (Mock(), Mock())]
+    metrics_server = Mock()
+    run = Mock()
+
+    # the main process
+    mock_fork.side_effect = [1001, 1002]
+    workerpids = client.start_workers(3, listener, servers, metrics_server,
+                                      run)
+    try:
+        assert [pid for (pid, sock) in workerpids] == [1001, 1002]
+        assert listener.setblocking.mock_calls == [call(False)]
+        assert run.mock_calls == []
+        assert servers[0][1].rsock.close.mock_calls == []
+    finally:
+        for (pid, sock) in workerpids:
+            sock.close()
+
+    # a worker: it gets rid of what's the main process's, and never returns
+    for (result, rv) in [(0, 0),
+                         (client.Fatal('no ssh'), 99),
+                         (KeyboardInterrupt(), 1)]:
+        mock_fork.side_effect = [0]
+        mock_exit.reset_mock()
+        run.reset_mock()
+        if isinstance(result, BaseException):
+            run.side_effect = result
+        else:
+            run.side_effect = None
+            run.return_value = result
+        with pytest.raises(Exited):
+            client.start_workers(2, listener, servers, metrics_server, run)
+        ((worker, sock), kw) = run.call_args
+        assert worker == 1
+        sock.close()
+        assert mock_exit.mock_calls == [call(rv)]
+        for (p, m) in servers:
+            assert m.rsock.close.called
+        assert metrics_server.sock.close.called
+    assert mock_flush_log.call_count == 3
+
+
+@patch('sshuttle.client._acl_watcher', new=None)
+@patch('sshuttle.helpers.logprefix', new='')
+@patch('sshuttle.helpers.start_log_writer')
+@patch('sshuttle.client.start_channel_listener')
+@patch('sshuttle.client.connect_server')
+@patch('sshuttle.client.ssnet.runonce')
+def test_worker(mock_runonce, mock_connect, mock_channel_listener,
+                mock_start_log_writer):
+    client = sshuttle.client
+    servers = [(Mock(), Mock()), (Mock(), Mock())]
+    mock_connect.side_effect = servers
+    # the first server goes away after one round
+    servers[0][0].poll.side_effect = [None, 255]
+    servers[1][0].poll.return_value = None
+    listener = Mock()
+    method = Mock()
+    (parentsock, sock) = socket.socketpair()
+    try:
+        with pytest.raises(client.Fatal):
+            client._worker(2, sock, listener, method, ['ssh'], 'host',
+                           'python', {}, False, 2, None)
+        assert sshuttle.helpers.logprefix == 'c2: '
+        assert mock_start_log_writer.called
+        assert mock_channel_listener.called
+        muxes = [m for (p, m) in servers]
+        ((handlers, mux, dispatcher, timeout), kw) = mock_runonce.call_args
+        assert mux is muxes[0]
+        assert handlers[:2] == muxes
+        assert client._acl_watcher in handlers
+        assert listener.add_handler.mock_calls == [
+            call(handlers, client.onaccept_tcp, method, muxes)]
+
+        # and it notices the main process going away
+        (parent,) = [h for h in handlers
+                     if isinstance(h, ssnet.Handler) and h.socks == [sock]]
+        parentsock.close()
+        with pytest.raises(client.Fatal):
+            parent.callback(sock)
+    finally:
+        sock.close()
+        if client._acl_watcher:
+            client._acl_watcher.rsock.close()
+            client._acl_watcher.wsock.close()
+
+
+@patch('sshuttle.client.os.waitpid')
+@patch('sshuttle.client.os.kill')
+def test_stop_workers(mock_kill, mock_waitpid):
+    client = sshuttle.client
+    socks = [Mock(), Mock()]
+    # the first one has exited already
+    mock_kill.side_effect = [OSError(errno.ESRCH, 'No such process'), None]
+    mock_waitpid.side_effect = [OSError(errno.ECHILD, 'No child'), (1002, 0)]
+    client.stop_workers([(1001, socks[0]), (1002, socks[1])])
+    for sock in socks:
+        assert sock.close.called
+    assert mock_kill.mock_calls == [call(1001, signal.SIGTERM),
+                                    call(1002, signal.SIGTERM)]
+    assert mock_waitpid.mock_calls == [call(1001, 0), call(1002, 0)]
+
+    mock_kill.side_effect = OSError(errno.EPERM, 'Not permitted')
+    with pytest.raises(OSError):
+        client.stop_workers([(1001, Mock())])
+
+
+@patch('sshuttle.client.tcp_conns_by_mux', new={})
+def test_pick_mux():
+    client = sshuttle.client
+    muxes = [Mock(), Mock(), Mock()]
+    for (m, queued) in zip(muxes, [0, 10, 5]):
+        m.amount_queued.return_value = queued
+    # all the DNS and UDP channels are on the first one
+    muxes[0].channels = dict((i, None) for i in range(100))
+    assert client.pick_mux(muxes) is muxes[0]
+
+    proxies = [Mock(), Mock()]
+    proxies[0].wrap2.mux = muxes[0]
+    proxies[1].wrap2.mux = muxes[2]
+    with patch('sshuttle.client._expiry', new=[]), \
+            patch('sshuttle.client.tcp_conns', new={}), \
+            patch('sshuttle.client.tcp_conns_by_src', new={}), \
+            patch('sshuttle.client.tcp_rechecks', new={}), \
+            patch('sshuttle.client.active_tcp_conns', new={}):
+        socks = [Mock(), Mock()]
+        for (i, s) in enumerate(proxies):
+            client.add_tcp_conn(socks[i], ('1.1.1.1', 1000 + i),
+                                ('10.0.0.1', 80), s, 100)
+        assert client.pick_mux(muxes) is muxes[1]
+        client.forget_tcp_conn(socks[0])
+        assert list(client.tcp_conns_by_mux) == [muxes[2]]
+        assert client.pick_mux(muxes) is muxes[0]
+
+
+class Stop(Exception):
+    pass
+
+
+@patch('sshuttle.client._acl_watcher', new=None)
+@patch('sshuttle.helpers.logprefix', new='')
+@patch('sshuttle.helpers.start_log_writer')
+@patch('sshuttle.client.stop_workers')
+@patch('sshuttle.client.start_workers')
+@patch('sshuttle.client.start_channel_listener')
+@patch('sshuttle.client.connect_server')
+@patch('sshuttle.client.os.waitpid', return_value=(0, 0))
+@patch('sshuttle.client.ssnet.runonce', side_effect=Stop)
+def test_main_transports(mock_runonce, mock_waitpid, mock_connect,
+                         mock_channel_listener, mock_start_workers,
+                         mock_stop_workers, mock_start_log_writer):
+    client = sshuttle.client
+    servers = [(Mock(), Mock()), (Mock(), Mock()), (Mock(), Mock())]
+    for (p, m) in servers:
+        p.poll.return_value = None
+    mock_connect.side_effect = servers
+    muxes = [m for (p, m) in servers]
+    workerpids = [(1001, Mock())]
+
+    def start_workers(*args):
+        # the redis listener's thread mustn't be around when they fork
+        assert not mock_channel_listener.called
+        return workerpids
+    mock_start_workers.side_effect = start_workers
+    listener = Mock()
+    fw = Mock()
+    try:
+        with pytest.raises(Stop):
+            client._main(listener, None, fw, ['ssh'], 'host', 'python',
+                         False, False, None, None, False, False, None,
+                         3, 2, None)
+        assert len(mock_connect.mock_calls) == 3
+        assert mock_start_workers.call_args[0][:4] == (2, listener, servers,
+                                                       None)
+        assert mock_channel_listener.called
+        assert mock_stop_workers.mock_calls == [call(workerpids)]
+
+        ((handlers, mux, dispatcher, timeout), kw) = mock_runonce.call_args
+        assert mux is muxes[0]
+        assert handlers[:3] == muxes
+        assert listener.add_handler.mock_calls == [
+            call(handlers, client.onaccept_tcp, fw.method, muxes)]
+        # the routes only come from the first server
+        for m in muxes[1:]:
+            m.got_routes(b'2,10.0.0.0,8\n')
+        assert fw.start.mock_calls == []
+        muxes[0].got_routes(b'2,10.0.0.0,8\n')
+        assert fw.start.mock_calls == [call()]
+    finally:
+        if client._acl_watcher:
+            client._acl_watcher.rsock.close()
+            client._acl_watcher.wsock.close()
@@ -0,0 +1,104 @@
+from dnslib import DNSRecord, RR, QTYPE, RCODE, A, SOA, EDNS0
+
+from sshuttle.dnscache import DnsCache
+
+
+def answer(name, ttl=60, rcode=RCODE.NOERROR, soa_ttl=None):
+    q = DNSRecord.question(name, 'A')
+    r = q.reply()
+    r.header.rcode = rcode
+    if ttl:
+        r.add_answer(RR(name, QTYPE.A, rdata=A('1.2.3.4'), ttl=ttl))
+    if soa_ttl:
+        r.add_auth(RR(name, QTYPE.SOA, ttl=soa_ttl,
+                      rdata=SOA('ns', 'host', (1, 2, 3, 4, 30))))
+    return r
+
+
+def test_dns_cache():
+    cache = DnsCache(2)
+    r = answer('example.com')
+    cache.put(r, r.pack(), 100)
+
+    q = DNSRecord.question('EXAMPLE.com', 'A')
+    q.header.id = 4321
+    data = cache.get(q, 100)
+    got = DNSRecord.parse(data)
+    assert got.header.id == 4321
+    assert got.rr[0].ttl == 60
+
+    got = DNSRecord.parse(cache.get(q, 150))
+    assert got.header.id == 4321
+    assert got.rr[0].ttl == 10
+    assert cache.get(q, 160) is None
+    assert cache.get(DNSRecord.question('example.com', 'AAAA'), 100) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_dns_cache_negative():
+    cache = DnsCache(10)
+    nx = answer('nx.example.com', ttl=0, rcode=RCODE.NXDOMAIN, soa_ttl=600)
+    cache.put(nx, nx.pack(), 100)
+    q = DNSRecord.question('nx.example.com', 'A')
+    assert DNSRecord.parse(cache.get(q, 129)).header.rcode == RCODE.NXDOMAIN
+    assert cache.get(q, 130) is None
+
+    # no SOA, a server failure or a truncated answer: nothing to cache
+    for r in [answer('a.example.com', ttl=0, rcode=RCODE.NXDOMAIN),
+              answer('b.example.com', rcode=RCODE.SERVFAIL),
+              answer('c.example.com', ttl=0)]:
+        cache.put(r, r.pack(), 100)
+    r = answer('d.example.com')
+    r.header.tc = 1
+    cache.put(r, r.pack(), 100)
+    assert len(cache) == 0
+
+
+def test_dns_cache_lru():
+    cache = DnsCache(2)
+    for name in ['a.com', 'b.com']:
+        cache.put(answer(name), answer(name).pack(), 100)
+    assert cache.get(DNSRecord.question('a.com'), 100)
+    cache.put(answer('c.com'), answer('c.com').pack(), 100)
+    assert len(cache) == 2
+    assert cache.get(DNSRecord.question('a.com'), 100)
+    assert cache.get(DNSRecord.question('b.com'), 100) is None
+    assert cache.get(DNSRecord.question('c.com'), 100)
+
+
+def test_dns_cache_payload_size():
+    cache = DnsCache(10)
+    r = answer('big.example.com')
+    for i in range(40):
+        r.add_answer(RR('big.example.com', QTYPE.A, rdata=A('10.0.0.%d' % i),
+                        ttl=60))
+    data = r.pack()
+    assert len(data) > 512
+    cache.put(r, data, 100)
+
+    q = DNSRecord.question('big.example.com', 'A')
+    assert cache.get(q, 100) is None
+    q.add_ar(EDNS0(udp_len=4096))
+    assert len(cache.get(q, 100)) == len(data)
+
+
+def test_dns_cache_question():
+    cache = DnsCache(10)
+    r = answer('Example.COM')
+    cache.put(r, r.pack(), 100)
+
+    # answered with the asker's own spelling, fresh or not
+    q = DNSRecord.question('eXAMPLE.com', 'A')
+    for now in [100, 110]:
+        got = DNSRecord.parse(cache.get(q, now))
+        assert str(got.q.qname) == 'eXAMPLE.com.'
+        assert got.rr[0].rdata == A('1.2.3.4')
+
+    # a DNSSEC OK asker doesn't get the answer to a question without DO
+    q.add_ar(EDNS0(flags='do', udp_len=4096))
+    assert cache.get(q, 100) is None
+    r = answer('example.com')
+    r.add_ar(EDNS0(flags='do', udp_len=4096))
+    cache.put(r, r.pack(), 100)
+    assert len(cache) == 2
+    assert cache.get(q, 100)
@@ -1,7 +1,10 @@
-from mock import patch, call
+from mock import Mock, patch, call
 import sys
 import io
+import os
 import socket
+import threading
+from collections import deque
 
 import sshuttle.helpers
 
@@ -115,6 +118,83 @@ def test_debug3_nop(mock_stderr, mock_stdout):
     assert mock_stderr.mock_calls == []
 
 
+@patch('sshuttle.helpers.logprefix', new='prefix: ')
+@patch('sshuttle.helpers.verbose', new=2)
+@patch('sshuttle.helpers.sys.stdout')
+@patch('sshuttle.helpers.sys.stderr')
+def test_debug_args(mock_stderr, mock_stdout):
+    formatted = []
+
+    class Lazy(object):
+        def __repr__(self):
+            formatted.append(self)
+            return 'lazy'
+
+    sshuttle.helpers.debug3("message %r\n", Lazy())
+    assert formatted == []
+    sshuttle.helpers.debug2("message %r %d%%\n", Lazy(), 5)
+    assert len(formatted) == 1
+    sshuttle.helpers.debug2("100%\n")
+    assert mock_stderr.mock_calls == [
+        call.write('prefix: message lazy 5%\n'),
+        call.flush(),
+        call.write('prefix: 100%\n'),
+        call.flush(),
+    ]
+
+
+@patch('sshuttle.helpers.logprefix', new='prefix: ')
+@patch('sshuttle.helpers.LOG_QUEUE_MAX', new=3)
+@patch('sshuttle.helpers.log_dropped', new=0)
+@patch('sshuttle.helpers.sys.stdout')
+@patch('sshuttle.helpers.sys.stderr')
+def test_log_queued(mock_stderr, mock_stdout):
+    queue = deque()
+    cond = threading.Condition()
+    with patch('sshuttle.helpers._log_queue',
+               new=(os.getpid(), queue, cond)):
+        sshuttle.helpers.log("message 1\n")
+        sshuttle.helpers.log("message 2\nline2\n")
+        sshuttle.helpers.log("message 3\n")
+        sshuttle.helpers.log("message 4\n")
+    assert list(queue) == [
+        'prefix: message 1\n',
+        'prefix: message 2\n',
+        '---> line2\n',
+    ]
+    assert sshuttle.helpers.log_dropped == 2
+    assert mock_stdout.mock_calls == []
+    assert mock_stderr.mock_calls == []
+
+    # only ever the queue this process's log() fills
+    with patch('sshuttle.helpers._log_queue',
+               new=(os.getpid() + 1, queue, cond)):
+        sshuttle.helpers.flush_log()
+    assert mock_stderr.mock_calls == []
+    with patch('sshuttle.helpers._log_queue',
+               new=(os.getpid(), queue, cond)):
+        sshuttle.helpers.flush_log()
+    assert not queue
+    assert mock_stderr.mock_calls == [
+        call.write('prefix: message 1\n'),
+        call.write('prefix: message 2\n'),
+        call.write('---> line2\n'),
+        call.flush(),
+    ]
+
+
+@patch('sshuttle.helpers.logprefix', new='prefix: ')
+@patch('sshuttle.helpers.sys.stdout')
+@patch('sshuttle.helpers.sys.stderr')
+def test_log_sink(mock_stderr, mock_stdout):
+    sink = Mock()
+    with patch('sshuttle.helpers.log_sink', new=sink):
+        sshuttle.helpers.log("message 1\nline2\n")
+    assert sink.mock_calls == [call('prefix: message 1\n---> line2\n')]
+    assert mock_stderr.mock_calls == []
+
+
+@patch('sshuttle.helpers._resolvconf', new=(None, []))
 @patch('sshuttle.helpers.open', create=True)
 def test_resolvconf_nameservers(mock_open):
     mock_open.return_value = io.StringIO(u"""
@@ -139,6 +219,7 @@ nameserver 2404:6800:4004:80c::4
     ]
 
 
+@patch('sshuttle.helpers._resolvconf', new=(None, []))
 @patch('sshuttle.helpers.open', create=True)
 def test_resolvconf_random_nameserver(mock_open):
     mock_open.return_value = io.StringIO(u"""
@@ -162,6 +243,22 @@ nameserver 2404:6800:4004:80c::4
     ]
 
 
+@patch('sshuttle.helpers._resolvconf', new=(None, []))
+@patch('sshuttle.helpers.os.stat')
+@patch('sshuttle.helpers.open', create=True)
+def test_resolvconf_nameservers_cached(mock_open, mock_stat):
+    mock_stat.return_value = Mock(st_mtime=100.0, st_size=50, st_ino=1)
+    mock_open.side_effect = lambda name: io.StringIO(u"nameserver 10.0.0.1\n")
+    assert sshuttle.helpers.resolvconf_nameservers() == [(2, u'10.0.0.1')]
+    assert sshuttle.helpers.resolvconf_nameservers() == [(2, u'10.0.0.1')]
+    assert len(mock_open.mock_calls) == 1
+
+    mock_stat.return_value = Mock(st_mtime=101.0, st_size=50, st_ino=1)
+    mock_open.side_effect = lambda name: io.StringIO(u"nameserver ::1\n")
+    assert sshuttle.helpers.resolvconf_nameservers() == [(10, u'::1')]
+    assert len(mock_open.mock_calls) == 2
+
+
 def test_islocal():
     assert sshuttle.helpers.islocal("127.0.0.1", socket.AF_INET)
     assert not sshuttle.helpers.islocal("192.0.2.1", socket.AF_INET)
@@ -13,6 +13,7 @@ def test_get_supported_features():
     assert not features.ipv6
     assert not features.udp
     assert features.dns
+    assert features.workers
 
 
 def test_get_tcp_dstip():
@@ -13,6 +13,7 @@ def test_get_supported_features():
     assert not features.ipv6
     assert not features.udp
     assert features.dns
+    assert not features.workers
 
 
 @patch('sshuttle.helpers.verbose', new=3)
@@ -76,6 +77,11 @@ def test_assert_features():
     features = method.get_supported_features()
     method.assert_features(features)
 
+    features.workers = True
+    with pytest.raises(Fatal):
+        method.assert_features(features)
+    features.workers = False
+
     features.udp = True
     with pytest.raises(Fatal):
         method.assert_features(features)
@@ -1,3 +1,6 @@
+import errno
+import socket
+
 from mock import Mock, patch, call
 
 from sshuttle.methods import get_method
@@ -41,20 +44,93 @@ def test_recv_udp(mock_recv_udp):
     assert result == ("127.0.0.1", "127.0.0.2", "11111")
 
 
+@patch("sshuttle.methods.tproxy.recvmsg", "python")
+@patch("sshuttle.methods.tproxy.recv_udp")
+def test_recv_udp_batch(mock_recv_udp):
+    mock_recv_udp.side_effect = [
+        ("127.0.0.1", "127.0.0.2", "11111"),
+        ("127.0.0.1", None, "22222"),
+        ("127.0.0.3", "127.0.0.2", "33333"),
+        socket.error(errno.EAGAIN, "again"),
+    ]
+
+    sock = Mock()
+    method = get_method('tproxy')
+    result = method.recv_udp_batch(sock, 1024, 10)
+    assert mock_recv_udp.mock_calls == [
+        call(sock, 1024),
+        call(sock, 1024, socket.MSG_DONTWAIT),
+        call(sock, 1024, socket.MSG_DONTWAIT),
+        call(sock, 1024, socket.MSG_DONTWAIT),
+    ]
+    assert result == [("127.0.0.1", "127.0.0.2", "11111"),
+                      ("127.0.0.3", "127.0.0.2", "33333")]
+
+    mock_recv_udp.reset_mock()
+    mock_recv_udp.side_effect = None
+    mock_recv_udp.return_value = ("127.0.0.1", "127.0.0.2", "11111")
+    assert len(method.recv_udp_batch(sock, 1024, 3)) == 3
+    assert len(mock_recv_udp.mock_calls) == 3
+
+
+def _calls(mock):
+    # without the __hash__() calls from keeping mock sockets in dicts
+    return [c for c in mock.mock_calls if not c[0].startswith('().__')]
+
+
 @patch("sshuttle.methods.socket.socket")
 def test_send_udp(mock_socket):
     sock = Mock()
     method = get_method('tproxy')
     method.send_udp(sock, "127.0.0.2", "127.0.0.1", "2222222")
     assert sock.mock_calls == []
-    assert mock_socket.mock_calls == [
+    assert _calls(mock_socket) == [
         call(sock.family, 2),
         call().setsockopt(1, 2, 1),
         call().setsockopt(0, 19, 1),
+        call().setsockopt(0, 20, 1),
         call().bind('127.0.0.2'),
         call().sendto("2222222", '127.0.0.1'),
+    ]
+    assert method.udp_senders() == [(mock_socket.return_value, sock)]
+
+    # the sender is kept for as long as a peer it replied to is around
+    mock_socket.reset_mock()
+    method.send_udp(sock, "127.0.0.2", "127.0.0.3", "3333333")
+    method.forget_udp("127.0.0.1")
+    assert _calls(mock_socket) == [
+        call().sendto("3333333", '127.0.0.3'),
+    ]
+    method.forget_udp("127.0.0.3")
+    assert _calls(mock_socket) == [
+        call().sendto("3333333", '127.0.0.3'),
         call().close()
     ]
+    assert method.udp_senders() == []
+    assert method.peer_senders == {}
+
+
+@patch("sshuttle.methods.tproxy.UDP_SENDERS", 2)
+@patch("sshuttle.methods.socket.socket")
+def test_send_udp_lru(mock_socket):
+    senders = [Mock(), Mock(), Mock(), Mock()]
+    mock_socket.side_effect = senders
+    sock = Mock()
+    method = get_method('tproxy')
+    method.udp_senders_changed = Mock()
+    method.send_udp(sock, ("10.0.0.1", 53), "127.0.0.1", "1")
+    method.send_udp(sock, ("10.0.0.2", 53), "127.0.0.1", "2")
+    method.send_udp(sock, ("10.0.0.1", 53), "127.0.0.1", "3")
+    method.send_udp(sock, ("10.0.0.3", 53), "127.0.0.1", "4")
+    assert senders[0].close.mock_calls == []
+    assert senders[1].close.mock_calls == [call()]
+    assert sorted(method.senders) == [(sock.family, ("10.0.0.1", 53)),
+                                      (sock.family, ("10.0.0.3", 53))]
+    assert len(method.udp_senders_changed.mock_calls) == 4
+
+    # replies sent from a sender are for the listener it replies for
+    method.send_udp(senders[2], ("10.0.0.4", 53), "127.0.0.1", "5")
+    assert dict(method.udp_senders()) == {senders[2]: sock, senders[3]: sock}
 
 
 def test_setup_tcp_listener():
@@ -0,0 +1,83 @@
+import os
+import shutil
+import socket
+import tempfile
+
+import sshuttle.metrics as metrics
+import sshuttle.ssnet as ssnet
+
+
+def test_histogram():
+    h = metrics.Histogram([0.1, 1])
+    for value in [0.05, 0.1, 0.5, 5]:
+        h.observe(value)
+    out = []
+    h.render(out, 'x_seconds', 'help')
+    assert out == [
+        '# HELP x_seconds help',
+        '# TYPE x_seconds histogram',
+        'x_seconds_bucket{le="0.1"} 2',
+        'x_seconds_bucket{le="1"} 3',
+        'x_seconds_bucket{le="+Inf"} 4',
+        'x_seconds_sum 5.650000',
+        'x_seconds_count 4',
+    ]
+
+
+def test_parse_address():
+    assert metrics.parse_address('9100') == ('127.0.0.1', 9100)
+    assert metrics.parse_address('0.0.0.0:9100') == ('0.0.0.0', 9100)
+    assert metrics.parse_address('[::1]:9100') == ('::1', 9100)
+    assert metrics.parse_address('/run/s.sock') == '/run/s.sock'
+    assert metrics.worker_address(('::1', 9100), 2) == ('::1', 9102)
+    assert metrics.worker_address('/run/s.sock', 0) == '/run/s.sock'
+    assert metrics.worker_address('/run/s.sock', 2) == '/run/s.sock.2'
+
+
+def test_metrics_server():
+    tmpdir = tempfile.mkdtemp()
+    a, b = socket.socketpair()
+    mux = ssnet.Mux(a, a)
+    mux.flush()
+    mux.pings.clear()
+    mux.send(1, ssnet.CMD_TCP_DATA, b'hello')
+    path = os.path.join(tmpdir, 'metrics')
+    server = metrics.MetricsServer(
+        path, [mux],
+        lambda: [('sshuttle_tcp_connections', 'gauge', 'help', 3)])
+    d = ssnet.Dispatcher(ssnet.SelectPoller())
+    d.add(server)
+    c = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        c.connect(path)
+        c.sendall(b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+        response = b''
+        while True:
+            d.update()
+            for (h, s) in d.poll(0.1):
+                h.callback(s)
+                h.changed()
+            c.setblocking(False)
+            try:
+                data = c.recv(65536)
+            except socket.error:
+                continue
+            if not data:
+                break
+            response += data
+        (head, body) = response.split(b'\r\n\r\n', 1)
+        assert head.startswith(b'HTTP/1.0 200 OK\r\n')
+        lines = body.decode('ASCII').split('\n')
+        assert 'sshuttle_tcp_connections 3' in lines
+        assert 'sshuttle_tcp_bytes_total{mux="0",direction="out"} 5' in lines
+        assert 'sshuttle_mux_channels{mux="0"} 0' in lines
+        # and it's measuring the round trip time again
+        assert len(mux.pings) == 1
+        assert not server.conns[0].ok
+    finally:
+        c.close()
+        server.close()
+        a.close()
+        b.close()
+        assert not os.path.exists(path)
+        shutil.rmtree(tmpdir)
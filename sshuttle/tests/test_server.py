@@ -0,0 +1,207 @@
+import select
+import socket
+import struct
+
+from mock import Mock, patch, call
+from dnslib import DNSRecord, RR, QTYPE, A, EDNS0
+
+import sshuttle.server
+import sshuttle.ssnet as ssnet
+
+
+def test_dns_upstream():
+    server = sshuttle.server
+    ns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ns.bind(('127.0.0.1', 0))
+    ns.settimeout(1)
+    mux = Mock()
+    servers = [(socket.AF_INET, '127.0.0.1')]
+
+    with patch.multiple(server, DNS_PORT=ns.getsockname()[1],
+                        resolvconf_nameservers=lambda: list(servers)):
+        dns = server.DnsUpstream(False, mux, [])
+        try:
+            requests = [struct.pack('!H', 0x1000 + i) + b'query%d' % i
+                        + b'\0' * 8 for i in range(10)]
+            for (chan, request) in enumerate(requests):
+                dns.query(chan, request)
+            assert len(dns.socks) == server.DNS_SOCKETS
+            assert len(dns.pending) == len(requests)
+
+            # answer them in reverse order, with our own IDs
+            got = []
+            for i in range(len(requests)):
+                got.append(ns.recvfrom(512))
+            for (query, peer) in reversed(got):
+                ns.sendto(query + b'answer', peer)
+            ns.sendto(b'\0\0 unsolicited', got[0][1])
+            for sock in dns.socks:
+                select.select([sock], [], [], 1)
+                dns.callback(sock)
+            expected = [call.send(chan, ssnet.CMD_DNS_RESPONSE,
+                                  request + b'answer')
+                        for (chan, request) in enumerate(requests)]
+            assert sorted(mux.mock_calls) == sorted(expected)
+            assert dns.pending == {}
+            assert dns.requests == {}
+
+            # unanswered requests are forgotten after a while
+            dns.query(20, requests[0])
+            dns.expire(0)
+            assert list(dns.requests) == [20]
+            dns.expire(dns.requests[20].timeout + 1)
+            assert dns.requests == {}
+            assert dns.pending == {}
+
+            # sockets to nameservers that are gone are closed
+            servers[:] = [(socket.AF_INET, '127.0.0.2')]
+            dns.query(21, requests[1])
+            assert list(dns.pool) == [(socket.AF_INET, '127.0.0.2')]
+            assert len(dns.socks) == 1
+        finally:
+            for sock in dns.socks:
+                sock.close()
+            ns.close()
+
+
+def test_dns_payload_size():
+    q = DNSRecord.question('example.com')
+    assert sshuttle.server.dns_payload_size(q.pack()) == 512
+    q.add_ar(EDNS0(udp_len=4096))
+    assert sshuttle.server.dns_payload_size(q.pack()) == 4096
+    assert sshuttle.server.dns_payload_size(q.pack()[:20]) == 512
+
+
+def test_dns_upstream_truncated():
+    server = sshuttle.server
+    ns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ns.bind(('127.0.0.1', 0))
+    ns.settimeout(1)
+    port = ns.getsockname()[1]
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+    listener.settimeout(1)
+    mux = Mock()
+    handlers = []
+
+    q = DNSRecord.question('big.example.com')
+    q.header.id = 4321
+    q.add_ar(EDNS0(udp_len=4096))
+    full = q.reply()
+    for i in range(100):
+        full.add_answer(RR('big.example.com', QTYPE.A, ttl=60,
+                           rdata=A('10.0.0.%d' % i)))
+    full = full.pack()
+
+    with patch.multiple(server, DNS_PORT=port,
+                        resolvconf_nameservers=lambda: [
+                            (socket.AF_INET, '127.0.0.1')]):
+        dns = server.DnsUpstream(False, mux, handlers)
+        try:
+            dns.query(1, q.pack())
+            (query, peer) = ns.recvfrom(512)
+            truncated = q.reply()
+            truncated.header.id = DNSRecord.parse(query).header.id
+            truncated.header.tc = 1
+            ns.sendto(truncated.pack(), peer)
+            select.select(dns.socks, [], [], 1)
+            dns.callback(dns.socks[0])
+            assert mux.mock_calls == []
+            (tcp,) = handlers
+
+            select.select([], [tcp.sock], [], 1)
+            tcp.callback(tcp.sock)
+            (conn, _) = listener.accept()
+            conn.settimeout(1)
+            assert conn.recv(2 + len(q.pack())) == \
+                struct.pack('!H', len(q.pack())) + q.pack()
+            conn.sendall(struct.pack('!H', len(full)) + full)
+            while mux.mock_calls == []:
+                select.select([tcp.sock], [], [], 1)
+                tcp.callback(tcp.sock)
+            conn.close()
+            assert mux.mock_calls == [
+                call.send(1, ssnet.CMD_DNS_RESPONSE, full)]
+            assert not tcp.ok
+            assert dns.requests == {}
+
+            # an asker that can't take more than 512 bytes gets the
+            # truncated answer as it is
+            mux.reset_mock()
+            q = DNSRecord.question('big.example.com')
+            dns.query(2, q.pack())
+            (query, peer) = ns.recvfrom(512)
+            truncated = q.reply()
+            truncated.header.tc = 1
+            truncated.header.id = DNSRecord.parse(query).header.id
+            ns.sendto(truncated.pack(), peer)
+            (readable, _, _) = select.select(dns.socks, [], [], 1)
+            dns.callback(readable[0])
+            truncated.header.id = q.header.id
+            assert mux.mock_calls == [
+                call.send(2, ssnet.CMD_DNS_RESPONSE, truncated.pack())]
+            assert handlers == [tcp]
+        finally:
+            for sock in dns.socks:
+                sock.close()
+            ns.close()
+            listener.close()
+
+
+def test_udp_relay():
+    server = sshuttle.server
+    peers = []
+    for i in range(2):
+        p = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        p.bind(('127.0.0.1', 0))
+        p.settimeout(1)
+        peers.append(p)
+    (a, b) = [p.getsockname() for p in peers]
+    mux = Mock()
+    mux.protocol = ssnet.PROTOCOL_UDP
+    relay = server.UdpRelay(False, mux)
+    try:
+        for chan in (1, 2, 3):
+            relay.open(chan, socket.AF_INET)
+        relay.send(1, a, b'1a')
+        relay.send(2, b, b'2b')
+        # both talk to a, so they can't share a socket any more
+        relay.send(2, a, b'2a')
+        relay.send(3, b, b'3b')
+        assert len(relay.socks) == 2
+
+        got = {}
+        for (p, n) in ((peers[0], 2), (peers[1], 2)):
+            for i in range(n):
+                (data, addr) = p.recvfrom(100)
+                got[data] = addr
+                p.sendto(data + b' reply', addr)
+        assert got[b'1a'] == got[b'2b'] != got[b'2a'] == got[b'3b']
+
+        for sock in relay.socks:
+            select.select([sock], [], [], 1)
+            relay.callback(sock)
+        header = ssnet.udp_header
+        assert sorted(mux.mock_calls) == sorted([
+            call.send(1, ssnet.CMD_UDP_DATA,
+                      header(mux.protocol, a) + b'1a reply'),
+            call.send(2, ssnet.CMD_UDP_DATA,
+                      header(mux.protocol, b) + b'2b reply'),
+            call.send(2, ssnet.CMD_UDP_DATA,
+                      header(mux.protocol, a) + b'2a reply'),
+            call.send(3, ssnet.CMD_UDP_DATA,
+                      header(mux.protocol, b) + b'3b reply'),
+        ])
+
+        relay.close(1)
+        relay.close(2)
+        assert len(relay.socks) == 1
+        relay.close(3)
+        assert relay.socks == []
+        assert relay.owners == {}
+    finally:
+        for sock in relay.socks:
+            sock.close()
+        for p in peers:
+            p.close()
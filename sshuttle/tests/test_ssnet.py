@@ -0,0 +1,429 @@
+import os
+import socket
+import select
+import struct
+
+import pytest
+from mock import Mock, patch, call
+
+import sshuttle.ssnet as ssnet
+from sshuttle.ssnet import Handler, Dispatcher
+
+
+POLLERS = [ssnet.SelectPoller]
+if hasattr(select, 'poll'):
+    POLLERS.append(ssnet.PollPoller)
+if hasattr(select, 'epoll'):
+    POLLERS.append(ssnet.EpollPoller)
+
+
+@pytest.mark.parametrize("poller", POLLERS)
+def test_poller(poller):
+    p = poller()
+    a, b = socket.socketpair()
+    try:
+        p.register(a.fileno(), ssnet.POLL_IN)
+        assert p.poll(0) == []
+
+        b.send(b'x')
+        assert p.poll(0) == [(a.fileno(), ssnet.POLL_IN)]
+
+        p.modify(a.fileno(), ssnet.POLL_OUT)
+        assert p.poll(0) == [(a.fileno(), ssnet.POLL_OUT)]
+
+        p.unregister(a.fileno())
+        assert p.poll(0) == []
+    finally:
+        a.close()
+        b.close()
+
+
+def test_dispatcher():
+    a, b = socket.socketpair()
+    called = []
+    h = Handler([a], lambda sock: called.append(sock.recv(10)))
+    d = Dispatcher(ssnet.SelectPoller())
+    try:
+        d.add(h)
+        d.update()
+        assert d.poll(0) == []
+
+        b.send(b'x')
+        assert d.poll(0) == [(h, a)]
+
+        h.ok = False
+        assert not d.handlers
+        assert not d.readers
+        assert d.poll(0) == []
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.parametrize("poller", POLLERS)
+def test_dispatcher_fd_reuse(poller):
+    a, b = socket.socketpair()
+    h1 = Handler([a])
+    d = Dispatcher(poller())
+    d.add(h1)
+    d.update()
+    # closed without telling the dispatcher first, and the fd number
+    # taken over by a socket of another handler
+    fd = a.fileno()
+    a.close()
+    c, e = socket.socketpair()
+    try:
+        if fd not in (c.fileno(), e.fileno()):
+            pytest.skip('fd number was not reused')
+        if e.fileno() == fd:
+            (c, e) = (e, c)
+        h2 = Handler([c])
+        d.add(h2)
+        d.update()
+        e.send(b'x')
+        assert d.poll(0) == [(h2, c)]
+
+        h1.socks = []
+        h1.changed()
+        d.update()
+        assert d.poll(0) == [(h2, c)]
+    finally:
+        b.close()
+        c.close()
+        e.close()
+
+
+class CountingProxy(ssnet.Proxy):
+
+    def __init__(self, wrap1, wrap2, called):
+        ssnet.Proxy.__init__(self, wrap1, wrap2)
+        self.called = called
+
+    def callback(self, sock):
+        self.called.append(self.wrap2.channel)
+        ssnet.Proxy.callback(self, sock)
+
+
+def test_proxy_wakeups():
+    a, b = socket.socketpair()
+    mux = ssnet.Mux(a, a)
+    peer = ssnet.Mux(b, b)
+    mux.protocol = peer.protocol = ssnet.PROTOCOL_VERSION
+    socks = [a, b]
+    handlers = [mux]
+    called = []
+    for chan in (1, 2):
+        (c, d) = socket.socketpair()
+        socks += [c, d]
+        handlers.append(CountingProxy(ssnet.SockWrapper(c, c),
+                                      ssnet.MuxWrapper(mux, chan), called))
+    dispatcher = Dispatcher(ssnet.SelectPoller())
+    try:
+        ssnet.runonce(handlers, mux, dispatcher, 0)
+        # only the mux itself waits on the mux's socket
+        assert list(dispatcher.readers[a.fileno()]) == [mux]
+        assert list(dispatcher.writers.get(a.fileno(), [mux])) == [mux]
+        del called[:]
+
+        # a frame for channel 1 only calls back channel 1's proxy
+        peer.send(1, ssnet.CMD_TCP_DATA, b'hello')
+        peer.flush()
+        ssnet.runonce(handlers, mux, dispatcher, 1)
+        assert called == [1]
+        assert socks[3].recv(10) == b'hello'
+    finally:
+        for s in socks:
+            s.close()
+
+
+@pytest.mark.parametrize("poller", POLLERS)
+def test_mux_ready(poller):
+    a, b = socket.socketpair()
+    mux = ssnet.Mux(a, a)
+    peer = ssnet.Mux(b, b)
+    dispatcher = Dispatcher(poller())
+    try:
+        # only writable: the PING goes out, but nobody tries to read
+        with patch.object(mux, 'handle') as handle:
+            ssnet.runonce([mux], mux, dispatcher, 0)
+            assert handle.mock_calls == []
+        assert not mux.outbuf
+
+        # only readable: nothing to write, but the frame is read
+        peer.send(1, ssnet.CMD_TCP_DATA, b'hello')
+        peer.flush()
+        got = []
+        mux.channels[1] = lambda cmd, data: got.append(data)
+        with patch.object(mux, 'flush') as flush:
+            ssnet.runonce([], mux, dispatcher, 1)
+            assert flush.mock_calls == []
+        assert got == [b'hello']
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.parametrize("protocol", [ssnet.PROTOCOL_MIN,
+                                      ssnet.PROTOCOL_LARGE])
+def test_mux_frames(protocol):
+    a, b = socket.socketpair()
+    m1 = ssnet.Mux(a, a)
+    m2 = ssnet.Mux(b, b)
+    m1.protocol = m2.protocol = protocol
+    got = []
+    m2.channels[1] = lambda cmd, data: got.append((cmd, data))
+    try:
+        sent = [b'hello', b'x' * m1.max_frame(), b'', b'world']
+        for data in sent:
+            m1.send(1, ssnet.CMD_TCP_DATA, data)
+        while len(got) < len(sent):
+            m1.flush()
+            m2.handle()
+        assert got == [(ssnet.CMD_TCP_DATA, data) for data in sent]
+        assert m1.amount_queued() == 0
+    finally:
+        a.close()
+        b.close()
+
+
+@patch('sshuttle.ssnet.MUX_IOV_MAX', new=3)
+def test_mux_short_writes():
+    a, b = socket.socketpair()
+    m1 = ssnet.Mux(a, a)
+    m2 = ssnet.Mux(b, b)
+    got = []
+    m2.channels[1] = lambda cmd, data: got.append(data)
+    chunks = []
+
+    def short_writev(fd, bufs):
+        # never more than 3 chunks, and stop in the middle of one
+        chunks.append(len(bufs))
+        data = b''.join(b.tobytes() if isinstance(b, memoryview) else b
+                        for b in bufs)
+        return os.write(fd, data[:7])
+
+    try:
+        sent = [b'hello', b'', b'x' * 20, b'world']
+        for data in sent:
+            m1.send(1, ssnet.CMD_TCP_DATA, data)
+        positions = []
+        with patch('sshuttle.ssnet._writev', new=short_writev):
+            while m1.amount_queued():
+                m1.flush()
+                positions.append(m1.outpos)
+        while len(got) < len(sent):
+            m2.handle()
+        assert got == sent
+        assert max(chunks) == 3
+        assert any(positions)  # stopped in the middle of a chunk
+        assert not m1.outbuf and m1.outpos == 0
+    finally:
+        a.close()
+        b.close()
+
+
+def test_mux_compression():
+    a, b = socket.socketpair()
+    m1 = ssnet.Mux(a, a)
+    m2 = ssnet.Mux(b, b)
+    m1.protocol = m2.protocol = ssnet.PROTOCOL_COMPRESS
+    got = []
+    m2.channels[1] = lambda cmd, data: got.append((cmd, data))
+    try:
+        m1.set_compression('zlib')
+        small = b'a' * (ssnet.MUX_COMPRESS_MIN - 1)
+        noise = os.urandom(ssnet.MUX_COMPRESS_MIN * 4)
+        text = b'a' * (ssnet.MUX_COMPRESS_MIN * 4)
+        m1.outbuf.clear()  # the initial PING
+        m1.queued = 0
+        m1.send(0, ssnet.CMD_COMPRESS, b'zlib')
+        for data in [small, noise, text]:
+            m1.send(1, ssnet.CMD_TCP_DATA, data)
+
+        cmds = [struct.unpack('!ccHHH', hdr)[3]
+                for hdr in list(m1.outbuf)[::2]]
+        assert cmds == [ssnet.CMD_COMPRESS, ssnet.CMD_TCP_DATA,
+                        ssnet.CMD_TCP_DATA, ssnet.CMD_TCP_DATA_Z]
+        zlen = len(m1.outbuf[-1])
+        assert zlen < len(text)
+        assert m1.compress_in == len(noise) + len(text)
+        assert m1.compress_out == len(noise) + zlen
+        assert m1.compression_ratio() == \
+            float(len(noise) + zlen) / (len(noise) + len(text))
+
+        while len(got) < 3:
+            m1.flush()
+            m2.handle()
+        assert m2.compression == 'zlib'
+        assert got == [(ssnet.CMD_TCP_DATA, data)
+                       for data in [small, noise, text]]
+    finally:
+        a.close()
+        b.close()
+
+
+def test_mux_compression_gives_up():
+    a, b = socket.socketpair()
+    m = ssnet.Mux(a, a)
+    m.protocol = ssnet.PROTOCOL_COMPRESS
+    try:
+        m.set_compression('zlib')
+        compress = Mock(side_effect=m.compress)
+        m.compress = compress
+        noise = os.urandom(ssnet.MUX_COMPRESS_MIN * 4)
+        text = b'a' * (ssnet.MUX_COMPRESS_MIN * 4)
+        m.outbuf.clear()  # the initial PING
+        for i in range(ssnet.MUX_COMPRESS_RETRY):
+            m.send(1, ssnet.CMD_TCP_DATA, noise)
+            m.send(2, ssnet.CMD_TCP_DATA, text)
+        # channel 1 is only tried a few times; channel 2 isn't affected
+        assert [c[1][0] for c in compress.mock_calls].count(noise) == \
+            ssnet.MUX_COMPRESS_TRIES
+        cmds = [struct.unpack('!ccHHH', hdr)[2:4]
+                for hdr in list(m.outbuf)[::2]]
+        assert set(cmds) == set([(1, ssnet.CMD_TCP_DATA),
+                                 (2, ssnet.CMD_TCP_DATA_Z)])
+
+        # but gets another go every now and then, after which it's
+        # compressed again if that helped
+        compress.reset_mock()
+        m.send(1, ssnet.CMD_TCP_DATA, text)
+        assert compress.mock_calls == [call(text)]
+        assert m.compress_misses == {}
+
+        # and forgotten once it's done
+        m.send(3, ssnet.CMD_TCP_DATA, noise)
+        assert list(m.compress_misses) == [3]
+        m.send(3, ssnet.CMD_TCP_EOF, b'')
+        assert m.compress_misses == {}
+    finally:
+        a.close()
+        b.close()
+
+
+def test_mux_counters():
+    a, b = socket.socketpair()
+    m1 = ssnet.Mux(a, a)
+    m2 = ssnet.Mux(b, b)
+    rtts = []
+    m1.got_rtt = rtts.append
+    got = []
+    m2.channels[1] = lambda cmd, data: got.append(data)
+    try:
+        m1.send(1, ssnet.CMD_TCP_DATA, b'hello')
+        m1.flush()
+        m2.handle()
+        assert got == [b'hello']
+        assert m2.tcp_in == m1.tcp_out == 5
+        # the initial PING, and the data
+        assert m2.frames_in == m1.frames_out == 2
+        assert m2.bytes_in == m1.bytes_out == 2 * ssnet.HDR_LEN + 7 + 5
+
+        assert m1.rtt is None and len(m1.pings) == 1
+        m2.flush()
+        m1.handle()
+        assert len(rtts) == 1 and m1.rtt == rtts[0] >= 0
+        assert not m1.pings
+    finally:
+        a.close()
+        b.close()
+
+
+def window_mux():
+    mux = Mock()
+    mux.channels = {}
+    mux.protocol = ssnet.PROTOCOL_WINDOW
+    mux.too_full = False
+    mux.max_frame.return_value = 65535
+    mux.rsock.getpeername.return_value = ('127.0.0.1', 22)
+    return mux
+
+
+def test_window_blocks_channel():
+    mux = window_mux()
+    w = ssnet.MuxWrapper(mux, 1)
+    w.window = 5
+    assert not w.too_full()
+    assert w.uwrite(b'x' * 10) == 5
+    assert w.window == 0
+    assert w.too_full()
+    assert w.uwrite(b'x') == 0
+    assert mux.send.mock_calls == [call(1, ssnet.CMD_TCP_DATA, b'x' * 5)]
+
+    w.handler = Mock()
+    w.got_packet(ssnet.CMD_TCP_WINDOW, struct.pack('!I', 3))
+    assert w.handler.wakeup.mock_calls == [call()]
+    assert not w.too_full()
+    assert w.uwrite(b'y' * 10) == 3
+
+
+def test_window_credit_after_write():
+    mux = window_mux()
+    w = ssnet.MuxWrapper(mux, 1)
+    data = b'x' * (ssnet.MUX_WINDOW // 2)
+    w.got_packet(ssnet.CMD_TCP_DATA, data)
+    outwrap = Mock()
+    # nothing written locally yet, so no credit for the other end
+    outwrap.write.return_value = 0
+    w.copy_to(outwrap)
+    assert mux.send.mock_calls == []
+
+    outwrap.write.return_value = len(data)
+    w.copy_to(outwrap)
+    assert mux.send.mock_calls == [
+        call(1, ssnet.CMD_TCP_WINDOW, struct.pack('!I', len(data)))]
+
+
+def test_window_per_channel():
+    mux = window_mux()
+    w1 = ssnet.MuxWrapper(mux, 1)
+    w2 = ssnet.MuxWrapper(mux, 2)
+    w1.window = 0
+    # one channel out of credit doesn't hold up another
+    assert w1.too_full()
+    assert not w2.too_full()
+    assert w2.uwrite(b'abc') == 3
+    assert not mux.blocked.add.mock_calls
+
+
+@pytest.mark.parametrize("protocol", [ssnet.PROTOCOL_MIN,
+                                      ssnet.PROTOCOL_WINDOW])
+def test_pong_fullness(protocol):
+    a, b = socket.socketpair()
+    m = ssnet.Mux(a, a)
+    m.protocol = protocol
+    m.too_full = True
+    m.fullness = 1000
+    try:
+        m.got_packet(0, ssnet.CMD_PONG, b'chicken')
+        if protocol >= ssnet.PROTOCOL_WINDOW:
+            # only draining the queue gets us going again
+            assert m.too_full and m.fullness == 1000
+        else:
+            assert not m.too_full and m.fullness == 0
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.parametrize("protocol", [ssnet.PROTOCOL_MIN, ssnet.PROTOCOL_UDP])
+def test_udp_header(protocol):
+    for addr in [('10.1.2.3', 53), ('2001:db8::1', 65535)]:
+        data = ssnet.udp_header(protocol, addr) + b'a,b'
+        assert ssnet.split_udp_data(protocol, data) == (addr, b'a,b')
+    assert ssnet.udp_header(ssnet.PROTOCOL_UDP, ('10.1.2.3', 53)) == \
+        b'\x04\x00\x35\x0a\x01\x02\x03'
+
+
+@pytest.mark.parametrize("protocol", [ssnet.PROTOCOL_MIN,
+                                      ssnet.PROTOCOL_BINARY])
+def test_connect_and_open_data(protocol):
+    for (family, addr) in [(socket.AF_INET, ('10.1.2.3', 80)),
+                           (socket.AF_INET6, ('2001:db8::1', 443))]:
+        data = ssnet.tcp_connect_data(protocol, family, addr)
+        assert ssnet.split_tcp_connect(protocol, data) == (family, addr)
+        data = ssnet.udp_open_data(protocol, family)
+        assert ssnet.split_udp_open(protocol, data) == family
+    assert ssnet.tcp_connect_data(ssnet.PROTOCOL_BINARY, socket.AF_INET,
+                                  ('10.1.2.3', 80)) == \
+        b'\x04\x00\x50\x0a\x01\x02\x03'
@@ -0,0 +1,24 @@
+import os
+import socket
+import tempfile
+import shutil
+
+import sshuttle.ssyslog
+
+
+def test_devlog_sink():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'log')
+        assert sshuttle.ssyslog.devlog_sink(path) is None
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(path)
+        sink = sshuttle.ssyslog.devlog_sink(path)
+        sink('c : message 1\n---> line2\n')
+        tag = '<149>sshuttle[%d]: ' % os.getpid()
+        assert server.recv(1024) == (tag + 'c : message 1').encode()
+        assert server.recv(1024) == (tag + '---> line2').encode()
+        server.close()
+    finally:
+        shutil.rmtree(tmpdir)